@@ -0,0 +1,464 @@
+import os
+import gc
+import sys
+import json
+import time
+import logging
+import shutil
+import platform
+import argparse
+import subprocess
+from functools import cached_property
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import psutil
+import sklearn
+from feast import FileSource
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+
+from benchmarks.synthetic_market import generate_dataset
+from cli import COMMANDS
+from inference import EXPECTATIONS
+from prepare_data import USED_COLUMNS, add_targets
+from train_model import PreprocessDF
+from utils.compiled_forest import CompiledForest
+from utils.config import load_config
+from utils.geo_processing_utils import (
+    get_dist_from_bc,
+    get_geo_features,
+    get_num_neighbours,
+)
+from utils.io_utils import read_and_rename, write_partitioned
+from utils.labels import month_index
+from utils.neighbourhood import get_neighbourhood_features
+from utils.pit_join import as_of_join, read_keys, read_source
+from utils.rates import RATES, get_rates
+from utils.rolling import trend_features
+from utils.schema import (
+    FEATURE_DTYPES,
+    MODEL_DTYPE,
+    MODEL_FEATURES,
+    RAW_DTYPES,
+    cast_to_schema,
+    get_model_columns,
+    parse_bedrooms,
+)
+from utils.tracing import stage_span
+from utils.validation import validate
+
+log = logging.getLogger("BENCHMARK")
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = load_config()
+
+GEO_COLUMNS = ["latitude", "longitude", "zipcode", "city"]
+# the largest model of the search space
+TRAIN_PARAMS = {"n_estimators": 80, "max_depth": 30, "n_jobs": -1, "random_state": 0}
+# results measured on datasets with different parameters are not comparable
+DATASET_KEYS = ["rows", "markets", "cities", "months", "seed", "train_rows"]
+
+
+class Fixtures:
+    """Inputs of the benchmarks, computed once and not measured"""
+
+    def __init__(self, paths: List[str], train_rows: int):
+        self.paths = paths
+        self.train_rows = train_rows
+
+    @cached_property
+    def raw(self) -> pd.DataFrame:
+        df = pd.concat(
+            [read_and_rename(p, columns=USED_COLUMNS + GEO_COLUMNS) for p in self.paths],
+            ignore_index=True,
+        )
+        df = cast_to_schema(df, RAW_DTYPES)
+        df["bedrooms"] = parse_bedrooms(df["bedrooms"])
+        return df
+
+    @cached_property
+    def targets(self) -> pd.DataFrame:
+        return add_targets(self.raw, CONFIG["TARGET_HORIZONS"])
+
+    @cached_property
+    def features(self) -> pd.DataFrame:
+        """The rows of the feature sources in a single frame, with UTC timestamps"""
+        df = self.raw.assign(
+            event_timestamp=pd.to_datetime(self.raw["reporting_month"], utc=True)
+        )
+        df = get_geo_features(
+            df, GEO_ID="airbnb_property_id", radius=CONFIG["NEIGHBOURS_RADIUS_KM"]
+        )
+        df = df.join(trend_features(df, month_index(df["reporting_month"])))
+        df = df.join(get_neighbourhood_features(df))
+        df = df.join(get_rates(df))
+        return cast_to_schema(
+            df, {k: v for dtypes in FEATURE_DTYPES.values() for k, v in dtypes.items()}
+        )
+
+    @cached_property
+    def source(self) -> FileSource:
+        """The features of df2_feature_view written as prepare_data writes the sources (partitioned by
+        month, sorted, with row groups of PARQUET_ROW_GROUP_ROWS rows), rewritten at every run"""
+        path = os.path.join(os.path.dirname(self.paths[0]), "source_df2")
+        shutil.rmtree(path, ignore_errors=True)
+        columns = ["airbnb_property_id", "event_timestamp", *MODEL_FEATURES["df2_feature_view"]]
+        df = self.features[columns].assign(
+            event_timestamp=self.features["event_timestamp"].dt.tz_localize(None)
+        )
+        write_partitioned(
+            df.assign(month=df["event_timestamp"].dt.strftime("%Y-%m")),
+            path,
+            partition_cols=["month"],
+            sort_by=["airbnb_property_id", "event_timestamp"],
+            row_group_rows=CONFIG["PARQUET_ROW_GROUP_ROWS"],
+        )
+        return FileSource(name="source_df2", path=path, timestamp_field="event_timestamp")
+
+    @cached_property
+    def entities(self) -> pd.DataFrame:
+        entities = self.targets[["airbnb_property_id", "event_timestamp", "target_1m"]]
+        entities = entities.assign(
+            event_timestamp=entities["event_timestamp"].dt.tz_localize("UTC")
+        )
+        return entities.sort_values("event_timestamp", kind="stable").reset_index(drop=True)
+
+    @cached_property
+    def training_set(self) -> Tuple[np.ndarray, np.ndarray]:
+        keys = ["airbnb_property_id", "reporting_month"]
+        computed = [c for c in get_model_columns() if c not in self.targets.columns]
+        df = self.targets.merge(self.features[keys + computed], on=keys)
+        df = df[df["target_1m"].notna()]
+        df = df.sample(n=min(self.train_rows, len(df)), random_state=0)
+        X = np.asfortranarray(df[get_model_columns()].to_numpy(MODEL_DTYPE))
+        return X, df["target_1m"].to_numpy(bool)
+
+    @cached_property
+    def model(self) -> RandomForestClassifier:
+        X, y = self.training_set
+        return RandomForestClassifier(**TRAIN_PARAMS).fit(X, y)
+
+    @cached_property
+    def scoring_set(self) -> np.ndarray:
+        return np.asfortranarray(self.features[get_model_columns()].to_numpy(MODEL_DTYPE))
+
+
+def bench_read_and_rename(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    def read() -> List[pd.DataFrame]:
+        return [read_and_rename(p, columns=USED_COLUMNS + GEO_COLUMNS) for p in fx.paths]
+
+    return read, len(fx.raw)
+
+
+def bench_get_num_neighbours(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    df = fx.raw[["airbnb_property_id", "latitude", "longitude"]]
+    radius = CONFIG["NEIGHBOURS_RADIUS_KM"]
+    return lambda: get_num_neighbours(df, GEO_ID="airbnb_property_id", radius=radius), len(df)
+
+
+def bench_get_dist_from_bc(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    df = fx.raw[["airbnb_property_id", "latitude", "longitude"]]
+    return lambda: get_dist_from_bc(df, GEO_ID="airbnb_property_id"), len(df)
+
+
+def bench_add_targets(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    df = fx.raw
+    return lambda: add_targets(df, CONFIG["TARGET_HORIZONS"]), len(df)
+
+
+def bench_trend_features(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    df = fx.raw
+    months = month_index(df["reporting_month"])
+    return lambda: trend_features(df, months), len(df)
+
+
+def bench_neighbourhood_features(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    df = fx.raw
+    return lambda: get_neighbourhood_features(df), len(df)
+
+
+def bench_historical_retrieval(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    """The point in time joins of utils.pit_join, one per feature view, without the feature store"""
+    entities, features = fx.entities, fx.features
+
+    def retrieve() -> pd.DataFrame:
+        df = entities
+        for view, names in MODEL_FEATURES.items():
+            df = as_of_join(
+                df,
+                features,
+                join_keys=["airbnb_property_id"],
+                timestamp_field="event_timestamp",
+                features={name: name for name in names},
+            )
+        return df
+
+    return retrieve, len(entities)
+
+
+def bench_rates_retrieval(on_demand: bool) -> Callable[[Fixtures], Tuple[Callable[[], Any], int]]:
+    """Point in time join of the features of df2_feature_view, with the rates read from the source
+    (precomputed) or computed from the days after the join (on demand)"""
+
+    def bench(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+        entities, features = fx.entities, fx.features
+        names = MODEL_FEATURES["df2_feature_view"]
+        if on_demand:
+            names = [name for name in names if name not in RATES]
+
+        def retrieve() -> pd.DataFrame:
+            df = as_of_join(
+                entities,
+                features,
+                join_keys=["airbnb_property_id"],
+                timestamp_field="event_timestamp",
+                features={name: name for name in names},
+            )
+            return df.join(get_rates(df)) if on_demand else df
+
+        return retrieve, len(entities)
+
+    return bench
+
+
+def bench_rates_online(on_demand: bool) -> Callable[[Fixtures], Tuple[Callable[[], Any], int]]:
+    """Rates of the micro batches of the scoring service (SCORING_MAX_BATCH_SIZE properties), selected
+    from the online features (precomputed) or computed by the on demand view"""
+
+    def bench(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+        size = CONFIG["SCORING_MAX_BATCH_SIZE"]
+        online = fx.features[MODEL_FEATURES["df2_feature_view"]]
+        batches = [online.iloc[i : i + size] for i in range(0, min(len(online), 1000 * size), size)]
+        if on_demand:
+            return lambda: [get_rates(batch) for batch in batches], sum(map(len, batches))
+        return lambda: [batch[list(RATES)] for batch in batches], sum(map(len, batches))
+
+    return bench
+
+
+def bench_read_last_month(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    """The retrieval of the features of the last month: only its partition is read"""
+    source = fx.source
+    last_month = fx.features["event_timestamp"].max()
+    columns = ["airbnb_property_id", "event_timestamp", *MODEL_FEATURES["df2_feature_view"]]
+    rows = int((fx.features["event_timestamp"] == last_month).sum())
+    return lambda: read_source(source, columns, start=last_month, end=last_month), rows
+
+
+def bench_read_keys(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    """The lookup of 1000 properties in the whole history, by the statistics of the row groups"""
+    source = fx.source
+    ids = fx.features["airbnb_property_id"].drop_duplicates()
+    keys = ids.sample(n=min(1000, len(ids)), random_state=0).to_frame()
+    return lambda: read_keys(source, keys), len(keys)
+
+
+def bench_validate(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    df = fx.features
+    return lambda: validate(df, EXPECTATIONS), len(df)
+
+
+def bench_train(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    X, y = fx.training_set
+    return lambda: RandomForestClassifier(**TRAIN_PARAMS).fit(X, y), len(X)
+
+
+def bench_score_sklearn(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+    model, X = fx.model, fx.scoring_set
+    return lambda: model.predict_proba(X), len(X)
+
+
+def bench_score_small_batches(compiled: bool) -> Callable[[Fixtures], Tuple[Callable[[], Any], int]]:
+    """Scoring of the batches of the online service (SCORING_MAX_BATCH_SIZE rows). The compiled
+    forest is used only for these, it is slower than sklearn above MAX_BATCH_ROWS rows per call"""
+
+    def bench(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+        model = fx.model
+        if compiled:
+            model = CompiledForest.from_pipeline(
+                Pipeline([("preprocess", PreprocessDF()), ("classifier", fx.model)])
+            )
+        size = CONFIG["SCORING_MAX_BATCH_SIZE"]
+        X = np.ascontiguousarray(fx.scoring_set[: 1000 * size])
+        batches = [X[i : i + size] for i in range(0, len(X), size)]
+        return lambda: [model.predict_proba(batch) for batch in batches], len(X)
+
+    return bench
+
+
+def bench_startup(command: str) -> Callable[[Fixtures], Tuple[Callable[[], Any], int]]:
+    """Startup of a command of cli.py in a new interpreter: the imports before any work is done"""
+    argv = [sys.executable, "-c", f"import cli; cli.load_command({command!r})"]
+
+    def bench(fx: Fixtures) -> Tuple[Callable[[], Any], int]:
+        return lambda: subprocess.run(argv, cwd=SRC_DIR, check=True), 1
+
+    return bench
+
+
+BENCHMARKS: Dict[str, Callable[[Fixtures], Tuple[Callable[[], Any], int]]] = {
+    "read_and_rename": bench_read_and_rename,
+    "get_num_neighbours": bench_get_num_neighbours,
+    "get_dist_from_bc": bench_get_dist_from_bc,
+    "add_targets": bench_add_targets,
+    "trend_features": bench_trend_features,
+    "neighbourhood_features": bench_neighbourhood_features,
+    "historical_retrieval": bench_historical_retrieval,
+    "rates_precomputed": bench_rates_retrieval(on_demand=False),
+    "rates_on_demand": bench_rates_retrieval(on_demand=True),
+    "rates_online_precomputed": bench_rates_online(on_demand=False),
+    "rates_online_on_demand": bench_rates_online(on_demand=True),
+    "read_last_month": bench_read_last_month,
+    "read_keys": bench_read_keys,
+    "validate": bench_validate,
+    "train": bench_train,
+    "score_sklearn": bench_score_sklearn,
+    "score_sklearn_small_batches": bench_score_small_batches(compiled=False),
+    "score_compiled_small_batches": bench_score_small_batches(compiled=True),
+    **{f"startup_{name.replace('-', '_')}": bench_startup(name) for name in COMMANDS},
+}
+
+
+def measure(name: str, fn: Callable[[], Any], rows: int, repeat: int) -> Dict[str, float]:
+    """Best wall time of repeat runs, with its CPU time, and the largest memory peak above the starting RSS"""
+    runs = []
+    for _ in range(repeat):
+        gc.collect()
+        start_rss = psutil.Process().memory_info().rss
+        with stage_span(f"bench.{name}") as span:
+            span.rows = rows
+            fn()
+        delta = span.record["peak_rss_mb"] - start_rss / 2**20
+        runs.append({**span.record, "peak_rss_delta_mb": delta})
+    best = min(runs, key=lambda r: r["wall_s"])
+    return {
+        "wall_s": best["wall_s"],
+        "cpu_s": best["cpu_s"],
+        "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+        "peak_rss_delta_mb": max(r["peak_rss_delta_mb"] for r in runs),
+        "rows": rows,
+        "rows_per_s": rows / best["wall_s"],
+    }
+
+
+def get_meta(params: Dict[str, int]) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=SRC_DIR
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        **params,
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(
+    results: Dict[str, Any],
+    baseline: Dict[str, Any],
+    tolerance: float = 0.25,
+    min_wall_s: float = 0.05,
+    min_rss_mb: float = 32.0,
+) -> List[str]:
+    """Regressions of results with respect to baseline: wall time or memory above the baseline by more than
+    tolerance. Differences below min_wall_s and min_rss_mb are noise and never regressions
+
+    Returns:
+        List[str]: one message per regression, empty if there is none
+    """
+    changed = {k for k in DATASET_KEYS if results["meta"].get(k) != baseline["meta"].get(k)}
+    if changed:
+        raise ValueError(f"the baseline was measured on a different dataset: {sorted(changed)}")
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        for metric, floor in [("wall_s", min_wall_s), ("peak_rss_delta_mb", min_rss_mb)]:
+            limit = max(base[metric] * (1 + tolerance), base[metric] + floor)
+            if result[metric] > limit:
+                regressions.append(
+                    f"{name}: {metric} {result[metric]:.3f} > {limit:.3f} (baseline {base[metric]:.3f})"
+                )
+    return regressions
+
+
+def run(
+    params: Dict[str, int],
+    data_dir: str,
+    only: Optional[List[str]] = None,
+    repeat: int = 3,
+) -> Dict[str, Any]:
+    """Run the benchmarks on a synthetic dataset
+
+    Args:
+        params (Dict[str, int]): rows, markets, cities, months and seed of the dataset, train_rows of the training set
+        data_dir (str): cache of the synthetic datasets
+        only (Optional[List[str]], optional): benchmarks to run. Defaults to None (all).
+        repeat (int, optional): runs of every benchmark. Defaults to 3.
+
+    Returns:
+        Dict[str, Any]: "meta" with the parameters and the environment, "benchmarks" with the measures
+    """
+    paths = generate_dataset(
+        data_dir,
+        params["rows"],
+        params["markets"],
+        params["cities"],
+        params["months"],
+        params["seed"],
+    )
+    fixtures = Fixtures(paths, params["train_rows"])
+    results = {"meta": get_meta(params), "benchmarks": {}}
+    for name, bench in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+        fn, rows = bench(fixtures)
+        results["benchmarks"][name] = measure(name, fn, rows, repeat)
+        log.info(f"{name}: {json.dumps(results['benchmarks'][name])}")
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="benchmarks on synthetic markets")
+    parser.add_argument("--rows", type=int, default=100_000, help="rows of the dataset, from 100k to 10M")
+    parser.add_argument("--markets", type=int, default=4)
+    parser.add_argument("--cities", type=int, default=10, help="cities of every market")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--train-rows", type=int, default=200_000, help="max rows of the training set")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=None)
+    parser.add_argument("--data-dir", default=os.path.join(SRC_DIR, ".bench_data"))
+    parser.add_argument("--output", default=None, help="json file of the results")
+    parser.add_argument("--baseline", default=None, help="json results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    params = {k: getattr(args, k) for k in DATASET_KEYS}
+    results = run(params, args.data_dir, args.only, args.repeat)
+
+    output = args.output or os.path.join(
+        SRC_DIR, ".bench_results", f"{results['meta']['timestamp'].replace(':', '.')}-{args.rows}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=1)
+    log.info(f"results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            log.error(f"regression {message}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,178 @@
+import os
+import json
+import logging
+import argparse
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import csv
+
+from utils.io_utils import PERFORMANCE_DATA_SCHEMA
+
+log = logging.getLogger("BENCHMARK")
+
+LAST_MONTH = "2023-10"
+LISTING_TYPES = ["entire_home", "private_room", "shared_room", "hotel_room"]
+LISTING_PROBS = [0.75, 0.22, 0.01, 0.02]
+PROPERTY_TYPES = ["Entire home", "Entire rental unit", "Private room in home", "Entire condo"]
+# properties per km2 around the center of a city, close to the sample markets
+DENSITY_KM2 = 300
+KM_PER_DEGREE = 111.0
+
+
+def generate_market(
+    n_rows: int,
+    n_cities: int = 10,
+    n_months: int = 12,
+    seed: int = 0,
+    market_index: int = 0,
+) -> pa.Table:
+    """Synthetic market with the columns and the types of the *PerformanceData.csv files.
+    Every property is listed for a random run of consecutive months, a few months are missing
+    (properties coming back after a gap) and the cities are clusters of locations with a realistic density
+
+    Args:
+        n_rows (int): approximate number of rows
+        n_cities (int, optional): cities of the market. Defaults to 10.
+        n_months (int, optional): reporting months, the last one is LAST_MONTH. Defaults to 12.
+        seed (int, optional): random seed. Defaults to 0.
+        market_index (int, optional): makes property ids and locations unique across markets. Defaults to 0.
+
+    Returns:
+        pa.Table: the market, with the csv column names
+    """
+    rng = np.random.default_rng([seed, market_index])
+    months = pd.period_range(end=LAST_MONTH, periods=n_months, freq="M").strftime("%Y-%m")
+
+    # properties listed for a run of months, the mean run is half of the months
+    n_properties = max(1, int(n_rows / ((n_months + 1) / 2)))
+    length = rng.integers(1, n_months + 1, n_properties)
+    start = rng.integers(0, n_months - length + 1)
+    rows_per_property = np.repeat(np.arange(n_properties), length)
+    month_idx = start[rows_per_property] + (
+        np.arange(len(rows_per_property)) - np.repeat(np.cumsum(length) - length, length)
+    )
+    # a gap in the history of some properties
+    keep = rng.random(len(month_idx)) > 0.03
+    rows_per_property, month_idx = rows_per_property[keep], month_idx[keep]
+    n = len(rows_per_property)
+
+    # cities spread as a normal around their center, wider for more properties
+    city = rng.integers(0, n_cities, n_properties)
+    city_lat = rng.uniform(-50, 60) + rng.uniform(-0.5, 0.5, n_cities)
+    city_lon = rng.uniform(-120, 140) + rng.uniform(-0.5, 0.5, n_cities)
+    spread_km = np.sqrt(np.bincount(city, minlength=n_cities) / (2 * np.pi * DENSITY_KM2))
+    lat = city_lat[city] + rng.normal(0, 1, n_properties) * spread_km[city] / KM_PER_DEGREE
+    lon = city_lon[city] + rng.normal(0, 1, n_properties) * spread_km[city] / (
+        KM_PER_DEGREE * np.cos(np.radians(lat))
+    )
+    bedrooms = rng.integers(1, 7, n_properties).astype(str).astype(object)
+    bedrooms[rng.random(n_properties) < 0.05] = "Studio"
+    property_ids = (market_index + 1) * 10**12 + rng.permutation(n_properties * 10)[:n_properties]
+
+    blocked = rng.integers(0, 31, n)
+    available = 31 - blocked
+    occupancy = np.round(rng.uniform(0, 100, n), 1)
+    reservation_days = np.round(occupancy * available / 100).astype("int64")
+    adr = np.round(rng.lognormal(5, 0.6, n)).astype("int64") + 10
+    cleaning_fee = np.round(rng.gamma(1.5, 35, n))
+    cleaning_fee[rng.random(n) < 0.35] = np.nan
+
+    property_type = rng.integers(0, len(PROPERTY_TYPES), n_properties)
+    listing_type = rng.choice(len(LISTING_TYPES), n_properties, p=LISTING_PROBS)
+
+    p = rows_per_property
+    columns = {
+        "Property Type": np.array(PROPERTY_TYPES)[property_type][p],
+        "Listing Type": np.array(LISTING_TYPES)[listing_type][p],
+        "Bedrooms": bedrooms[p],
+        "Bathrooms": rng.integers(0, 5, n_properties)[p],
+        "Country Code": np.full(n, "US"),
+        "City": np.char.add("City ", city.astype(str))[p],
+        "Zipcode": (10000 + city * 100 + rng.integers(0, 100, n_properties)).astype(str)[p],
+        "Latitude": np.round(lat, 5)[p],
+        "Longitude": np.round(lon, 5)[p],
+        "Currency Native": np.full(n, "USD"),
+        "Airbnb Property ID": property_ids[p],
+        "Airbnb Host ID": rng.integers(10**4, 10**9, n_properties)[p],
+        "last_seen": np.full(n, "2024-01-03"),
+        "cleaning_fee": cleaning_fee,
+        "Reporting Month": np.asarray(months)[month_idx],
+        "Blocked Days": blocked,
+        "Available Days": available,
+        "Scraped During Month": np.ones(n, dtype=bool),
+        "Occupancy Rate": occupancy,
+        "Reservation Days": reservation_days,
+        "ADR (USD)": adr,
+        "ADR (Native)": adr,
+        "Number Of Reservation": rng.poisson(3, n),
+        "Revenue (USD)": adr * reservation_days,
+        "Revenue (Native)": adr * reservation_days,
+    }
+    return pa.table(
+        {
+            name: pa.array(values, type=PERFORMANCE_DATA_SCHEMA[name], from_pandas=True)
+            for name, values in columns.items()
+        }
+    )
+
+
+def generate_dataset(
+    data_dir: str,
+    n_rows: int,
+    n_markets: int = 4,
+    n_cities: int = 10,
+    n_months: int = 12,
+    seed: int = 0,
+) -> List[str]:
+    """Write n_markets synthetic market files with n_rows rows in total, the files of the same
+    parameters are generated once and reused
+
+    Args:
+        data_dir (str): directory of the datasets, every set of parameters gets its own subdirectory
+
+    Returns:
+        List[str]: paths of the market files
+    """
+    params = {
+        "rows": n_rows,
+        "markets": n_markets,
+        "cities": n_cities,
+        "months": n_months,
+        "seed": seed,
+    }
+    out_dir = os.path.join(data_dir, "-".join(f"{k}{v}" for k, v in params.items()))
+    paths = [
+        os.path.join(out_dir, f"Synthetic{i:02d}PerformanceData.csv") for i in range(n_markets)
+    ]
+    done_path = os.path.join(out_dir, "params.json")
+    if not os.path.exists(done_path):
+        os.makedirs(out_dir, exist_ok=True)
+        for i, path in enumerate(paths):
+            log.info(f"generating {path}")
+            table = generate_market(n_rows // n_markets, n_cities, n_months, seed, market_index=i)
+            csv.write_csv(table, path)
+        # written last, it marks a complete dataset
+        with open(done_path, "w", encoding="utf-8") as f:
+            json.dump(params, f)
+    return paths
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="generate synthetic *PerformanceData.csv files")
+    parser.add_argument("data_dir")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--markets", type=int, default=4)
+    parser.add_argument("--cities", type=int, default=10)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for path in generate_dataset(
+        args.data_dir, args.rows, args.markets, args.cities, args.months, args.seed
+    ):
+        print(path)
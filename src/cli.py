@@ -0,0 +1,207 @@
+import os
+import sys
+import asyncio
+import logging
+import argparse
+import importlib
+import warnings
+from types import ModuleType
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from utils.config import load_config
+from utils.tracing import stage_span
+
+log = logging.getLogger("CLI")
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Command(NamedTuple):
+    """A command of the project. Its module (with feast, mlflow, sklearn...) is imported only when it runs,
+    the arguments are defined here so that the help and the errors are immediate"""
+
+    module: str
+    description: str
+    add_arguments: Callable[[argparse.ArgumentParser], None]
+    # called with the module and the parsed arguments, returns the exit code
+    run: Callable[[ModuleType, argparse.Namespace], Optional[int]]
+
+
+def _prepare_data_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "input_files",
+        nargs="*",
+        help="market files or glob patterns in INPUT_DATA_DIR (default: INPUT_FILE in config.yaml)",
+    )
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="process only the months not yet written in OUT_DATA_DIR",
+    )
+    parser.add_argument(
+        "--out-of-core",
+        action="store_true",
+        default=None,
+        help="stream every market month by month (default: only the files larger than OUT_OF_CORE_MIN_MB)",
+    )
+
+
+def _no_arguments(parser: argparse.ArgumentParser) -> None:
+    pass
+
+
+def _train_arguments(parser: argparse.ArgumentParser) -> None:
+    CONFIG = load_config()
+    parser.add_argument("--search", choices=["grid", "halving"], default=CONFIG["SEARCH_MODE"])
+    parser.add_argument(
+        "--budget-s",
+        type=float,
+        default=CONFIG["SEARCH_BUDGET_S"],
+        help="wall clock budget of a grid search, in seconds",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="continue the last interrupted search"
+    )
+
+
+def _inference_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="score in a pool of processes and write the predictions to PREDICTIONS",
+    )
+
+
+def _serve_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--materialize",
+        action="store_true",
+        help="load the feature views in the online store before serving",
+    )
+
+
+def _load_test_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--url", default=None, help="running service, by default it runs in process"
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--ids-per-request", type=int, default=1)
+
+
+def _pipeline_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        help="stages to run with their dependencies (default: all)",
+    )
+    parser.add_argument(
+        "--force",
+        nargs="+",
+        default=[],
+        help="stages to run even if up to date, 'all' for every stage",
+    )
+    parser.add_argument("--max-workers", type=int, default=None)
+
+
+def _run_train(module: ModuleType, args: argparse.Namespace) -> None:
+    from utils.model_utils import local_tracking_server
+
+    with local_tracking_server():
+        module.main(args.search, args.budget_s, args.resume)
+
+
+def _run_inference(module: ModuleType, args: argparse.Namespace) -> None:
+    from utils.model_utils import local_tracking_server
+
+    with local_tracking_server():
+        module.main(batch=args.batch)
+
+
+def _run_serve(module: ModuleType, args: argparse.Namespace) -> None:
+    import uvicorn
+
+    if args.materialize:
+        log.info("materializing the online store")
+        module.materialize_online_store(module.get_feast_fs())
+    uvicorn.run(module.create_app(), host=args.host, port=args.port)
+
+
+def _run_load_test(module: ModuleType, args: argparse.Namespace) -> int:
+    ok = asyncio.run(
+        module.main(args.url, args.requests, args.concurrency, args.ids_per_request)
+    )
+    return 0 if ok else 1
+
+
+def _run_pipeline(module: ModuleType, args: argparse.Namespace) -> None:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        module.main(args.targets, args.force, args.max_workers)
+
+
+COMMANDS: Dict[str, Command] = {
+    "prepare-data": Command(
+        "prepare_data",
+        "prepare the feature sources",
+        _prepare_data_arguments,
+        lambda module, args: module.main(
+            args.input_files, args.max_workers, args.incremental, args.out_of_core
+        ),
+    ),
+    "prepare-training": Command(
+        "prepare_training",
+        "build the training dataset from the feature store",
+        _no_arguments,
+        lambda module, args: module.main(),
+    ),
+    "train": Command("train_model", "hyperparameter search of the model", _train_arguments, _run_train),
+    "inference": Command(
+        "inference", "predict the churn of the test properties", _inference_arguments, _run_inference
+    ),
+    "serve": Command("scoring_service", "online churn scoring service", _serve_arguments, _run_serve),
+    "load-test": Command(
+        "scoring_load_test", "load test of the scoring service", _load_test_arguments, _run_load_test
+    ),
+    "pipeline": Command("launch_project", "run the pipeline of the project", _pipeline_arguments, _run_pipeline),
+}
+
+
+def get_parser(name: str) -> argparse.ArgumentParser:
+    """Parser of a single command, for the scripts launched directly"""
+    command = COMMANDS[name]
+    parser = argparse.ArgumentParser(description=command.description)
+    command.add_arguments(parser)
+    return parser
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="airbnb-bc", description="churn prediction of the airbnb properties"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, command in COMMANDS.items():
+        command.add_arguments(
+            commands.add_parser(name, help=command.description, description=command.description)
+        )
+    return parser
+
+
+def load_command(name: str) -> ModuleType:
+    """Import the module of a command, the time is traced as 'cli.startup'"""
+    with stage_span("cli.startup", command=name):
+        return importlib.import_module(COMMANDS[name].module)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    # OUT_DATA_DIR and the other paths of config.yaml are relative to src
+    os.chdir(SRC_DIR)
+    return COMMANDS[args.command].run(load_command(args.command), args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,37 @@
 from datetime import timedelta
 import os
-import yaml
+import sys
 
 from feast import Entity, FeatureView, FileSource, Field
-from feast.types import Float32, Float64, Int32, Int64, String
+from feast.types import Bool, Float32, Float64, Int32, Int64, String
 
 filename = os.path.abspath(__file__)
-CONFIG_PATH = os.path.join(
-    os.path.dirname(filename), os.pardir, os.pardir, os.pardir, "config.yaml"
-)
-with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-    CONFIG = yaml.safe_load(f)
+
+# the settings and the types of the features are shared with the data preparation, see src/utils/schema.py
+sys.path.append(os.path.join(os.path.dirname(filename), os.pardir, os.pardir))
+from utils.config import load_config  # noqa: E402
+from utils.labels import get_target_columns  # noqa: E402
+from utils.schema import TARGET_DTYPE, get_feature_fields  # noqa: E402
+
+CONFIG = load_config()
+
+FEAST_TYPES = {
+    "int32": Int32,
+    "int64": Int64,
+    "float32": Float32,
+    "float64": Float64,
+    "category": String,
+    "bool": Bool,
+    "boolean": Bool,
+}
+
+
+def get_schema(view_name: str):
+    return [
+        Field(name=name, dtype=FEAST_TYPES[dtype])
+        for name, dtype in get_feature_fields(view_name).items()
+    ]
+
 
 DATA_DIR = os.path.join(os.path.dirname(filename), "data")
 
@@ -31,12 +52,7 @@ df1_fv = FeatureView(
     name="df1_feature_view",
     ttl=timedelta(days=1),
     entities=[property_entity],
-    schema=[
-        Field(name="listing_type", dtype=String),
-        Field(name="bedrooms", dtype=Int32),
-        Field(name="bathrooms", dtype=Int32),
-        # Field(name="cleaning_fee", dtype=Float32)
-    ],
+    schema=get_schema("df1_feature_view"),
     source=f_source1,
 )
 
@@ -53,16 +69,7 @@ df2_fv = FeatureView(
     name="df2_feature_view",
     ttl=timedelta(days=1),
     entities=[property_entity],
-    schema=[
-        Field(name="blocked_days", dtype=Int32),
-        Field(name="available_days", dtype=Int32),
-        Field(name="occupancy_rate", dtype=Float32),
-        Field(name="cleaning_fee", dtype=Float32),
-        Field(name="number_of_reservation", dtype=Float32),
-        Field(name="reservation_days", dtype=Int32),
-        Field(name="adr_usd", dtype=Float32),
-        Field(name="revenue_usd", dtype=Int64),
-    ],
+    schema=get_schema("df2_feature_view"),
     source=f_source2,
 )
 
@@ -78,14 +85,42 @@ df3_fv = FeatureView(
     name="df3_feature_view",
     ttl=timedelta(days=1),
     entities=[property_entity],
-    schema=[
-        Field(name="num_neighbours", dtype=Int64),
-        Field(name="dist_from_bc", dtype=Float64),
-        # Field(name="adr_usd", dtype=Float32)
-    ],
+    schema=get_schema("df3_feature_view"),
     source=f_source3,
 )
 
+# Declaring the source of the trends of the properties
+f_source4 = FileSource(
+    name="source4",
+    path=os.path.join(DATA_DIR, CONFIG["DATA4"]),
+    timestamp_field=CONFIG["EVENT_TIMESTAMP"],
+)
+
+# Defining the trends of the properties: changes, volatility and age of the listing
+df4_fv = FeatureView(
+    name="df4_feature_view",
+    ttl=timedelta(days=1),
+    entities=[property_entity],
+    schema=get_schema("df4_feature_view"),
+    source=f_source4,
+)
+
+# Declaring the source of the neighbourhoods of the properties
+f_source5 = FileSource(
+    name="source5",
+    path=os.path.join(DATA_DIR, CONFIG["DATA5"]),
+    timestamp_field=CONFIG["EVENT_TIMESTAMP"],
+)
+
+# Defining the neighbourhoods: competitors active in the same month within every radius
+df5_fv = FeatureView(
+    name="df5_feature_view",
+    ttl=timedelta(days=1),
+    entities=[property_entity],
+    schema=get_schema("df5_feature_view"),
+    source=f_source5,
+)
+
 
 # source1_push_source = PushSource(
 #     name="source1_push_source",
@@ -98,17 +133,20 @@ df3_fv = FeatureView(
 # )
 
 # Declaring the source of the targets
-# target_source = FileSource(
-#     name="target_source",
-#     path=os.path.join(DATA_DIR, CONFIG["TARGETDF"]),
-#     timestamp_field=CONFIG["EVENT_TIMESTAMP"],
-# )
+target_source = FileSource(
+    name="target_source",
+    path=os.path.join(DATA_DIR, CONFIG["TARGETDF"]),
+    timestamp_field=CONFIG["EVENT_TIMESTAMP"],
+)
 
-# # Defining the targets
-# target_fv = FeatureView(
-#     name="target_feature_view",
-#     entities=[property_entity],
-#     ttl=timedelta(days=1),
-#     schema=[Field(name="target", dtype=Bool)],
-#     source=target_source,
-# )
+# Defining the targets, one label per horizon
+target_fv = FeatureView(
+    name="target_feature_view",
+    entities=[property_entity],
+    ttl=timedelta(days=1),
+    schema=[
+        Field(name=name, dtype=FEAST_TYPES[TARGET_DTYPE])
+        for name in get_target_columns(CONFIG["TARGET_HORIZONS"])
+    ],
+    source=target_source,
+)
@@ -1,143 +1,170 @@
 import os
 import sys
-import yaml
 import logging
-import subprocess
+from functools import partial
+from typing import TYPE_CHECKING
+
 import pandas as pd
-import feast
-from feast import FeatureStore
-import mlflow
-from mlflow.entities import ViewType
-from feast.infra.offline_stores.file_source import SavedDatasetFileStorage
-from feast.dqm.profilers.ge_profiler import ge_profiler
-from feast.dqm.errors import ValidationFailed
 
-from great_expectations.core.expectation_suite import ExpectationSuite
-from great_expectations.dataset import PandasDataset
+from utils.config import load_config
+from utils.schema import get_feature_refs
+from utils.tracing import stage_span
+from utils.validation import Expectation, failed_rows, validate
+
+# feast, mlflow and sklearn take seconds to import, only the functions using them import them
+if TYPE_CHECKING:
+    from feast import FeatureStore
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 log = logging.getLogger("INFERENCE")
 
 
-@ge_profiler
-def stats_profiler(ds: PandasDataset) -> ExpectationSuite:
-    # simple checks on data consistency
-    ds.expect_column_values_to_be_between(
-        "available_days", min_value=1, max_value=31, mostly=0.99  # allow some outliers
-    )
+# simple checks on data consistency, mostly allows some outliers
+EXPECTATIONS = [
+    Expectation("available_days", min_value=1, max_value=31, mostly=0.99),
+    Expectation("bathrooms", min_value=1, max_value=1, mostly=0.99),
+    Expectation("num_neighbours", min_value=0, max_value=100.0, mostly=0.99),
+]
 
-    ds.expect_column_values_to_be_between(
-        "bathrooms", min_value=1, max_value=1, mostly=0.99  # allow some outliers
-    )
 
-    ds.expect_column_values_to_be_between(
-        "num_neighbours",
-        min_value=0,
-        max_value=100.0,
-        mostly=0.99,  # allow some outliers
-    )
+def get_model_cache_dir() -> str:
+    return os.path.join(os.path.dirname(__file__), load_config()["MODEL_CACHE_DIR"])
 
-    return ds.get_expectation_suite(discard_failed_expectations=False)
 
+def get_feast_fs() -> "FeatureStore":
+    """Feature store of the project, its registry snapshot is shared by the whole process"""
+    from utils.registry import get_feature_store
 
-def get_best_model_id(experiment_name: str, metric: str = "mean_test_f1") -> str:
-    """Retrieves the run id of the best trained model
+    return get_feature_store()
 
-    Args:
-        experiment_name (str): name of the experiment
-        metric (str, optional): criterion to choose the best model. Defaults to "mean_test_f1".
 
-    Returns:
-        str: run id of the best trained model
-    """
-    # mlflow.set_tracking_uri("http://127.0.0.1:5000")
-    df = mlflow.search_runs(
-        experiment_names=[experiment_name], run_view_type=ViewType.ALL
+def get_customer_to_predict() -> pd.DataFrame:
+    CONFIG = load_config()
+    df = pd.read_parquet(
+        os.path.join(os.path.dirname(__file__), CONFIG["OUT_DATA_DIR"], CONFIG["TESTDF"])
     )
-    df = df.sort_values(by=[f"metrics.{metric}"], ascending=False)
-    return df.iloc[0].run_id
-
-
-def get_config():
-    filename = os.path.abspath(__file__)
-    CONFIG_PATH = os.path.join(os.path.dirname(filename), os.pardir, "config.yaml")
+    return df
 
-    with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-        CONFIG = yaml.safe_load(f)
-    return CONFIG
 
+# get_best_model("airbnb-bc")
 
-def get_feast_fs() -> FeatureStore:
-    fs = feast.FeatureStore(
-        repo_path=os.path.join(os.path.dirname(__file__), "feature_store/feature_repo")
+def batch_score(dataset_path: str, run_id: str) -> None:
+    """Churn probability of every row of the dataset, written to the PREDICTIONS dataset by a pool of
+    SCORING_WORKERS processes. The throughput is logged as a run of the batch_scoring experiment"""
+    import mlflow
+    from utils.batch_scoring import score_dataset
+    from utils.model_utils import load_scoring_model
+
+    CONFIG = load_config()
+    # the sklearn forest on the large record batches, the compiled one only below MAX_BATCH_ROWS
+    load_fn = partial(load_scoring_model, batch_rows=CONFIG["SCORING_BATCH_ROWS"])
+    max_workers = CONFIG["SCORING_WORKERS"] or os.cpu_count()
+    report = score_dataset(
+        dataset_path,
+        os.path.join(os.path.dirname(__file__), CONFIG["OUT_DATA_DIR"], CONFIG["PREDICTIONS"]),
+        run_id,
+        load_fn,
+        cache_dir=get_model_cache_dir(),
+        batch_rows=CONFIG["SCORING_BATCH_ROWS"],
+        max_workers=max_workers,
     )
-    return fs
-
-
-def get_customer_to_predict() -> pd.DataFrame:
-    CONFIG = get_config()
-    df = pd.read_parquet(
-        os.path.join(
-            os.path.dirname(__file__),
-            "feature_store/feature_repo/data/",
-            CONFIG["TESTDF"],
-        )
+    log.info(
+        f"{report.churned} of {report.rows} properties predicted to leave, "
+        f"{report.rows_per_s:.0f} rows/s"
     )
-    return df
 
+    mlflow.set_experiment("batch_scoring")
+    with mlflow.start_run():
+        mlflow.log_params(
+            {
+                "model_run_id": run_id,
+                "batch_rows": CONFIG["SCORING_BATCH_ROWS"],
+                "workers": max_workers,
+            }
+        )
+        mlflow.log_metrics(
+            {"rows": report.rows, "wall_s": report.wall_s, "rows_per_s": report.rows_per_s}
+        )
 
-# get_best_model("airbnb-bc")
 
-if __name__ == "__main__":
+def main(batch: bool = False) -> None:
+    import mlflow
+    from feast.infra.offline_stores.file_source import SavedDatasetFileStorage
+    from utils.feature_matrix import get_feature_matrix
+    from utils.model_utils import TRACKING_URI, get_model_run_id, load_model
+    from utils.pit_join import get_historical_features
+    from utils.registry import REGISTRY_LOCK
 
-    CONFIG = get_config()
+    CONFIG = load_config()
 
     log.info("loading best model from mlflow")
 
-    mlflow.set_tracking_uri("http://127.0.0.1:5000")
-    loaded_model_id = get_best_model_id("test1")
-    loaded_model = mlflow.pyfunc.load_model(f"runs:/{loaded_model_id}/sk_models")
+    mlflow.set_tracking_uri(TRACKING_URI)
+    loaded_model_id = get_model_run_id("test1")
+    loaded_model = load_model(loaded_model_id, cache_dir=get_model_cache_dir())
 
     fs = get_feast_fs()
 
-    test = fs.get_historical_features(
+    test = get_historical_features(
+        fs,
         entity_df=get_customer_to_predict(),
-        features=[
-            "df1_feature_view:bedrooms",
-            "df1_feature_view:bathrooms",
-            "df2_feature_view:cleaning_fee",
-            "df2_feature_view:available_days",
-            "df2_feature_view:blocked_days",
-            "df2_feature_view:occupancy_rate",
-            "df2_feature_view:reservation_days",
-            "df2_feature_view:adr_usd",
-            "df2_feature_view:number_of_reservation",
-            "df3_feature_view:num_neighbours",
-            "df3_feature_view:dist_from_bc",
-        ],
+        features=get_feature_refs(on_demand=CONFIG["OFFLINE_RATES"] == "on_demand"),
+    )
+
+    inference_ds_path = os.path.join(
+        os.path.dirname(__file__), CONFIG["OUT_DATA_DIR"], "my_inference_ds.parquet"
     )
+    with REGISTRY_LOCK:
+        dataset = fs.create_saved_dataset(
+            from_=test,
+            name="my_inference_ds",
+            allow_overwrite=True,
+            storage=SavedDatasetFileStorage(path=inference_ds_path),
+            tags={"author": "fsxz"},
+        )
 
-    dataset = fs.create_saved_dataset(
-        from_=test,
-        name="my_inference_ds",
-        allow_overwrite=True,
-        storage=SavedDatasetFileStorage(
-            path=os.path.join(
-                os.path.dirname(__file__),
-                "feature_store/feature_repo/data/my_inference_ds.parquet",
-            )
-        ),
-        tags={"author": "fsxz"},
+    # the frame of the join computed for the saved dataset, nothing is retrieved again
+    test_df = test.to_df()
+    with stage_span("inference.validation") as span:
+        report = validate(test_df, EXPECTATIONS, sample_size=CONFIG["VALIDATION_SAMPLE_SIZE"])
+        span.rows = report.rows
+    log.info(report.summary())
+
+    # after a failed validation only the rows within the ranges of all the expectations are scored
+    scoring_ds_path = inference_ds_path
+    if not report.success:
+        report.offending_rows.to_parquet(
+            inference_ds_path.replace(".parquet", "_invalid_rows.parquet")
+        )
+        invalid = failed_rows(test_df, EXPECTATIONS)
+        scoring_ds_path = inference_ds_path.replace(".parquet", "_valid_rows.parquet")
+        test_df[~invalid].to_parquet(scoring_ds_path, index=False)
+        log.warning(
+            f"validation failed: {invalid.sum()} of {len(invalid)} rows are out of range and are not "
+            f"scored, the other {(~invalid).sum()} are in {scoring_ds_path}"
+        )
+
+    if batch:
+        batch_score(scoring_ds_path, loaded_model_id)
+        return
+
+    # the rows to score, whose model columns are mapped from disk without copies.
+    # The matrix is already the output of the preprocessing step, it goes straight to the classifier
+    features = get_feature_matrix(
+        scoring_ds_path,
+        loaded_model[0].needed_columns,
+        os.path.join(os.path.dirname(__file__), CONFIG["MATRIX_CACHE_DIR"]),
     )
+    with stage_span("inference.predict") as span:
+        staying = loaded_model[-1].predict(features)
+        span.rows = len(staying)
+    log.info(f"{(~staying).sum()} of {len(staying)} properties predicted to leave")
 
-    ds = fs.get_saved_dataset("my_inference_ds")
-    vr = ds.as_reference(name="validation_reference_dataset", profiler=stats_profiler)
 
-    try:
-        validated_test = test.to_df(validation_reference=vr)
-    except ValidationFailed as exc:
-        print("VALIDATION FAILED! THERE'S SOME PROBLEM IN THE DATA!")
-        bad_data = test.to_df()
+if __name__ == "__main__":
+    from cli import get_parser
+    from utils.model_utils import local_tracking_server
 
-    log.info("Sutting down mlflow ui")
-    subprocess.call("kill $(lsof -t -i:5000)", shell=True)
+    args = get_parser("inference").parse_args()
+    with local_tracking_server():
+        main(batch=args.batch)
@@ -1,57 +1,270 @@
-import logging
-import subprocess
+import os
 import sys
+import shutil
+import logging
 import warnings
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import yaml
+
+from utils.config import load_config
+from utils.pipeline import Stage, run_pipeline
+from utils.tracing import log_records_to_mlflow, stage_span
 
 log = logging.getLogger("INSTALLATION")
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG = load_config()
 
+FEATURE_REPO = os.path.join(SRC_DIR, "feature_store", "feature_repo")
+DATA_DIR = os.path.join(FEATURE_REPO, "data")
+STATE_PATH = os.path.join(DATA_DIR, "_state", "pipeline.json")
+
+# same settings of `feast init` with the local template
+FEATURE_STORE_YAML = {
+    "project": "feature_store",
+    "registry": "data/registry.db",
+    "provider": "local",
+    "online_store": {"type": "sqlite", "path": "data/online_store.db"},
+    "entity_key_serialization_version": 2,
+}
 
-def main():
-    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
-    log.info("creating feature store")
-    out = subprocess.call("feast init feature_store", shell=True)
-    if out == 0:
-        log.info("ok")
-    else:
-        sys.exit(1)
-
-    log.info("removing useless default files")
-    subprocess.call(
-        "rm  ./feature_store/feature_repo/example_repo.py ./feature_store/feature_repo/test_workflow.py ./feature_store/feature_repo/data/driver_stats.parquet",
-        shell=True,
+def src_files(*paths: str) -> List[str]:
+    return [os.path.join(SRC_DIR, p) for p in paths]
+
+
+def settings(*keys: str) -> Dict:
+    """The values of some keys of config.yaml, for the fingerprint of a stage"""
+    return {k: CONFIG[k] for k in sorted(keys)}
+
+
+def init_feature_store() -> None:
+    """Feature repository with the definitions of the project"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    repo_yaml = os.path.join(FEATURE_REPO, "feature_store.yaml")
+    if not os.path.exists(repo_yaml):
+        with open(repo_yaml, "w", encoding="utf-8") as f:
+            yaml.safe_dump(FEATURE_STORE_YAML, f, sort_keys=False)
+    # the definitions are imported as feature_store.feature_repo.fs_definition
+    Path(FEATURE_REPO, "__init__.py").touch()
+    shutil.copy(
+        os.path.join(SRC_DIR, "fs_definition.py"),
+        os.path.join(FEATURE_REPO, "fs_definition.py"),
     )
 
-    log.info("moving fs definition")
-    subprocess.call(
-        "cp fs_definition.py feature_store/feature_repo/fs_definition.py", shell=True
+
+def apply_feature_store() -> None:
+    """Same as `feast apply` in the feature repository, without changing the working directory.
+    Nothing is written when the definitions did not change since the last apply"""
+    from feast.repo_operations import apply_total_with_repo_instance, parse_repo
+    from utils.registry import apply_if_changed, get_feature_store
+
+    store = get_feature_store(FEATURE_REPO)
+    repo = parse_repo(Path(FEATURE_REPO))
+    apply_if_changed(
+        store,
+        "fs_definition",
+        [
+            *repo.data_sources,
+            *repo.entities,
+            *repo.feature_views,
+            *repo.on_demand_feature_views,
+            *repo.stream_feature_views,
+            *repo.feature_services,
+        ],
+        apply=lambda: apply_total_with_repo_instance(
+            store, store.project, store.registry, repo, skip_source_validation=False
+        ),
     )
 
-    code = subprocess.call("python prepare_data.py", shell=True)
-    if code == 0:
-        log.info("data preparation done!")
-    else:
-        log.info("error in creating data!")
-        sys.exit(1)
-
-    log.info("starting fs creation...")
-    code = subprocess.call("cd feature_store/feature_repo && feast apply", shell=True)
-    if code == 0:
-        log.info("fs created!")
-    else:
-        log.info("error in creating fs!")
-        sys.exit(1)
-
-    log.info("starting training dataset generation")
-    code = subprocess.call("python prepare_training.py", shell=True)
-    if code == 0:
-        log.info("training dataset created!")
-    else:
-        log.info("error in creating training dataset!")
-        sys.exit(1)
+
+def prepare_data() -> None:
+    from prepare_data import main
+
+    main()
+
+
+def prepare_training() -> None:
+    from prepare_training import main
+
+    main()
+
+
+def materialize() -> None:
+    from inference import get_feast_fs
+    from scoring_service import materialize_online_store
+
+    materialize_online_store(get_feast_fs())
+
+
+def train() -> None:
+    from train_model import main
+
+    main()
+
+
+def inference() -> None:
+    from inference import main
+
+    main()
+
+
+def get_stages() -> List[Stage]:
+    """The graph of the project. The fingerprint of a stage covers its code, its inputs and its settings"""
+    data_keys = ["DATA1", "DATA2", "DATA3", "DATA4", "DATA5", "TARGETDF"]
+    data = [os.path.join(DATA_DIR, CONFIG[k]) for k in data_keys]
+    return [
+        Stage(
+            "init_feature_store",
+            init_feature_store,
+            inputs=src_files("fs_definition.py"),
+            outputs=[
+                os.path.join(FEATURE_REPO, "feature_store.yaml"),
+                os.path.join(FEATURE_REPO, "fs_definition.py"),
+            ],
+        ),
+        Stage(
+            "prepare_data",
+            prepare_data,
+            inputs=[
+                os.path.join(SRC_DIR, os.pardir, CONFIG["INPUT_DATA_DIR"], CONFIG["INPUT_FILE"]),
+                *src_files("prepare_data.py", "utils/io_utils.py", "utils/schema.py"),
+                *src_files("utils/geo_processing_utils.py", "utils/labels.py", "utils/rolling.py"),
+                *src_files("utils/neighbourhood.py", "utils/rates.py"),
+            ],
+            # every setting read by prepare_data, but the OUT_OF_CORE_* ones: they change only how
+            # the outputs are computed
+            config=settings(
+                "INPUT_DATA_DIR",
+                "INPUT_FILE",
+                "OUT_DATA_DIR",
+                "EVENT_TIMESTAMP",
+                "NEIGHBOURS_RADIUS_KM",
+                "PARQUET_ROW_GROUP_ROWS",
+                "TARGET_HORIZON",
+                "TARGET_HORIZONS",
+                "TEST_MONTHS",
+                "TESTDF",
+                *data_keys,
+            ),
+            outputs=data
+            + [os.path.join(DATA_DIR, "train_df.parquet"), os.path.join(DATA_DIR, CONFIG["TESTDF"])],
+        ),
+        Stage(
+            "apply_feature_store",
+            apply_feature_store,
+            # feast reads the schema of the sources
+            deps=["init_feature_store", "prepare_data"],
+            inputs=src_files(
+                "utils/schema.py",
+                "utils/labels.py",
+                "utils/neighbourhood.py",
+                "utils/rates.py",
+                "utils/registry.py",
+            ),
+            config=settings("TARGET_HORIZONS"),
+            outputs=[os.path.join(DATA_DIR, "registry.db")],
+            # materialization and saved datasets are recorded in the registry too
+            shared_outputs=True,
+        ),
+        Stage(
+            "training_dataset",
+            prepare_training,
+            deps=["apply_feature_store"],
+            inputs=src_files(
+                "prepare_training.py",
+                "utils/pit_join.py",
+                "utils/rates.py",
+                "utils/registry.py",
+                "utils/schema.py",
+            ),
+            config=settings("OFFLINE_RATES"),
+            outputs=[os.path.join(DATA_DIR, "training_dataset.parquet")],
+        ),
+        Stage(
+            "materialize_online_store",
+            materialize,
+            deps=["apply_feature_store"],
+            outputs=[os.path.join(DATA_DIR, "online_store.db")],
+        ),
+        Stage(
+            "train",
+            train,
+            deps=["training_dataset"],
+            inputs=src_files(
+                "train_model.py",
+                "utils/compiled_forest.py",
+                "utils/feature_matrix.py",
+                "utils/model_utils.py",
+            ),
+            config=settings("SEARCH_MODE", "SEARCH_N_JOBS", "SEARCH_BUDGET_S", "SEARCH_SPACE"),
+        ),
+        # the champion model can change outside of the pipeline
+        Stage(
+            "inference",
+            inference,
+            deps=["train", "apply_feature_store"],
+            cache=False,
+        ),
+    ]
+
+
+def select_stages(stages: List[Stage], targets: Sequence[str]) -> List[Stage]:
+    """The target stages with all the stages they depend on"""
+    by_name = {s.name: s for s in stages}
+    selected, todo = set(), list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo += list(by_name[name].deps)
+    return [s for s in stages if s.name in selected]
+
+
+def log_pipeline_run(status: Dict[str, str]) -> None:
+    """Timings and memory of the stages as a run of the pipeline experiment"""
+    import mlflow
+    from utils.model_utils import TRACKING_URI
+
+    mlflow.set_tracking_uri(TRACKING_URI)
+    mlflow.set_experiment("pipeline")
+    with mlflow.start_run():
+        mlflow.set_tags({f"{name}.status": s for name, s in status.items()})
+        log_records_to_mlflow()
+
+
+def main(
+    targets: Optional[Sequence[str]] = None,
+    force: Sequence[str] = (),
+    max_workers: Optional[int] = None,
+) -> None:
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    # the scripts resolve OUT_DATA_DIR from here, as when they are launched by hand
+    os.chdir(SRC_DIR)
+
+    stages = get_stages()
+    if targets:
+        stages = select_stages(stages, targets)
+    if "all" in force:
+        force = [s.name for s in stages]
+
+    from utils.model_utils import LOCAL_TRACKING, local_tracking_server
+
+    names = {s.name for s in stages}
+    with local_tracking_server(bool(names & {"train", "inference"})) as server:
+        with stage_span("pipeline"):
+            status = run_pipeline(stages, STATE_PATH, max_workers=max_workers, force=force)
+        if server is not None or not LOCAL_TRACKING:
+            log_pipeline_run(status)
+    log.info(", ".join(f"{name}: {s}" for name, s in status.items()))
 
 
 if __name__ == "__main__":
+    from cli import get_parser
+
+    args = get_parser("pipeline").parse_args()
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        main()
+        main(args.targets, args.force, args.max_workers)
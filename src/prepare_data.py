@@ -1,83 +1,680 @@
 import os
-import yaml
+import sys
+import glob
+import shutil
 import logging
+import tempfile
+import multiprocessing
+from functools import partial
+from typing import Dict, List, Optional, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor
+import dask
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+from dask import delayed
 
-from utils.io_utils import read_and_rename
-from utils.geo_processing_utils import get_dist_from_bc, get_num_neighbours
+from utils.config import load_config
+from utils.io_utils import iter_record_batches, read_and_rename, write_partitioned
+from utils.labels import churn_labels, get_target_columns, month_index
+from utils.neighbourhood import get_neighbourhood_features
+from utils.rates import get_rates
+from utils.rolling import TREND_MONTHS, trend_features
+from utils.schema import (
+    ENTITY_DTYPES,
+    FEATURE_DTYPES,
+    RAW_DTYPES,
+    TARGET_DTYPE,
+    cast_to_schema,
+    parse_bedrooms,
+)
+from utils.geo_processing_utils import update_geo_state, get_geo_features_from_state
+from utils.tracing import stage_span, trace_context
 
 log = logging.getLogger("INSTALLATION")
-filename = os.path.abspath(__file__)
-CONFIG_PATH = os.path.join(os.path.dirname(filename), os.pardir, "config.yaml")
-
-with open(CONFIG_PATH, "r", encoding="utf-8") as f:
-    CONFIG = yaml.safe_load(f)
+CONFIG = load_config()
 
 ABS_DATA_DIR = os.path.join(
-    os.path.dirname(filename), os.pardir, CONFIG["INPUT_DATA_DIR"]
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, CONFIG["INPUT_DATA_DIR"]
 )
 
+PARTITION_COLS = ["market", "month"]
+# datasets written by write_sources, the targets are cleared first: they mark the complete months
+SOURCE_KEYS = ["TARGETDF", "DATA1", "DATA2", "DATA3", "DATA4", "DATA5"]
+USED_COLUMNS = [
+    "airbnb_property_id",
+    "reporting_month",
+    "listing_type",
+    "bedrooms",
+    "bathrooms",
+    "cleaning_fee",
+    "blocked_days",
+    "available_days",
+    "occupancy_rate",
+    "reservation_days",
+    "adr_usd",
+    "number_of_reservation",
+    "revenue_usd",
+]
+GEO_COLUMNS = ["latitude", "longitude", "zipcode", "city"]
+# columns of the other months read by the labels and by the trends of a month
+HISTORY_COLUMNS = [
+    "airbnb_property_id",
+    "reporting_month",
+    "occupancy_rate",
+    "adr_usd",
+    "revenue_usd",
+]
+# per market state needed by the incremental refresh, ignored by the parquet readers
+STATE_DIR = os.path.join(CONFIG["OUT_DATA_DIR"], "_state")
+# months before a month needed by its labels (the previous months are relabeled) and by its trends
+HISTORY_MONTHS = max(max(CONFIG["TARGET_HORIZONS"]), TREND_MONTHS)
 
-df = read_and_rename(os.path.join(ABS_DATA_DIR, CONFIG["INPUT_FILE"]))
 
-geo_columns = ["latitude", "longitude", "zipcode", "city"]
-constants = ["scraped_during_month", "country_code", "currency_native"]
-not_useful = ["property_type", "airbnb_host_id", "last_seen"]
-cols_to_drop = constants + not_useful
-df = df.drop(cols_to_drop, axis=1)
+def read_split(target_column: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Train and test entities read back from the targets dataset. The split is a month: the months of
+    each side and the known labels of the training side are filtered in the scan, on the partitions
+    and on the statistics of the row groups, the other rows are never loaded"""
+    target_dir = os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG["TARGETDF"])
+    last_month = max(
+        os.path.basename(d).split("=", 1)[1]
+        for d in glob.glob(os.path.join(target_dir, "market=*", "month=*"))
+    )
+    test_start = shift_month(last_month, 1 - CONFIG["TEST_MONTHS"])
+    dataset = ds.dataset(target_dir, format="parquet", partitioning="hive")
+    columns = ["airbnb_property_id", CONFIG["EVENT_TIMESTAMP"], target_column]
+    train_df = dataset.to_table(
+        columns=columns,
+        filter=(ds.field("month") < test_start) & ds.field(target_column).is_valid(),
+    ).to_pandas()
+    test_df = dataset.to_table(columns=columns, filter=ds.field("month") >= test_start).to_pandas()
+    return train_df, test_df
 
 
-df.sort_values(by=["airbnb_property_id", "reporting_month"], inplace=True)
+def get_market_files(input_files: Union[str, List[str]]) -> List[str]:
+    """Resolve the market files to process
 
-# Shift the reporting_month column by one row for each airbnb_property_id
-df["next_reporting_month"] = df.groupby("airbnb_property_id")["reporting_month"].shift(
-    -1
-)
+    Args:
+        input_files (Union[str, List[str]]): file names or glob patterns, relative to INPUT_DATA_DIR
+
+    Returns:
+        List[str]: sorted absolute paths of the market files
+    """
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    paths = set()
+    for pattern in input_files:
+        paths.update(glob.glob(os.path.join(ABS_DATA_DIR, pattern)))
+    return sorted(paths)
+
+
+def get_market_name(path: str) -> str:
+    """BrightonPerformanceData.csv -> Brighton"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return name.replace("PerformanceData", "") or name
+
+
+def get_materialized_months(market: str) -> List[str]:
+    """Months of the market already written, the targets are written last so they mark complete months"""
+    market_dir = os.path.join(
+        CONFIG["OUT_DATA_DIR"], CONFIG["TARGETDF"], f"market={market}"
+    )
+    if not os.path.isdir(market_dir):
+        return []
+    return sorted(
+        d.split("=", 1)[1] for d in os.listdir(market_dir) if d.startswith("month=")
+    )
+
+
+def load_market_state(market: str) -> Tuple[pd.DataFrame, pd.Series]:
+    state_dir = os.path.join(STATE_DIR, market)
+    first_seen = pd.read_parquet(os.path.join(state_dir, "first_seen.parquet"))
+    return (
+        pd.read_parquet(os.path.join(state_dir, "geo_state.parquet")),
+        first_seen.set_index("airbnb_property_id")["first_month"],
+    )
+
+
+def save_market_state(market: str, geo_state: pd.DataFrame, first_seen: pd.Series) -> None:
+    state_dir = os.path.join(STATE_DIR, market)
+    os.makedirs(state_dir, exist_ok=True)
+    geo_state.to_parquet(os.path.join(state_dir, "geo_state.parquet"), index=False)
+    first_seen.rename("first_month").rename_axis("airbnb_property_id").reset_index().to_parquet(
+        os.path.join(state_dir, "first_seen.parquet"), index=False
+    )
+
+
+def add_targets(
+    df: pd.DataFrame, horizons: List[int], cutoff: Optional[int] = None
+) -> pd.DataFrame:
+    """Add the churn labels 'target_<k>m' of every horizon (see utils.labels.churn_labels) and 'event_timestamp'.
+    The labels are unknown for the months too close to the last month of df
+
+    Args:
+        df (pd.DataFrame): monthly rows of the properties, with 'airbnb_property_id' and 'reporting_month'
+        horizons (List[int]): months ahead of the labels
+        cutoff (Optional[int], optional): last month of the data, as month_index. Defaults to None, the last month of df.
+
+    Returns:
+        pd.DataFrame: the rows of df with the labels
+    """
+    labels = churn_labels(
+        df["airbnb_property_id"].to_numpy(), month_index(df["reporting_month"]), horizons, cutoff
+    )
+    df = df.assign(**{column: labels[column].array for column in labels})
+    df["event_timestamp"] = pd.to_datetime(df["reporting_month"])
+    return df
+
+
+def prepare_market(
+    path: str,
+    incremental: bool = False,
+    trace_parent: Optional[dict] = None,
+    out_of_core: Optional[bool] = None,
+) -> Optional[pd.DataFrame]:
+    """Compute targets and features of a single market and write them as partitions of the feature sources
+
+    Args:
+        path (str): path of the csv of the market
+        incremental (bool, optional): process only the months not yet materialized. Defaults to False.
+        trace_parent (Optional[dict], optional): span of the caller, from utils.tracing.trace_context. Defaults to None.
+        out_of_core (Optional[bool], optional): stream the market through a dask graph of months (see
+            _prepare_market_out_of_core). Defaults to None, only the files larger than OUT_OF_CORE_MIN_MB.
+
+    Returns:
+        Optional[pd.DataFrame]: the targets of the market, used to split train and test entities.
+            None when they are not kept in memory (out of core)
+    """
+    market = get_market_name(path)
+    if out_of_core is None:
+        out_of_core = os.path.getsize(path) > CONFIG["OUT_OF_CORE_MIN_MB"] * 2**20
+    # the months added to an existing market are few, they are always prepared in memory
+    if incremental and get_materialized_months(market):
+        out_of_core = False
+
+    with stage_span(
+        "prepare_data.market", parent=trace_parent, market=market, out_of_core=out_of_core
+    ) as span:
+        if out_of_core:
+            span.rows = _prepare_market_out_of_core(path, market)
+            return None
+        target_df = _prepare_market(path, market, incremental)
+        span.rows = len(target_df)
+    return target_df
+
+
+def read_market(path: str, columns: List[str]) -> pd.DataFrame:
+    """Read the columns of a market file, with the types of the prepared data"""
+    df = read_and_rename(path, columns=columns)
+    if df is None:
+        raise FileNotFoundError(path)
+    return finalize_raw(df)
+
+
+def finalize_raw(df: pd.DataFrame) -> pd.DataFrame:
+    df = cast_to_schema(df, RAW_DTYPES)
+    df["bedrooms"] = parse_bedrooms(df["bedrooms"])
+    return df
+
+
+def cleaning_fee_sums(df: pd.DataFrame) -> pd.DataFrame:
+    """Sum and count of the cleaning fees of every month. The running mean of the market adds them month
+    by month, so that every execution mode (eager, incremental, out of core) adds the very same numbers"""
+    return df.groupby("reporting_month", sort=True, observed=True)["cleaning_fee"].agg(
+        ["sum", "count"]
+    )
+
+
+def add_cleaning_fee_sums(stats: dict, sums: pd.DataFrame) -> None:
+    for fee_sum, fee_count in sums.sort_index().itertuples(index=False):
+        stats["cleaning_fee_sum"] += float(fee_sum)
+        stats["cleaning_fee_count"] += int(fee_count)
+
+
+def build_sources(
+    df: pd.DataFrame,
+    target_rows: pd.Series,
+    feature_rows: pd.Series,
+    cutoff: Optional[int],
+    first_seen: pd.Series,
+    geo_state: pd.DataFrame,
+    cleaning_fee_mean: float,
+    context: Optional[pd.DataFrame] = None,
+) -> Dict[str, pd.DataFrame]:
+    """Targets and feature sources of some rows of a market, the other rows of df and the rows
+    of context are only used by their labels and by their trends
+
+    Args:
+        df (pd.DataFrame): monthly rows of the market, from read_market
+        target_rows (pd.Series): rows whose targets are returned
+        feature_rows (pd.Series): rows whose features are returned
+        cutoff (Optional[int]): last month of the market, see utils.labels.churn_labels
+        first_seen (pd.Series): first month of the properties listed before df
+        geo_state (pd.DataFrame): locations of the market, see update_geo_state
+        cleaning_fee_mean (float): replaces the missing cleaning fees
+        context (Optional[pd.DataFrame], optional): the HISTORY_COLUMNS of other months. Defaults to None.
+
+    Returns:
+        Dict[str, pd.DataFrame]: the frames to write, by key of CONFIG
+    """
+    history = df[HISTORY_COLUMNS]
+    if context is not None:
+        history = pd.concat([history, context[HISTORY_COLUMNS]], ignore_index=True)
+    target_columns = get_target_columns(CONFIG["TARGET_HORIZONS"])
+    labels = add_targets(history, CONFIG["TARGET_HORIZONS"], cutoff)
+    trends = trend_features(history, month_index(history["reporting_month"]), first_seen)
+    # the rows of df come first
+    labels, trends = (f.iloc[: len(df)].set_axis(df.index) for f in (labels, trends))
+    df = df.assign(**{c: labels[c] for c in target_columns + ["event_timestamp"]})
+    target_df = df.loc[target_rows, ["airbnb_property_id", "event_timestamp"] + target_columns]
+    df = df.join(trends)[feature_rows]
+
+    data_df1 = df[
+        ["airbnb_property_id", "event_timestamp"]
+        + ["listing_type", "bedrooms", "bathrooms"]
+    ].copy()
+    data_df4 = df[["airbnb_property_id", "event_timestamp"] + list(trends.columns)]
+
+    with stage_span("prepare_data.neighbourhood") as span:
+        span.rows = len(df)
+        # every month has its own neighbours, the new months need no history
+        data_df5 = df[["airbnb_property_id", "event_timestamp"]].join(
+            get_neighbourhood_features(df)
+        )
+    return {
+        "DATA1": data_df1,
+        **build_market_sources(df, geo_state, cleaning_fee_mean),
+        "DATA4": data_df4,
+        "DATA5": data_df5,
+        "TARGETDF": target_df,
+    }
 
-# Create a new column that is True if the next month's row exists for that airbnb_property_id
-df["target"] = ~df["next_reporting_month"].isnull()
-
-df = df[df["reporting_month"] != "2023-10-01"].drop(["next_reporting_month"], axis=1)
-df["event_timestamp"] = pd.to_datetime(df["reporting_month"])
-
-
-data_df1 = df[["airbnb_property_id", "event_timestamp"] + ["bedrooms", "bathrooms"]]
-data_df2 = df[
-    ["airbnb_property_id", "event_timestamp"]
-    + [
-        "cleaning_fee",
-        "blocked_days",
-        "available_days",
-        "occupancy_rate",
-        "reservation_days",
-        "adr_usd",
-        "number_of_reservation",
-        "revenue_usd",
+
+def build_market_sources(
+    df: pd.DataFrame, geo_state: pd.DataFrame, cleaning_fee_mean: float
+) -> Dict[str, pd.DataFrame]:
+    """The sources whose features depend on the whole market and not only on the months around a row:
+    the cleaning fees, the missing ones replaced by the mean of the market, and the geo features
+
+    Args:
+        df (pd.DataFrame): monthly rows of the market with 'event_timestamp'
+        geo_state (pd.DataFrame): locations of the market, see update_geo_state
+        cleaning_fee_mean (float): replaces the missing cleaning fees
+
+    Returns:
+        Dict[str, pd.DataFrame]: the frames of DATA2 and DATA3
+    """
+    data_df2 = df[
+        ["airbnb_property_id", "event_timestamp"]
+        + [
+            "cleaning_fee",
+            "blocked_days",
+            "available_days",
+            "occupancy_rate",
+            "reservation_days",
+            "adr_usd",
+            "number_of_reservation",
+            "revenue_usd",
+        ]
+    ].copy()
+    data_df2["cleaning_fee"] = data_df2["cleaning_fee"].fillna(cleaning_fee_mean)
+    data_df2 = data_df2.join(get_rates(data_df2))
+
+    data_df3 = get_geo_features_from_state(
+        df[["airbnb_property_id", "event_timestamp"] + GEO_COLUMNS],
+        geo_state,
+        GEO_ID="airbnb_property_id",
+    )
+    return {"DATA2": data_df2, "DATA3": data_df3}
+
+
+def clear_market(market: str) -> None:
+    """Remove the partitions of every month of the market, write_partitioned replaces only the months
+    it writes: a full preparation of a file with fewer months would leave the others behind"""
+    for key in SOURCE_KEYS:
+        shutil.rmtree(
+            os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG[key], f"market={market}"), ignore_errors=True
+        )
+
+
+def write_sources(market: str, sources: Dict[str, pd.DataFrame]) -> int:
+    """Write the partitions of the sources returned by build_sources, returns the rows written"""
+    dtypes = {
+        "DATA1": FEATURE_DTYPES["df1_feature_view"],
+        "DATA2": FEATURE_DTYPES["df2_feature_view"],
+        "DATA3": FEATURE_DTYPES["df3_feature_view"],
+        "DATA4": FEATURE_DTYPES["df4_feature_view"],
+        "DATA5": FEATURE_DTYPES["df5_feature_view"],
+        "TARGETDF": {c: TARGET_DTYPE for c in get_target_columns(CONFIG["TARGET_HORIZONS"])},
+    }
+    rows = 0
+    for key, data in sources.items():
+        # parquet files get the very same types declared in the feature views
+        data = cast_to_schema(data, {**ENTITY_DTYPES, **dtypes[key]})
+        write_partitioned(
+            data.assign(market=market, month=data["event_timestamp"].dt.strftime("%Y-%m")),
+            path=os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG[key]),
+            partition_cols=PARTITION_COLS,
+            sort_by=list(ENTITY_DTYPES),
+            row_group_rows=CONFIG["PARQUET_ROW_GROUP_ROWS"],
+        )
+        rows += len(data)
+    return rows
+
+
+def _prepare_market(path: str, market: str, incremental: bool) -> pd.DataFrame:
+    # constants (scraped_during_month, country_code, currency_native), not useful columns
+    # (property_type, airbnb_host_id, last_seen) and native currencies are never parsed
+    with stage_span("prepare_data.read") as span:
+        df = read_market(path, USED_COLUMNS + GEO_COLUMNS)
+        span.rows = len(df)
+
+    # running mean over the whole history of the market
+    stats = {"cleaning_fee_sum": 0.0, "cleaning_fee_count": 0}
+    add_cleaning_fee_sums(stats, cleaning_fee_sums(df))
+    cleaning_fee_mean = stats["cleaning_fee_sum"] / max(stats["cleaning_fee_count"], 1)
+
+    # in incremental mode only the new months are processed, together with the last
+    # materialized ones whose labels depend on the new months and the ones in the
+    # windows of the trends of the new months
+    months = get_materialized_months(market) if incremental else []
+    geo_state = None
+    if months and os.path.isdir(os.path.join(STATE_DIR, market)):
+        last_month = months[-1]
+        if df["reporting_month"].max() <= last_month:
+            log.info(f"{market}: already up to date")
+            return df.iloc[:0][["airbnb_property_id"]]
+        geo_state, first_seen = load_market_state(market)
+        keys = ["airbnb_property_id", "latitude", "longitude"]
+        removed = geo_state[keys].merge(df[keys], on=keys, how="left", indicator=True)["_merge"]
+        if removed.eq("left_only").any():
+            # the written months changed, not only their labels
+            log.info(f"{market}: properties removed from the file, preparing the whole market")
+            geo_state = None
+
+    market_df = None
+    if geo_state is not None:
+        # the market level features of the written months change with the new months
+        market_df = df
+        df = df[df["reporting_month"] > shift_month(last_month, -HISTORY_MONTHS)]
+    else:
+        last_month = ""
+        first_seen = pd.Series(dtype="int64")
+    new_rows = df["reporting_month"] > last_month
+
+    with stage_span("prepare_data.geo_features") as span:
+        span.rows = int(new_rows.sum())
+        # the neighbour counts are updated only around the new locations
+        geo_state = update_geo_state(
+            df.loc[new_rows, ["airbnb_property_id"] + GEO_COLUMNS],
+            geo_state,
+            GEO_ID="airbnb_property_id",
+            radius=CONFIG["NEIGHBOURS_RADIUS_KM"],
+        )
+
+    # the labels of a market end with its own data, whole months are relabeled
+    sources = build_sources(
+        df,
+        target_rows=pd.Series(True, index=df.index),
+        feature_rows=new_rows,
+        cutoff=None,
+        first_seen=first_seen,
+        geo_state=geo_state,
+        cleaning_fee_mean=cleaning_fee_mean,
+    )
+    if market_df is not None:
+        # every month of the market gets the cleaning fees and the geo features of a full run
+        sources.update(
+            build_market_sources(
+                market_df.assign(event_timestamp=pd.to_datetime(market_df["reporting_month"])),
+                geo_state,
+                cleaning_fee_mean,
+            )
+        )
+    months = month_index(df["reporting_month"])
+    first_seen = (
+        pd.concat([first_seen, pd.Series(months, index=df["airbnb_property_id"].to_numpy())])
+        .groupby(level=0)
+        .min()
+    )
+
+    with stage_span("prepare_data.write") as span:
+        if market_df is None:
+            # the whole market is prepared again
+            clear_market(market)
+        span.rows = write_sources(market, sources)
+    save_market_state(market, geo_state, first_seen)
+
+    log.info(f"{market}: {int(new_rows.sum())} rows prepared")
+    return sources["TARGETDF"]
+
+
+def shift_month(month: str, months: int) -> str:
+    return (pd.Period(month, "M") + months).strftime("%Y-%m")
+
+
+def stage_market(path: str, stage_dir: str, block_size: int) -> int:
+    """Stream a market file into a parquet dataset partitioned by month, with bounded memory.
+    The rows keep their position in the file ('_row'): every month is read back in the order of the file
+
+    Returns:
+        int: rows of the file
+    """
+    offset = 0
+    columns = USED_COLUMNS + GEO_COLUMNS
+    for i, batch in enumerate(iter_record_batches(path, columns, block_size)):
+        df = batch.to_pandas()
+        df["_row"] = np.arange(offset, offset + len(df))
+        offset += len(df)
+        df.assign(month=df["reporting_month"]).to_parquet(
+            stage_dir,
+            partition_cols=["month"],
+            index=False,
+            # file names sort in the order of the batches
+            basename_template=f"batch-{i:08d}-{{i}}.parquet",
+        )
+    return offset
+
+
+def read_staged_months(
+    stage_dir: str, months: List[str], columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """Rows of some months of a staged market in the order of the file, with their position '_row'"""
+    df = pd.read_parquet(
+        stage_dir,
+        columns=None if columns is None else columns + ["_row"],
+        filters=[("month", "in", months)],
+    )
+    df = df.drop(columns="month", errors="ignore").sort_values("_row", kind="stable")
+    return df.reset_index(drop=True)
+
+
+def _month_summary(stage_dir: str, month: str) -> Tuple[pd.DataFrame, pd.DataFrame, Dict[str, set]]:
+    """Cleaning fee sums, first location of the properties and values of the categories of a staged month"""
+    categorical = [c for c, dtype in RAW_DTYPES.items() if dtype == "category"]
+    df = read_staged_months(
+        stage_dir,
+        [month],
+        list(dict.fromkeys(["airbnb_property_id", "reporting_month", "cleaning_fee"] + GEO_COLUMNS + categorical)),
+    )
+    values = {c: set(df[c].dropna().unique()) for c in categorical}
+    locations = df.drop_duplicates(["airbnb_property_id", "latitude", "longitude"])
+    # numeric columns only, the locations of all the months are kept together
+    locations = locations[["_row", "airbnb_property_id", "latitude", "longitude"]].assign(
+        month=month_index(locations["reporting_month"])
+    )
+    return cleaning_fee_sums(df), locations, values
+
+
+def _market_summary(
+    summaries: List[Tuple[pd.DataFrame, pd.DataFrame, Dict[str, set]]]
+) -> Tuple[pd.DataFrame, pd.Series, dict, Dict[str, pd.CategoricalDtype]]:
+    """State of the whole market from the summaries of its months: locations (with the neighbour counts),
+    first month of every property and cleaning fee sums, the same of an eager run. The categorical
+    columns get the categories of the whole market, as when the file is read at once"""
+    stats = {"cleaning_fee_sum": 0.0, "cleaning_fee_count": 0}
+    add_cleaning_fee_sums(stats, pd.concat([sums for sums, _, _ in summaries]))
+    categories = {
+        c: pd.CategoricalDtype(sorted(set().union(*(values[c] for _, _, values in summaries))))
+        for c in summaries[0][2]
+    }
+    locations = pd.concat([loc for _, loc, _ in summaries]).sort_values("_row", kind="stable")
+    first_seen = locations.groupby("airbnb_property_id")["month"].min().rename_axis(None)
+    # the threads of the months share this index: pandas builds its hash table lazily and
+    # not thread safely, it is built here once
+    _ = first_seen.index.is_unique
+    # the locations in order of first appearance in the file, as read by the eager mode
+    locations = locations.drop_duplicates(["airbnb_property_id", "latitude", "longitude"])
+    geo_state = update_geo_state(
+        locations[["airbnb_property_id", "latitude", "longitude"]],
+        None,
+        GEO_ID="airbnb_property_id",
+        radius=CONFIG["NEIGHBOURS_RADIUS_KM"],
+    )
+    return geo_state, first_seen, stats, categories
+
+
+def _prepare_month(
+    stage_dir: str,
+    market: str,
+    month: str,
+    months: List[str],
+    summary: Tuple[pd.DataFrame, pd.Series, dict, Dict[str, pd.CategoricalDtype]],
+    trace_parent: Optional[dict] = None,
+) -> int:
+    """Build and write the sources of a staged month, with the months of its labels and of its trends"""
+    geo_state, first_seen, stats, categories = summary
+    context_months = [
+        m for m in months
+        if m != month
+        and shift_month(month, -TREND_MONTHS) <= m <= shift_month(month, max(CONFIG["TARGET_HORIZONS"]))
     ]
-]
+    with stage_span("prepare_data.month", parent=trace_parent, month=month) as span:
+        df = finalize_raw(read_staged_months(stage_dir, [month]).drop(columns="_row"))
+        df = df.astype(categories)
+        # the other months only for the labels and the trends
+        context = cast_to_schema(
+            read_staged_months(stage_dir, context_months, HISTORY_COLUMNS),
+            RAW_DTYPES,
+        )
+        rows = pd.Series(True, index=df.index)
+        sources = build_sources(
+            df,
+            target_rows=rows,
+            feature_rows=rows,
+            cutoff=month_index(pd.Series(months[-1:]))[0],
+            first_seen=first_seen,
+            geo_state=geo_state,
+            cleaning_fee_mean=stats["cleaning_fee_sum"] / max(stats["cleaning_fee_count"], 1),
+            context=context,
+        )
+        span.rows = write_sources(market, sources)
+    return span.rows
 
-data_df2.cleaning_fee.fillna(data_df2.cleaning_fee.mean(), inplace=True)
 
+def _prepare_market_out_of_core(path: str, market: str) -> int:
+    """Out of core version of _prepare_market, with the same outputs. The file is streamed into a staging
+    dataset partitioned by month, then a dask graph summarizes every month (cleaning fees, locations,
+    first months) into the state of the market and prepares every month from the few months around it.
+    At most OUT_OF_CORE_WORKERS windows of months are in memory at the same time
 
-data_df3 = df[["airbnb_property_id", "event_timestamp"] + geo_columns]
-data_df3 = get_num_neighbours(data_df3, GEO_ID="airbnb_property_id")
-data_df3 = get_dist_from_bc(data_df3, GEO_ID="airbnb_property_id")
+    Returns:
+        int: rows of the market
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    stage_dir = tempfile.mkdtemp(prefix=f"{market}-staged-", dir=STATE_DIR)
+    try:
+        with stage_span("prepare_data.stage") as span:
+            span.rows = stage_market(path, stage_dir, CONFIG["OUT_OF_CORE_BLOCK_MB"] * 2**20)
+        months = sorted(
+            d.split("=", 1)[1] for d in os.listdir(stage_dir) if d.startswith("month=")
+        )
 
-target_df = df[["airbnb_property_id", "target", "event_timestamp"]]
+        clear_market(market)
+        with stage_span("prepare_data.months", months=len(months)) as span:
+            summary = delayed(_market_summary)(
+                [delayed(_month_summary)(stage_dir, m) for m in months]
+            )
+            # the spans of the dask threads are children of this one
+            writes = [
+                delayed(_prepare_month)(stage_dir, market, m, months, summary, trace_context())
+                for m in months
+            ]
+            (geo_state, first_seen, stats, _), *written = dask.compute(
+                summary,
+                *writes,
+                scheduler="threads",
+                num_workers=CONFIG["OUT_OF_CORE_WORKERS"],
+            )
+            span.rows = sum(written)
+        save_market_state(market, geo_state, first_seen)
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
 
+    log.info(f"{market}: {span.rows} rows prepared out of core")
+    return span.rows
 
-data_df1.loc[data_df1.bedrooms == "Studio", "bedrooms"] = "1"
-data_df1.loc[:, "bedrooms"] = data_df1["bedrooms"].astype("int32")
 
-data_df1.to_parquet(path=os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG["DATA1"]))
-data_df2.to_parquet(path=os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG["DATA2"]))
-data_df3.to_parquet(path=os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG["DATA3"]))
+def main(
+    input_files: Optional[Union[str, List[str]]] = None,
+    max_workers: Optional[int] = None,
+    incremental: bool = False,
+    out_of_core: Optional[bool] = None,
+) -> None:
+    files = get_market_files(input_files or CONFIG["INPUT_FILE"])
+    if not files:
+        raise FileNotFoundError(f"no market files found in {ABS_DATA_DIR}")
+    # the label the model is trained on
+    target_column = get_target_columns([CONFIG["TARGET_HORIZON"]])[0]
+    if not incremental:
+        # a full run writes the markets of files only, from scratch
+        for key in SOURCE_KEYS:
+            shutil.rmtree(os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG[key]), ignore_errors=True)
+        shutil.rmtree(STATE_DIR, ignore_errors=True)
 
+    log.info(f"preparing {len(files)} markets")
+    # one worker per market, every worker writes its own partitions
+    max_workers = min(max_workers or os.cpu_count(), len(files))
+    # spawned workers: main can run in a thread of the pipeline, forking a threaded process is unsafe
+    with stage_span("prepare_data.markets", markets=len(files)) as span, ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        # the spans of the workers are children of this one
+        prepare = partial(
+            prepare_market,
+            incremental=incremental,
+            trace_parent=trace_context(),
+            out_of_core=out_of_core,
+        )
+        targets = list(pool.map(prepare, files))
 
-# SPLIT TRAIN AND TEST_DATA
-train_df, test_df = (
-    target_df[target_df[CONFIG["EVENT_TIMESTAMP"]] < "2023-09-01"],
-    target_df[target_df[CONFIG["EVENT_TIMESTAMP"]] >= "2023-09-01"],
-)
-train_df.to_parquet(path=os.path.join(CONFIG["OUT_DATA_DIR"], "train_df.parquet"))
-test_df.to_parquet(path=os.path.join(CONFIG["OUT_DATA_DIR"], "test_df.parquet"))
+    # SPLIT TRAIN AND TEST_DATA: the last TEST_MONTHS months of the data are the test set,
+    # the training entities need a known label
+    entity_columns = ["airbnb_property_id", CONFIG["EVENT_TIMESTAMP"]]
+    if incremental or any(t is None for t in targets):
+        train_df, test_df = read_split(target_column)
+    else:
+        target_df = pd.concat(targets, ignore_index=True)
+        timestamps = target_df[CONFIG["EVENT_TIMESTAMP"]]
+        split = (timestamps.max().to_period("M") - CONFIG["TEST_MONTHS"] + 1).to_timestamp()
+        entities = target_df[entity_columns + [target_column]]
+        train_df = entities[(timestamps < split) & entities[target_column].notna()]
+        test_df = entities[timestamps >= split]
+    # the same entities in the same order whatever the way they were prepared
+    train_df, test_df = (
+        df.rename(columns={target_column: "target"}).sort_values(entity_columns, ignore_index=True)
+        for df in (train_df, test_df)
+    )
+    train_df = train_df.astype({"target": "bool"})
+    train_df.to_parquet(path=os.path.join(CONFIG["OUT_DATA_DIR"], "train_df.parquet"))
+    test_df.to_parquet(path=os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG["TESTDF"]))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    from cli import get_parser
+
+    args = get_parser("prepare-data").parse_args()
+
+    main(args.input_files, args.max_workers, args.incremental, args.out_of_core)
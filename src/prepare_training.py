@@ -1,71 +1,67 @@
 import os
 import pandas as pd
 import feast
-from feast.types import Float64, Int64
+from feast.types import Float32
 from feast import Field
 from feast.on_demand_feature_view import on_demand_feature_view
 from feast.infra.offline_stores.file_source import SavedDatasetFileStorage
 
+from utils.config import load_config
+from utils.pit_join import get_historical_features
+from utils.rates import RATES, get_rates
+from utils.registry import REGISTRY_LOCK, apply_if_changed, get_feature_store
+from utils.schema import get_feature_refs
 
-fs = feast.FeatureStore(
-    repo_path=os.path.join(os.path.dirname(__file__), "feature_store/feature_repo")
-)
 
-
-@on_demand_feature_view(
-    sources=[fs.get_feature_view(name="df2_feature_view")],
-    schema=[
-        Field(name="rate_blocked_days", dtype=Float64),
-        Field(name="rate_available_days", dtype=Float64),
-    ],
-)
 def on_demand_rates(input_df: pd.DataFrame) -> pd.DataFrame:
-    out = pd.DataFrame()
-    out["rate_blocked_days"] = input_df["blocked_days"] / input_df["available_days"]
-    out["rate_available_days"] = input_df["available_days"] / input_df["blocked_days"]
+    # the same numpy computation of the rates written with the sources
+    return get_rates(input_df)
+
 
-    return out
+def apply_on_demand_features(fs: feast.FeatureStore) -> None:
+    """Register the on demand feature views, their sources must be already applied.
+    The registry is written only when the views changed"""
+    inputs = sorted({column for pair in RATES.values() for column in pair})
+    on_demand_rates_fv = on_demand_feature_view(
+        # only the days are read for the rates, not the whole view
+        sources=[fs.get_feature_view(name="df2_feature_view", allow_registry_cache=True)[inputs]],
+        schema=[Field(name=name, dtype=Float32) for name in RATES],
+    )(on_demand_rates)
+    apply_if_changed(fs, "on_demand", [on_demand_rates_fv])
 
 
-fs.apply([on_demand_rates])
+def main() -> None:
+    fs = get_feature_store()
+    apply_on_demand_features(fs)
 
-df = pd.read_parquet(
-    os.path.join(
-        os.path.dirname(__file__), "feature_store/feature_repo/data", "train_df.parquet"
+    df = pd.read_parquet(
+        os.path.join(
+            os.path.dirname(__file__), "feature_store/feature_repo/data", "train_df.parquet"
+        )
     )
-)
 
+    training_df = get_historical_features(
+        fs,
+        entity_df=df,
+        features=get_feature_refs(on_demand=load_config()["OFFLINE_RATES"] == "on_demand"),
+    )
 
-training_df = fs.get_historical_features(
-    entity_df=df,
-    features=[
-        "df1_feature_view:bedrooms",
-        "df1_feature_view:bathrooms",
-        "df2_feature_view:cleaning_fee",
-        "df2_feature_view:available_days",
-        "df2_feature_view:blocked_days",
-        "df2_feature_view:occupancy_rate",
-        "df2_feature_view:reservation_days",
-        "df2_feature_view:adr_usd",
-        "df2_feature_view:number_of_reservation",
-        # "on_demand_rates:rate_blocked_days",
-        # "on_demand_rates:rate_available_days",
-        "df3_feature_view:num_neighbours",
-        "df3_feature_view:dist_from_bc",
-    ],
-)
+    # materialize_online_store can run in another thread on the same registry
+    with REGISTRY_LOCK:
+        fs.create_saved_dataset(
+            from_=training_df,
+            name="training_dataset",
+            allow_overwrite=True,
+            storage=SavedDatasetFileStorage(
+                path=os.path.join(
+                    os.path.dirname(__file__),
+                    "feature_store/feature_repo/data",
+                    "training_dataset.parquet",
+                )
+            ),
+            tags={"author": "fsxz"},
+        )
 
 
-dataset = fs.create_saved_dataset(
-    from_=training_df,
-    name="training_dataset",
-    allow_overwrite=True,
-    storage=SavedDatasetFileStorage(
-        path=os.path.join(
-            os.path.dirname(__file__),
-            "feature_store/feature_repo/data",
-            "training_dataset.parquet",
-        )
-    ),
-    tags={"author": "fsxz"},
-)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import sys
+import time
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import httpx
+
+from inference import get_customer_to_predict
+from utils.config import load_config
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log = logging.getLogger("LOAD_TEST")
+
+
+async def run_load_test(
+    client: httpx.AsyncClient,
+    ids: np.ndarray,
+    n_requests: int = 2000,
+    concurrency: int = 32,
+    ids_per_request: int = 1,
+    warmup: int = 100,
+) -> Tuple[pd.Series, float]:
+    """Send n_requests score requests, concurrency at a time, with random property ids.
+    The first warmup requests are not measured
+
+    Returns:
+        Tuple[pd.Series, float]: latency in ms of every request and total time in seconds
+    """
+    rng = np.random.default_rng(0)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one_request(latencies: List[float]) -> None:
+        payload = {
+            "airbnb_property_ids": rng.choice(ids, ids_per_request).tolist()
+        }
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/score", json=payload)
+            latencies.append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+
+    await asyncio.gather(*[one_request([]) for _ in range(warmup)])
+    start = time.perf_counter()
+    await asyncio.gather(*[one_request(latencies) for _ in range(n_requests)])
+    return pd.Series(latencies, name="latency_ms"), time.perf_counter() - start
+
+
+async def main(
+    url: Optional[str], n_requests: int, concurrency: int, ids_per_request: int
+) -> bool:
+    CONFIG = load_config()
+    ids = get_customer_to_predict()["airbnb_property_id"].unique()
+
+    if url:
+        async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+            latencies, elapsed = await run_load_test(
+                client, ids, n_requests, concurrency, ids_per_request
+            )
+    else:
+        # the service runs in this same process, no server needed
+        from scoring_service import create_app
+
+        app = create_app()
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://scoring", timeout=60
+            ) as client:
+                latencies, elapsed = await run_load_test(
+                    client, ids, n_requests, concurrency, ids_per_request
+                )
+
+    p50, p99 = latencies.quantile(0.5), latencies.quantile(0.99)
+    log.info(
+        f"{n_requests} requests in {elapsed:.2f}s ({n_requests / elapsed:.0f} req/s), "
+        f"p50 {p50:.1f}ms (target {CONFIG['SCORING_P50_TARGET_MS']}ms), "
+        f"p99 {p99:.1f}ms (target {CONFIG['SCORING_P99_TARGET_MS']}ms)"
+    )
+    return (
+        p50 <= CONFIG["SCORING_P50_TARGET_MS"]
+        and p99 <= CONFIG["SCORING_P99_TARGET_MS"]
+    )
+
+
+if __name__ == "__main__":
+    from cli import get_parser
+
+    args = get_parser("load-test").parse_args()
+
+    ok = asyncio.run(
+        main(args.url, args.requests, args.concurrency, args.ids_per_request)
+    )
+    sys.exit(0 if ok else 1)
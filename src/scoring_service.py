@@ -0,0 +1,257 @@
+import sys
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+import mlflow
+import uvicorn
+from fastapi import FastAPI
+from feast import FeatureStore
+from pydantic import BaseModel, Field
+from sklearn.pipeline import Pipeline
+
+from inference import get_feast_fs, get_model_cache_dir
+from utils.compiled_forest import CompiledForest
+from utils.config import load_config
+from utils.model_utils import TRACKING_URI, get_model_run_id, load_scoring_model
+from utils.registry import REGISTRY_LOCK
+from utils.schema import (
+    MODEL_DTYPE,
+    NULLABLE_FEATURES,
+    cast_to_schema,
+    get_feature_refs,
+    get_model_columns,
+)
+from utils.tracing import stage_span
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+log = logging.getLogger("SCORING")
+
+
+class ScoreRequest(BaseModel):
+    # an empty lookup is an error of the online store
+    airbnb_property_ids: List[int] = Field(min_length=1)
+
+
+class ScoreResponse(BaseModel):
+    airbnb_property_ids: List[int]
+    # None when the property has no features in the online store
+    churn_probability: List[Optional[float]]
+    model_run_id: str
+
+
+class ChurnScorer:
+    """Online features lookup and prediction with a model kept in memory"""
+
+    def __init__(
+        self, fs: FeatureStore, model: Union[Pipeline, CompiledForest], run_id: str
+    ):
+        self.fs = fs
+        self.model = model
+        self.run_id = run_id
+        self.features = get_feature_refs(
+            on_demand=load_config()["ONLINE_RATES"] == "on_demand"
+        )
+        self.columns = get_model_columns()
+        # the online store returns objects for the features missing in every row
+        self.dtypes = {c: MODEL_DTYPE for c in self.columns}
+        # properties without these are unknown to the online store
+        self.required = [c for c in self.columns if c not in NULLABLE_FEATURES]
+        # target is True when the property is still listed the next month
+        self.churn_class = list(model.classes_).index(False)
+
+    def score(self, ids: np.ndarray) -> np.ndarray:
+        """Churn probability of the properties, nan for the unknown ones"""
+        unique_ids, inverse = np.unique(ids, return_inverse=True)
+        features = self.fs.get_online_features(
+            features=self.features,
+            entity_rows=[{"airbnb_property_id": int(i)} for i in unique_ids],
+        ).to_df()
+
+        known = features[self.required].notna().all(axis=1).values
+        proba = np.full(len(unique_ids), np.nan)
+        if known.any():
+            proba[known] = self.model.predict_proba(features[known])[:, self.churn_class]
+        return proba[inverse]
+
+    def warm_up(self) -> None:
+        """A features lookup, that loads the registry, and a predict on the returned row with its
+        missing features set to zero: the model runs even when the id is unknown to the online store"""
+        features = self.fs.get_online_features(
+            features=self.features, entity_rows=[{"airbnb_property_id": 0}]
+        ).to_df()
+        self.model.predict_proba(cast_to_schema(features, self.dtypes).fillna(0))
+
+
+class MicroBatcher:
+    """Groups the requests arriving together, so that they share one features lookup and one predict call.
+    A batch is scored as soon as it has max_batch_size ids or max_wait_ms passed from its first request"""
+
+    def __init__(
+        self,
+        score_fn: Callable[[np.ndarray], np.ndarray],
+        max_batch_size: int = 256,
+        max_wait_ms: float = 5,
+    ):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        assert self.task is not None, "the batcher is not started"
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    async def submit(self, ids: List[int]) -> np.ndarray:
+        assert self.queue is not None, "the batcher is not started"
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((ids, future))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[List[int], asyncio.Future]]:
+        assert self.queue is not None
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            ids = np.concatenate([np.asarray(ids, dtype="int64") for ids, _ in batch])
+            try:
+                with stage_span("scoring.batch", requests=len(batch)) as span:
+                    span.rows = len(ids)
+                    # the event loop keeps accepting requests while the batch is scored
+                    scores = await loop.run_in_executor(None, self.score_fn, ids)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            start = 0
+            for request_ids, future in batch:
+                # the future is cancelled when the client went away
+                if not future.done():
+                    future.set_result(scores[start : start + len(request_ids)])
+                start += len(request_ids)
+
+
+def materialize_online_store(
+    fs: FeatureStore, end_date: Optional[datetime] = None
+) -> None:
+    """Load the latest features of every property in the online store (sqlite)"""
+    # the materialized intervals are recorded in the registry, shared with the other stages
+    with REGISTRY_LOCK:
+        fs.materialize(
+            start_date=datetime(1970, 1, 1, tzinfo=timezone.utc),
+            end_date=end_date or datetime.now(timezone.utc),
+        )
+
+
+def load_scorer(experiment_name: str = "test1") -> ChurnScorer:
+    """Champion model of the experiment and the feature store of the project"""
+    mlflow.set_tracking_uri(TRACKING_URI)
+    run_id = get_model_run_id(experiment_name)
+    # the compiled forest for the small batches of the service
+    model = load_scoring_model(
+        run_id, load_config()["SCORING_MAX_BATCH_SIZE"], cache_dir=get_model_cache_dir()
+    )
+    return ChurnScorer(get_feast_fs(), model, run_id)
+
+
+class ServiceState:
+    """Scorer and batcher of a running app, set by its lifespan"""
+
+    def __init__(self) -> None:
+        self.scorer: Optional[ChurnScorer] = None
+        self.batcher: Optional[MicroBatcher] = None
+
+    def get(self) -> Tuple[ChurnScorer, MicroBatcher]:
+        assert self.scorer is not None and self.batcher is not None, "the app is not started"
+        return self.scorer, self.batcher
+
+
+def create_app(
+    scorer: Optional[ChurnScorer] = None,
+    max_batch_size: Optional[int] = None,
+    max_wait_ms: Optional[float] = None,
+) -> FastAPI:
+    """Scoring service, the model and the feature store are loaded once at startup
+
+    Args:
+        scorer (Optional[ChurnScorer], optional): defaults to the best model of the experiment. Defaults to None.
+        max_batch_size (Optional[int], optional): defaults to SCORING_MAX_BATCH_SIZE in config.yaml.
+        max_wait_ms (Optional[float], optional): defaults to SCORING_MAX_WAIT_MS in config.yaml.
+    """
+    CONFIG = load_config()
+    state = ServiceState()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        loaded = scorer or load_scorer()
+        loaded.warm_up()
+        batcher = MicroBatcher(
+            loaded.score,
+            max_batch_size=max_batch_size or CONFIG["SCORING_MAX_BATCH_SIZE"],
+            max_wait_ms=max_wait_ms or CONFIG["SCORING_MAX_WAIT_MS"],
+        )
+        await batcher.start()
+        state.scorer, state.batcher = loaded, batcher
+        log.info(f"serving model {loaded.run_id}")
+        yield
+        await batcher.stop()
+
+    app = FastAPI(title="airbnb-bc scoring", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health() -> dict:
+        served, _ = state.get()
+        return {"status": "ok", "model_run_id": served.run_id}
+
+    @app.post("/score", response_model=ScoreResponse)
+    async def score(request: ScoreRequest) -> ScoreResponse:
+        served, batcher = state.get()
+        scores = await batcher.submit(request.airbnb_property_ids)
+        return ScoreResponse(
+            airbnb_property_ids=request.airbnb_property_ids,
+            churn_probability=[None if np.isnan(s) else float(s) for s in scores],
+            model_run_id=served.run_id,
+        )
+
+    return app
+
+
+if __name__ == "__main__":
+    from cli import get_parser
+
+    args = get_parser("serve").parse_args()
+
+    if args.materialize:
+        log.info("materializing the online store")
+        materialize_online_store(get_feast_fs())
+
+    uvicorn.run(create_app(), host=args.host, port=args.port)
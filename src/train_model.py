@@ -1,29 +1,175 @@
 import os
 import sys
+import json
+import time
 import warnings
 import tempfile
 import logging
 from datetime import datetime
+from typing import Any, Dict, List, Optional, Union
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.model_selection import GridSearchCV
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import GridSearchCV, HalvingGridSearchCV, ParameterGrid, check_cv
 from sklearn.pipeline import Pipeline
+from joblib import Memory, effective_n_jobs
+import numpy as np
 import pandas as pd
 import mlflow
+from mlflow.exceptions import MlflowException
+from mlflow.tracking import MlflowClient
+
+from utils.compiled_forest import CompiledForest
+from utils.config import load_config
+from utils.model_utils import (
+    COMPILED_ARTIFACT_PATH,
+    COMPILED_MODEL_FILE,
+    MODEL_ARTIFACT_PATH,
+    TRACKING_URI,
+    local_tracking_server,
+    set_champion,
+)
+from utils.feature_matrix import get_feature_matrix, get_fold_matrix
+from utils.schema import MODEL_DTYPE, get_model_columns
+from utils.tracing import log_records_to_mlflow, stage_span
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 log = logging.getLogger("TRAINING")
+CONFIG = load_config()
 
+SCORING = ["f1", "accuracy", "balanced_accuracy", "precision", "recall", "roc_auc"]
+CHECKPOINT_FILE = "checkpoint.csv"
 
-def mlflow_trainer(
+
+class PreprocessDF(BaseEstimator, TransformerMixin):
+    """First step of the pipeline, it selects the model columns in their order and with the model dtype.
+    It is a module level estimator so that the pipeline memory can clone and hash it
+    """
+
+    def __init__(self):
+
+        # ensure the order and needed columns
+        self.needed_columns = get_model_columns()
+
+    def fit(self, df, y=None):
+        """This function is required for sklearn Pipeline, but in our case, the fit methos isn't doing anything"""
+        return self
+
+    def transform(self, input_df):
+        if isinstance(input_df, np.ndarray):
+            # matrix from utils.feature_matrix, already with the needed columns: no copy
+            return np.asarray(input_df, dtype=MODEL_DTYPE)
+        # selecting the columns already creates a new frame, no need of a copy
+        return input_df[self.needed_columns].astype(MODEL_DTYPE)
+
+
+def _candidate_key(params: Dict[str, Any]) -> str:
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+def _get_interrupted_run(experiment_id: str) -> Optional[str]:
+    """Latest run of the experiment whose search did not finish"""
+    runs = MlflowClient().search_runs(
+        experiment_ids=[experiment_id],
+        filter_string="tags.search_status = 'running'",
+        order_by=["attributes.start_time DESC"],
+        max_results=1,
+    )
+    return runs[0].info.run_id if runs else None
+
+
+def _load_checkpoint(run_id: str) -> pd.DataFrame:
+    try:
+        path = mlflow.artifacts.download_artifacts(
+            run_id=run_id, artifact_path=f"cv_results/{CHECKPOINT_FILE}"
+        )
+    except (MlflowException, OSError):
+        return pd.DataFrame()
+    return pd.read_csv(path)
+
+
+def _log_candidates(results: pd.DataFrame, first_step: int) -> None:
+    """Metrics of every evaluated candidate, the step is the position of the candidate in the search"""
+    for step, (_, row) in enumerate(results.iterrows(), start=first_step):
+        for metric in ["mean_fit_time", "std_fit_time", "mean_score_time", "mean_test_f1"]:
+            if metric in row:
+                mlflow.log_metric(f"candidate_{metric}", row[metric], step=step)
+
+
+def _search_in_chunks(
     clf: GridSearchCV,
+    X: Union[pd.DataFrame, np.ndarray],
+    y: pd.Series,
+    results: pd.DataFrame,
+    tempdir: str,
+    budget_s: Optional[float] = None,
+) -> pd.DataFrame:
+    """Evaluate the candidates of the grid not yet in results, a chunk of candidates at a time.
+    After every chunk the results are saved in the run, so that an interrupted search can be resumed.
+    No chunk is started after budget_s seconds. A memory mapped X is laid out by fold, see get_fold_matrix
+
+    Returns:
+        pd.DataFrame: cv results of all the evaluated candidates, one row per candidate
+    """
+    done = set(results["candidate"]) if len(results) else set()
+    todo = [p for p in ParameterGrid(clf.param_grid) if _candidate_key(p) not in done]
+    if done:
+        log.info(f"resuming the search, {len(done)} candidates already evaluated")
+
+    cv = clf.cv
+    if isinstance(X, np.memmap):
+        # the folds are slices of one mapped file: the workers share it instead of copying their folds
+        folds = list(check_cv(clf.cv, y, classifier=True).split(X, y))
+        X, order, cv = get_fold_matrix(X, folds)
+        y = y.iloc[order]
+
+    # one candidate per worker, every chunk keeps all the workers busy with its folds
+    chunk_size = max(1, effective_n_jobs(clf.n_jobs))
+    start = time.perf_counter()
+    for i in range(0, len(todo), chunk_size):
+        if budget_s is not None and time.perf_counter() - start > budget_s:
+            log.info(
+                f"search budget of {budget_s}s exhausted, {len(todo) - i} candidates skipped"
+            )
+            break
+        chunk = clone(clf).set_params(
+            param_grid=[{k: [v] for k, v in p.items()} for p in todo[i : i + chunk_size]],
+            refit=False,
+            cv=cv,
+        )
+        chunk.fit(X, y)
+        chunk_results = pd.DataFrame(chunk.cv_results_).drop(
+            columns=[c for c in chunk.cv_results_ if c.startswith("rank_")]
+        )
+        chunk_results["candidate"] = [_candidate_key(p) for p in chunk.cv_results_["params"]]
+        _log_candidates(chunk_results, first_step=len(results))
+        results = pd.concat([results, chunk_results], ignore_index=True)
+
+        checkpoint = os.path.join(tempdir, CHECKPOINT_FILE)
+        results.to_csv(checkpoint, index=False)
+        mlflow.log_artifact(checkpoint, "cv_results")
+    return results
+
+
+def mlflow_trainer(
+    clf: Union[GridSearchCV, HalvingGridSearchCV],
     training_data: pd.DataFrame,
     target_col: str = "target",
     experiment_name: str = "airbnb-bc",
+    budget_s: Optional[float] = None,
+    resume: bool = False,
+    features: Optional[np.ndarray] = None,
 ) -> None:
-    """_summary_
+    """Hyperparameter search and fit of the best model, with metrics and artifacts logged in mlflow.
+    Grid searches are evaluated in chunks of candidates: they can be stopped after budget_s seconds
+    and resumed by a later call with resume=True. Halving searches stop early the bad candidates by themselves
 
     Args:
-        clf (GridSearchCV[Pipeline]): model created from create_model function. Is should be ready to fit
+        clf (Union[GridSearchCV, HalvingGridSearchCV]): search created from create_model function. It should be ready to fit
+        budget_s (Optional[float], optional): wall clock budget of a grid search in seconds. Defaults to None.
+        resume (bool, optional): continue the last interrupted search of the experiment. Defaults to False.
+        features (Optional[np.ndarray], optional): input matrix of the model (see utils.feature_matrix),
+            training_data then needs only the target. Defaults to None, the model reads training_data.
     """
     existing_exp = mlflow.get_experiment_by_name(experiment_name)
 
@@ -32,117 +178,183 @@ def mlflow_trainer(
     else:
         experiment_id = existing_exp.experiment_id
 
+    run_id = _get_interrupted_run(experiment_id) if resume else None
     timestamp = datetime.now().isoformat().split(".")[0].replace(":", ".")
-    with mlflow.start_run(experiment_id=experiment_id, run_name=timestamp) as run:
-        clf.fit(training_data, training_data[target_col])
-        cv_results = clf.cv_results_
-        best_index = clf.best_index_
-        for score_name in [score for score in cv_results if "mean_test" in score]:
-            mlflow.log_metric(score_name, cv_results[score_name][best_index])
+    with mlflow.start_run(
+        experiment_id=experiment_id,
+        run_id=run_id,
+        run_name=None if run_id else timestamp,
+    ) as run:
+        mlflow.set_tag("search_status", "running")
+        tempdir = tempfile.mkdtemp()
+        X = training_data if features is None else features
+        y = training_data[target_col]
+
+        if isinstance(clf, GridSearchCV):
+            results = _load_checkpoint(run_id) if run_id else pd.DataFrame()
+            with stage_span("train.search") as search:
+                search.rows = len(y)
+                results = _search_in_chunks(clf, X, y, results, tempdir, budget_s)
+            complete = len(results) == len(ParameterGrid(clf.param_grid))
+            if results.empty:
+                raise RuntimeError("no candidate evaluated within the search budget")
+            best = results.iloc[results[f"mean_test_{clf.refit}"].idxmax()]
+
+            start = time.perf_counter()
+            best_estimator = clone(clf.estimator).set_params(**json.loads(best["candidate"]))
+            with stage_span("train.fit") as fit:
+                fit.rows = len(y)
+                best_estimator.fit(X, y)
+            mlflow.log_metric("refit_time", time.perf_counter() - start)
+            log_records_to_mlflow([search.record, fit.record])
+        else:
+            if budget_s is not None:
+                log.warning("the budget applies only to grid searches, it is ignored")
+            # the refit of the best candidate is part of the search
+            with stage_span("train.search") as search:
+                search.rows = len(y)
+                clf.fit(X, y)
+            log_records_to_mlflow([search.record])
+            complete = True
+            # the single metric of halving is f1
+            results = pd.DataFrame(clf.cv_results_).rename(
+                columns=lambda c: c.replace("test_score", "test_f1")
+            )
+            results["candidate"] = [_candidate_key(p) for p in clf.cv_results_["params"]]
+            _log_candidates(results, first_step=0)
+            best = results.iloc[clf.best_index_]
+            best_estimator = clf.best_estimator_
+            mlflow.log_metric("refit_time", clf.refit_time_)
+
+        for score_name in [score for score in results if "mean_test" in score]:
+            mlflow.log_metric(score_name, best[score_name])
             mlflow.log_metric(
                 score_name.replace("mean", "std"),
-                cv_results[score_name.replace("mean", "std")][best_index],
+                best[score_name.replace("mean", "std")],
             )
+        # a tag, params cannot change when a resumed search finds a better candidate
+        mlflow.set_tag("best_params", best["candidate"])
+        mlflow.log_metric("n_candidates", len(results))
 
-        tempdir = tempfile.TemporaryDirectory().name
-        os.mkdir(tempdir)
         filename = "%s-%s-cv_results.csv" % ("RandomForest", timestamp)
         csv = os.path.join(tempdir, filename)
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            pd.DataFrame(cv_results).to_csv(csv, index=False)
+            results.to_csv(csv, index=False)
 
         mlflow.log_artifact(csv, "cv_results")
-        mlflow.sklearn.log_model(clf.best_estimator_, "sk_models")
+        mlflow.sklearn.log_model(best_estimator, MODEL_ARTIFACT_PATH)
 
+        # same predictions of the pipeline, faster to load and to evaluate
+        compiled = os.path.join(tempdir, COMPILED_MODEL_FILE)
+        CompiledForest.from_pipeline(best_estimator).save(compiled)
+        mlflow.log_artifact(compiled, COMPILED_ARTIFACT_PATH)
+        # a search stopped by the budget can be resumed later
+        mlflow.set_tag("search_status", "finished" if complete else "running")
 
-def create_model() -> GridSearchCV:
+
+def create_model(
+    search: str = "grid",
+    search_params: Optional[Dict[str, List[Any]]] = None,
+    n_jobs: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+) -> Union[GridSearchCV, HalvingGridSearchCV]:
     """Creates a basic ml pipeline with column selection and cross validation
 
+    Args:
+        search (str, optional): "grid" for an exhaustive search, "halving" for successive halving. Defaults to "grid".
+        search_params (Optional[Dict[str, List[Any]]], optional): search space, defaults to SEARCH_SPACE in config.yaml.
+        n_jobs (Optional[int], optional): parallel fits of folds and candidates, defaults to SEARCH_N_JOBS in config.yaml.
+        cache_dir (Optional[str], optional): joblib cache of the preprocessing step, shared by folds and candidates.
+            Only for DataFrame inputs: a memory mapped matrix needs no preprocessing, and hashing it would read
+            the whole file for every fit. Defaults to None.
+
     Returns:
-        GridSearchCV: object ready to fit
+        Union[GridSearchCV, HalvingGridSearchCV]: object ready to fit
     """
-
-    class PreprocessDF:
-        def __init__(self):
-
-            # ensure the order and needed columns
-            self.needed_columns = [
-                "bedrooms",
-                "bathrooms",
-                "cleaning_fee",
-                "available_days",
-                "blocked_days",
-                "occupancy_rate",
-                "reservation_days",
-                "adr_usd",
-                "number_of_reservation",
-                "num_neighbours",
-                "dist_from_bc",
-            ]
-
-        def fit(self, df, y=None):
-            """This function is required for sklearn Pipeline, but in our case, the fit methos isn't doing anything"""
-            return self
-
-        def transform(self, input_df):
-            df = input_df.copy()  # creating a copy to avoid changes to original dataset
-            return df[self.needed_columns].astype("float32")
-
     # it guarantees that model and preprocessing needed are always togheter
     model = Pipeline(
-        steps=[("preprocess", PreprocessDF()), ("classifier", RandomForestClassifier())]
+        steps=[("preprocess", PreprocessDF()), ("classifier", RandomForestClassifier())],
+        memory=Memory(cache_dir, verbose=0) if cache_dir else None,
     )
 
-    search_params = {
-        "classifier__criterion": ["gini"],
-        "classifier__max_depth": [20, 30],
-        "classifier__n_estimators": [10, 80],
-    }
+    search_params = search_params or CONFIG["SEARCH_SPACE"]
+    n_jobs = n_jobs if n_jobs is not None else CONFIG["SEARCH_N_JOBS"]
+    if search == "halving":
+        # candidates are trained on a growing share of the rows, only the best third goes on
+        # at every round. Halving supports a single metric
+        return HalvingGridSearchCV(
+            model,
+            search_params,
+            scoring="f1",
+            factor=3,
+            cv=3,
+            n_jobs=n_jobs,
+            random_state=0,
+        )
+
     # best model with f1, other metrics are only monitored
     cv_clf = GridSearchCV(
         model,
         search_params,
-        scoring=[
-            "f1",
-            "accuracy",
-            "balanced_accuracy",
-            "precision",
-            "recall",
-            "roc_auc",
-        ],
+        scoring=SCORING,
         refit="f1",
         cv=3,
+        n_jobs=n_jobs,
     )
     return cv_clf
 
 
-if __name__ == "__main__":
-
+def main(
+    search: Optional[str] = None,
+    budget_s: Optional[float] = None,
+    resume: bool = False,
+) -> None:
     log.info("reading training data")
-    training_df = pd.read_parquet(
-        os.path.join(
-            os.path.dirname(__file__),
-            "feature_store/feature_repo/data/training_dataset.parquet",
-        )
+    training_path = os.path.join(
+        os.path.dirname(__file__),
+        "feature_store/feature_repo/data/training_dataset.parquet",
     )
+    search = search or CONFIG["SEARCH_MODE"]
+    if search == "halving":
+        # halving subsamples the rows at every round, the folds are copied anyway: the frame is read
+        # and its preprocessing is cached across candidates
+        features = None
+        training_df = pd.read_parquet(training_path, columns=get_model_columns() + ["target"])
+        cache_dir = os.path.join(os.path.dirname(__file__), CONFIG["PIPELINE_CACHE_DIR"])
+    else:
+        # the features are mapped from disk and shared with the workers, only the target is loaded.
+        # The matrix is already preprocessed, there is nothing to cache
+        features = get_feature_matrix(
+            training_path,
+            get_model_columns(),
+            os.path.join(os.path.dirname(__file__), CONFIG["MATRIX_CACHE_DIR"]),
+        )
+        training_df = pd.read_parquet(training_path, columns=["target"])
+        cache_dir = None
 
     log.info("training the model")
-    import subprocess
-
-    subprocess.call("mlflow ui --host 0.0.0.0 --port 5000 --workers 1 &", shell=True)
-
-    cv_model = create_model()
+    cv_model = create_model(search=search, cache_dir=cache_dir)
 
-    # default url for local mlflow
-    mlflow.set_tracking_uri("http://127.0.0.1:5000")
+    mlflow.set_tracking_uri(TRACKING_URI)
 
     mlflow_trainer(
         cv_model,
         training_data=training_df,
         target_col="target",
         experiment_name="test1",
+        budget_s=budget_s,
+        resume=resume,
+        features=features,
     )
+    # inference and scoring load the model with this alias
+    set_champion("test1")
     log.info("training completed!")
 
-    # subprocess.call("kill $(lsof -t -i:5000)", shell=True)
+
+if __name__ == "__main__":
+    from cli import get_parser
+
+    args = get_parser("train").parse_args()
+    with local_tracking_server():
+        main(args.search, args.budget_s, args.resume)
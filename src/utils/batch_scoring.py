@@ -0,0 +1,149 @@
+import os
+import time
+import shutil
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from utils.compiled_forest import CompiledForest
+from utils.schema import MODEL_DTYPE
+from utils.tracing import stage_span
+
+KEY_COLUMNS = ["airbnb_property_id", "event_timestamp"]
+PARTITION_COLS = ["model_run_id", "month"]
+
+# state of a worker process, the model is loaded once by _init_worker
+_worker: Dict[str, Any] = {}
+
+
+class BatchScoringReport(NamedTuple):
+    rows: int
+    # rows whose most likely class is the churn
+    churned: int
+    wall_s: float
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.rows / self.wall_s if self.wall_s else 0.0
+
+
+def get_input_columns(model: Any) -> List[str]:
+    """Input columns of a compiled forest or of a fitted pipeline, in order"""
+    if isinstance(model, CompiledForest):
+        return list(model.columns)
+    return list(model[0].needed_columns)
+
+
+def _init_worker(
+    load_fn: Callable[..., Any], run_id: str, cache_dir: Optional[str], out_dir: str
+) -> None:
+    model = load_fn(run_id, cache_dir=cache_dir)
+    _worker.update(
+        model=model,
+        run_id=run_id,
+        out_dir=out_dir,
+        columns=get_input_columns(model),
+        # target is True when the property is still listed
+        churn_class=list(model.classes_).index(False),
+    )
+
+
+def _score_batch(index: int, batch: pa.RecordBatch) -> Tuple[int, int]:
+    """Score a batch in a worker and append its predictions to the dataset
+
+    Returns:
+        Tuple[int, int]: rows of the batch and rows predicted to churn
+    """
+    model, columns = _worker["model"], _worker["columns"]
+    # nulls become nan, as in get_feature_matrix
+    X = np.column_stack(
+        [
+            pc.cast(batch.column(c), pa.float32(), safe=False).to_numpy(zero_copy_only=False)
+            for c in columns
+        ]
+    ).astype(MODEL_DTYPE, copy=False)
+    if not isinstance(model, CompiledForest):
+        X = pd.DataFrame(X, columns=columns)
+    proba = model.predict_proba(X)
+
+    timestamps = batch.column("event_timestamp").to_pandas()
+    predictions = pd.DataFrame(
+        {
+            "airbnb_property_id": batch.column("airbnb_property_id").to_numpy(),
+            "event_timestamp": timestamps,
+            "churn_probability": proba[:, _worker["churn_class"]],
+            "model_run_id": _worker["run_id"],
+            "month": timestamps.dt.strftime("%Y-%m"),
+        }
+    )
+    predictions.to_parquet(
+        _worker["out_dir"],
+        partition_cols=PARTITION_COLS,
+        index=False,
+        # every batch writes its own files, the workers never overwrite each other
+        basename_template=f"batch-{index:08d}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return len(predictions), int((proba.argmax(axis=1) == _worker["churn_class"]).sum())
+
+
+def score_dataset(
+    path: str,
+    out_dir: str,
+    run_id: str,
+    load_fn: Callable[..., Any],
+    cache_dir: Optional[str] = None,
+    batch_rows: int = 1 << 16,
+    max_workers: Optional[int] = None,
+) -> BatchScoringReport:
+    """Churn probability of every row of a features dataset, written to a parquet dataset partitioned by
+    model run id and month. The dataset is streamed in record batches of at most batch_rows rows, scored by
+    a pool of processes that load the model once, and every worker appends the predictions of its batches.
+    At most two batches per worker are in flight, so the memory does not depend on the size of the dataset
+
+    Args:
+        path (str): parquet file or dataset with 'airbnb_property_id', 'event_timestamp' and the model columns
+        out_dir (str): root of the predictions dataset, the previous predictions of the model are replaced
+        run_id (str): mlflow run id of the model
+        load_fn (Callable[..., Any]): model loader of utils.model_utils, called with run_id and cache_dir
+        cache_dir (Optional[str], optional): model cache of load_fn. Defaults to None.
+        batch_rows (int, optional): rows of the record batches. Defaults to 65536.
+        max_workers (Optional[int], optional): defaults to the number of cpus.
+
+    Returns:
+        BatchScoringReport: rows scored, rows predicted to churn and wall time
+    """
+    # the model is downloaded here once, the workers load it from the cache
+    columns = get_input_columns(load_fn(run_id, cache_dir=cache_dir))
+    shutil.rmtree(os.path.join(out_dir, f"model_run_id={run_id}"), ignore_errors=True)
+    batches = ds.dataset(path, format="parquet").to_batches(
+        columns=KEY_COLUMNS + columns, batch_size=batch_rows
+    )
+
+    max_workers = max_workers or os.cpu_count()
+    pending: Deque[Future] = deque()
+    counts: List[Tuple[int, int]] = []
+    start = time.perf_counter()
+    # spawned workers: main can run in a thread of the pipeline, forking a threaded process is unsafe
+    with stage_span("inference.batch_scoring") as span, ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(load_fn, run_id, cache_dir, out_dir),
+    ) as pool:
+        for index, batch in enumerate(batches):
+            if len(pending) >= 2 * max_workers:
+                counts.append(pending.popleft().result())
+            pending.append(pool.submit(_score_batch, index, batch))
+        counts += [future.result() for future in pending]
+        span.rows = sum(rows for rows, _ in counts)
+    return BatchScoringReport(
+        span.rows, sum(churned for _, churned in counts), time.perf_counter() - start
+    )
@@ -0,0 +1,24 @@
+import os
+from functools import lru_cache
+from typing import Any, Dict
+
+import yaml
+
+CONFIG_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, "config.yaml"
+)
+
+
+@lru_cache(maxsize=None)
+def load_config(path: str = CONFIG_PATH) -> Dict[str, Any]:
+    """Settings of the project, the file is parsed once per process.
+    All the callers share the returned dict, it must not be modified
+
+    Args:
+        path (str, optional): yaml file. Defaults to the config.yaml of the project.
+
+    Returns:
+        Dict[str, Any]: the settings
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f)
@@ -0,0 +1,121 @@
+import os
+import glob
+import hashlib
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from utils.schema import MODEL_DTYPE
+from utils.tracing import stage_span
+
+
+def dataset_hash(path: str) -> str:
+    """Hash of the content of a parquet file, or of all the files of a dataset directory"""
+    files = (
+        sorted(glob.glob(os.path.join(path, "**", "*.parquet"), recursive=True))
+        if os.path.isdir(path)
+        else [path]
+    )
+    digest = hashlib.sha256()
+    for file in files:
+        digest.update(os.path.relpath(file, path).encode())
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def get_feature_matrix(path: str, columns: List[str], cache_dir: str) -> np.ndarray:
+    """Columns of a parquet dataset as a read only float32 matrix, memory mapped from a .npy file in cache_dir.
+    The matrix is column-major (the layout used by the tree splitter) and it is built one column at a time,
+    so the whole table is never in memory. The file is keyed by the hash of the data and the column list,
+    later calls and the joblib workers map the same file without copying it
+
+    Args:
+        path (str): parquet file or dataset directory
+        columns (List[str]): columns of the matrix, in order
+        cache_dir (str): directory of the .npy files
+
+    Returns:
+        np.ndarray: memory mapped (rows, columns) matrix
+    """
+    columns_hash = hashlib.sha256("\x00".join(columns).encode()).hexdigest()
+    matrix_path = os.path.join(
+        cache_dir, f"{dataset_hash(path)[:16]}-{columns_hash[:8]}.npy"
+    )
+    with stage_span("feature_matrix", cached=os.path.exists(matrix_path)) as span:
+        if not os.path.exists(matrix_path):
+            os.makedirs(cache_dir, exist_ok=True)
+            dataset = pq.ParquetDataset(path)
+            n_rows = sum(fragment.count_rows() for fragment in dataset.fragments)
+            tmp_path = f"{matrix_path}.{os.getpid()}.tmp"
+            matrix = np.lib.format.open_memmap(
+                tmp_path,
+                mode="w+",
+                dtype=MODEL_DTYPE,
+                shape=(n_rows, len(columns)),
+                fortran_order=True,
+            )
+            for j, column in enumerate(columns):
+                values = dataset.read([column]).column(0)
+                # nulls become nan, as with pandas astype
+                matrix[:, j] = pc.cast(values, pa.float32(), safe=False).to_numpy(
+                    zero_copy_only=False
+                )
+            matrix.flush()
+            del matrix
+            os.replace(tmp_path, matrix_path)
+        matrix = np.load(matrix_path, mmap_mode="r")
+        span.rows = len(matrix)
+    return matrix
+
+
+def get_fold_matrix(
+    matrix: np.memmap, folds: Sequence[Tuple[np.ndarray, np.ndarray]]
+) -> Tuple[np.ndarray, np.ndarray, List[Tuple[slice, slice]]]:
+    """Rows of a memory mapped matrix laid out so that the training and test rows of every fold
+    are contiguous, then the folds are views of the same file and the cross validation workers
+    never copy them. The test blocks are written in order, followed by all of them but the last
+    again: the training rows of every fold are the blocks after its test block. The file, next to
+    the matrix, holds (2K - 1) / K times its rows with K folds and it is built one column at a time
+
+    Args:
+        matrix (np.memmap): matrix returned by get_feature_matrix
+        folds (Sequence[Tuple[np.ndarray, np.ndarray]]): (train, test) row indices of every fold, as
+            returned by the split of a cross validator. The test sets are a partition of the rows
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, List[Tuple[slice, slice]]]: memory mapped matrix, row of matrix
+            of every of its rows (to lay out the target the same way) and (train, test) slices of the folds
+    """
+    blocks = [np.asarray(test, dtype=np.intp) for _, test in folds]
+    order = np.concatenate(blocks + blocks[:-1])
+    starts = np.concatenate([[0], np.cumsum([len(b) for b in blocks + blocks[:-1]])])
+    splits = [
+        (slice(starts[k + 1], starts[k + len(blocks)]), slice(starts[k], starts[k + 1]))
+        for k in range(len(blocks))
+    ]
+
+    order_hash = hashlib.sha256(order.tobytes()).hexdigest()[:8]
+    fold_path = matrix.filename.replace(".npy", f"-folds{len(blocks)}-{order_hash}.npy")
+    with stage_span("fold_matrix", cached=os.path.exists(fold_path)) as span:
+        if not os.path.exists(fold_path):
+            tmp_path = f"{fold_path}.{os.getpid()}.tmp"
+            layout = np.lib.format.open_memmap(
+                tmp_path,
+                mode="w+",
+                dtype=matrix.dtype,
+                shape=(len(order), matrix.shape[1]),
+                fortran_order=True,
+            )
+            for j in range(matrix.shape[1]):
+                layout[:, j] = matrix[:, j][order]
+            layout.flush()
+            del layout
+            os.replace(tmp_path, fold_path)
+        layout = np.load(fold_path, mmap_mode="r")
+        span.rows = len(layout)
+    return layout, order, splits
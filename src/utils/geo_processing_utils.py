@@ -1,6 +1,8 @@
 import math
-from typing import Mapping, Tuple, Optional
+from typing import Mapping, Tuple, Optional, Sequence
 import numpy as np
+from numpy.typing import ArrayLike
+from scipy.spatial import cKDTree
 
 import pandas as pd
 
@@ -9,64 +11,336 @@ def euclidean_distance(p1: Mapping[int, float], p2: Mapping[int, float]) -> floa
     return math.sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2)
 
 
-def convert_to_cartesian(lat: float, lon: float) -> Tuple[float, float]:
+# np.cos and np.sin can differ from math.cos and math.sin in the last bits, moving the distances by
+# about 1e-12 km: the pairs closer than this to the radius are decided with the math conversion
+BOUNDARY_TOL_KM = 1e-9
+
+
+def convert_to_cartesian(lat: ArrayLike, lon: ArrayLike) -> Tuple[ArrayLike, ArrayLike]:
+    """Works both with single coordinates and with whole arrays of coordinates"""
     R = 6371  # Radius of the Earth in kilometers
-    x = R * math.cos(math.radians(lat)) * math.cos(math.radians(lon))
-    y = R * math.cos(math.radians(lat)) * math.sin(math.radians(lon))
+    lat, lon = np.radians(lat), np.radians(lon)
+    x = R * np.cos(lat) * np.cos(lon)
+    y = R * np.cos(lat) * np.sin(lon)
     return (x, y)
 
 
+def _exact_cartesian(latlon: np.ndarray) -> np.ndarray:
+    """(n, 2) coordinates of the scalar conversion with the math module, for the few points at the boundary"""
+    R = 6371
+    return np.array(
+        [
+            (
+                R * math.cos(math.radians(lat)) * math.cos(math.radians(lon)),
+                R * math.cos(math.radians(lat)) * math.sin(math.radians(lon)),
+            )
+            for lat, lon in latlon
+        ],
+        dtype="float64",
+    ).reshape(-1, 2)
+
+
+def _within_radius(
+    p1: np.ndarray,
+    p2: np.ndarray,
+    radius: float,
+    latlon1: Optional[np.ndarray] = None,
+    latlon2: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Boolean mask of the pairs of points closer than radius. With the (latitude, longitude) of the points
+    the pairs at the boundary get the result of the math conversion, as in euclidean_distance"""
+    dist = _distances(p1, p2)
+    close = dist < radius
+    if latlon1 is not None:
+        near = np.abs(dist - radius) <= BOUNDARY_TOL_KM
+        if near.any():
+            close[near] = (
+                _distances(_exact_cartesian(latlon1[near]), _exact_cartesian(latlon2[near])) < radius
+            )
+    return close
+
+
+def get_geo_df(
+    df: pd.DataFrame, GEO_ID: Optional[str] = "GEO_ID", group_col: Optional[str] = None
+) -> pd.DataFrame:
+    """Deduplicate the locations of the properties and convert them to cartesian coordinates
+
+    Args:
+        df (pd.DataFrame): input Dataframe with coordinates 'latitude' and 'longitude' to provide as float nums
+        group_col (Optional[str], optional): column identifying the market of the property. Defaults to None.
+
+    Returns:
+        pd.DataFrame: one row per property location, with the cartesian coordinates in columns 'x' and 'y'
+    """
+    cols = [GEO_ID, "latitude", "longitude"] + ([group_col] if group_col else [])
+    geo_df = df[cols].drop_duplicates(subset=[GEO_ID, "latitude", "longitude"])
+    # one single pass over the whole arrays, whatever the number of markets
+    geo_df["x"], geo_df["y"] = convert_to_cartesian(
+        geo_df["latitude"].values, geo_df["longitude"].values
+    )
+    return geo_df
+
+
+def dist_from_bc(
+    coords: np.ndarray, groups: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Compute the distance in km of every point from the barycenter of its group
+
+    Args:
+        coords (np.ndarray): (n, 2) array of cartesian coordinates in km
+        groups (Optional[np.ndarray], optional): (n,) array with the group of every point. Defaults to None (one single group).
+
+    Returns:
+        np.ndarray: (n,) float64 array of distances
+    """
+    if groups is None:
+        groups = np.zeros(len(coords), dtype="int64")
+    # we assume earth is locally flat, so that the barycenter is just the mean of the coordinates
+    barycenters = pd.DataFrame(coords).groupby(groups).transform("mean").values
+    return np.sqrt(
+        (coords[:, 0] - barycenters[:, 0]) ** 2
+        + (coords[:, 1] - barycenters[:, 1]) ** 2
+    )
+
+
 def get_dist_from_bc(
-    df: pd.DataFrame, GEO_ID: Optional[str] = "GEO_ID"
+    df: pd.DataFrame, GEO_ID: Optional[str] = "GEO_ID", group_col: Optional[str] = None
 ) -> pd.DataFrame:
     """Add column 'dist_from_bc' as the distance in km between the property and the baricenter
 
     Args:
         df (pd.DataFrame): input Dataframe with coordinates 'latitude' and 'longitude' to provide as float nums
+        group_col (Optional[str], optional): column identifying the market, every market gets its own barycenter. Defaults to None.
 
     Returns:
         pd.DataFrame: equal to input with the addition of the column 'dist_from_bc'
     """
+    return get_geo_features(df, GEO_ID, group_col=group_col, features=["dist_from_bc"])
+
+
+def count_neighbours(
+    coords: np.ndarray, radius: float = 0.1, latlon: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Count, for every point, the other points closer than radius
 
-    # Function to convert latitude and longitude to Cartesian coordinates
+    Args:
+        coords (np.ndarray): (n, 2) array of unique cartesian coordinates in km
+        radius (float, optional): strict upper bound for the distance in km. Defaults to 0.1.
+        latlon (Optional[np.ndarray], optional): (n, 2) latitude and longitude of the points, to decide
+            the pairs at the boundary as the math conversion. Defaults to None.
 
-    geo_df = df[[GEO_ID, "latitude", "longitude"]].drop_duplicates()
-    geo_df["cartesian_coordinates"] = [
-        convert_to_cartesian(*a) for a in zip(geo_df["latitude"], geo_df["longitude"])
+    Returns:
+        np.ndarray: (n,) int64 array with the number of neighbours of every point
+    """
+    tree = cKDTree(coords)
+    # the tree works with <= and its own rounding: the candidate pairs found with a
+    # slightly larger radius are filtered with the same formula of euclidean_distance
+    pairs = tree.query_pairs(r=radius * (1 + 1e-9) + BOUNDARY_TOL_KM, output_type="ndarray")
+    latlon1, latlon2 = (None, None) if latlon is None else (latlon[pairs[:, 0]], latlon[pairs[:, 1]])
+    pairs = pairs[
+        _within_radius(coords[pairs[:, 0]], coords[pairs[:, 1]], radius, latlon1, latlon2)
     ]
-    # we assume earth is locally flat
-    barycenter = np.mean(np.vstack(geo_df.cartesian_coordinates.values), axis=0)
-    geo_df["dist_from_bc"] = geo_df["cartesian_coordinates"].map(
-        lambda x: euclidean_distance(barycenter, x)
+
+    # every pair is a neighbour for both its points
+    return np.bincount(pairs.ravel(), minlength=len(coords)).astype("int64")
+
+
+def _distances(p1: np.ndarray, p2: np.ndarray) -> np.ndarray:
+    """Row-wise version of euclidean_distance, with the very same floating point operations"""
+    return np.sqrt((p2[:, 0] - p1[:, 0]) ** 2 + (p2[:, 1] - p1[:, 1]) ** 2)
+
+
+def _grid_cells(coords: np.ndarray, cell_size: float) -> np.ndarray:
+    """(n, 2) integer indices of the cells of a uniform grid containing the points"""
+    return np.floor(coords / cell_size).astype("int64")
+
+
+def _cell_keys(cells: np.ndarray) -> np.ndarray:
+    # cartesian coordinates are bounded by the radius of the earth, 2**31 cells per axis are plenty
+    return (cells[:, 0] << 32) + cells[:, 1]
+
+
+def add_neighbours(
+    coords: np.ndarray,
+    counts: np.ndarray,
+    new_coords: np.ndarray,
+    radius: float = 0.1,
+    latlon: Optional[np.ndarray] = None,
+    new_latlon: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Add new points to a set of unique points with known neighbour counts.
+    Points are bucketed in a uniform grid with cells as large as the radius, so that only the
+    counts of the points in the 3x3 cells around a new point are updated
+
+    Args:
+        coords (np.ndarray): (n, 2) array of unique cartesian coordinates already counted
+        counts (np.ndarray): (n,) neighbour counts of coords, as returned by count_neighbours
+        new_coords (np.ndarray): (m, 2) array of cartesian coordinates to add, duplicates and already known points are ignored
+        radius (float, optional): strict upper bound for the distance in km. Defaults to 0.1.
+        latlon (Optional[np.ndarray], optional): latitude and longitude of coords, see count_neighbours. Defaults to None.
+        new_latlon (Optional[np.ndarray], optional): latitude and longitude of new_coords. Defaults to None.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: updated unique coordinates (the old ones first, in the same order) and their counts
+    """
+    exact = latlon is not None and new_latlon is not None
+    new_coords, first = np.unique(new_coords, axis=0, return_index=True)
+    new_latlon = new_latlon[first] if exact else None
+    known = pd.MultiIndex.from_arrays([coords[:, 0], coords[:, 1]])
+    unknown = (
+        known.get_indexer(pd.MultiIndex.from_arrays([new_coords[:, 0], new_coords[:, 1]])) == -1
+    )
+    new_coords = new_coords[unknown]
+    new_latlon = new_latlon[unknown] if exact else None
+    # neighbours among the new points themselves
+    new_counts = (
+        count_neighbours(new_coords, radius, new_latlon)
+        if len(new_coords)
+        else np.zeros(0, "int64")
     )
+    counts = counts.astype("int64")  # copy, the input is left untouched
 
-    # hardcoding variables (key) is not the best, but in this case we would just get a less readable code
-    return pd.merge(df, geo_df[[GEO_ID, "dist_from_bc"]], on=GEO_ID, how="left")
+    if len(coords) and len(new_coords):
+        keys = _cell_keys(_grid_cells(coords, radius))
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        new_cells = _grid_cells(new_coords, radius)
+
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                cell_keys = _cell_keys(new_cells + [dx, dy])
+                lo = np.searchsorted(sorted_keys, cell_keys, side="left")
+                lengths = np.searchsorted(sorted_keys, cell_keys, side="right") - lo
+                # expand the [lo, hi) ranges into (new point, old point) candidate pairs
+                new_idx = np.repeat(np.arange(len(new_coords)), lengths)
+                offsets = np.arange(lengths.sum()) - np.repeat(
+                    np.cumsum(lengths) - lengths, lengths
+                )
+                old_idx = order[np.repeat(lo, lengths) + offsets]
+
+                close = _within_radius(
+                    coords[old_idx],
+                    new_coords[new_idx],
+                    radius,
+                    latlon[old_idx] if exact else None,
+                    new_latlon[new_idx] if exact else None,
+                )
+                counts += np.bincount(old_idx[close], minlength=len(coords))
+                new_counts += np.bincount(new_idx[close], minlength=len(new_coords))
+
+    return np.vstack([coords, new_coords]), np.concatenate([counts, new_counts])
 
 
 def get_num_neighbours(
-    df: pd.DataFrame, GEO_ID: Optional[str] = "GEO_ID"
+    df: pd.DataFrame, GEO_ID: Optional[str] = "GEO_ID", radius: float = 0.1
 ) -> pd.DataFrame:
-    """Add column 'num_neighbours' as the number of neighbours in the radius of 0.1 km
+    """Add column 'num_neighbours' as the number of neighbours in the radius of `radius` km
 
     Args:
         df (pd.DataFrame): input Dataframe with coordinates 'latitude' and 'longitude' to provide as float nums
+        radius (float, optional): radius in km of the neighbourhood. Defaults to 0.1.
 
     Returns:
         pd.DataFrame: equal to input with the addition of the column 'num_neighbours'
     """
+    return get_geo_features(df, GEO_ID, radius=radius, features=["num_neighbours"])
 
-    geo_df = df[[GEO_ID, "latitude", "longitude"]].drop_duplicates()
-    geo_df["cartesian_coordinates"] = [
-        convert_to_cartesian(*a) for a in zip(geo_df["latitude"], geo_df["longitude"])
-    ]
-    coord_set = np.vstack(geo_df["cartesian_coordinates"].drop_duplicates().values)
-    geo_df["num_neighbours"] = geo_df["cartesian_coordinates"].apply(
-        lambda x: len(
-            [d for d in [euclidean_distance(x, cs) for cs in coord_set] if d < 0.1]
+
+def get_geo_features(
+    df: pd.DataFrame,
+    GEO_ID: Optional[str] = "GEO_ID",
+    radius: float = 0.1,
+    group_col: Optional[str] = None,
+    features: Sequence[str] = ("num_neighbours", "dist_from_bc"),
+) -> pd.DataFrame:
+    """Add the geographical features 'num_neighbours' and 'dist_from_bc' sharing the same cartesian coordinates
+
+    Args:
+        df (pd.DataFrame): input Dataframe with coordinates 'latitude' and 'longitude' to provide as float nums
+        radius (float, optional): radius in km of the neighbourhood. Defaults to 0.1.
+        group_col (Optional[str], optional): column identifying the market, every market gets its own barycenter. Defaults to None.
+        features (Sequence[str], optional): features to compute. Defaults to both.
+
+    Returns:
+        pd.DataFrame: equal to input with the addition of the requested features
+    """
+    geo_df = get_geo_df(df, GEO_ID, group_col)
+    coords = geo_df[["x", "y"]].values
+
+    if "num_neighbours" in features:
+        # properties sharing the same location are counted once, as a single point.
+        # Neighbours are searched across markets: far away points are never in the radius
+        coord_set, first, inverse = np.unique(
+            coords, axis=0, return_index=True, return_inverse=True
         )
-        - 1
-    )
+        latlon = geo_df[["latitude", "longitude"]].values[first]
+        geo_df["num_neighbours"] = count_neighbours(coord_set, radius, latlon)[inverse.ravel()]
+
+    if "dist_from_bc" in features:
+        groups = pd.factorize(geo_df[group_col])[0] if group_col else None
+        geo_df["dist_from_bc"] = dist_from_bc(coords, groups)
 
     # hardcoding variables (key) is not the best, but in this case we would just get a less readable code
-    return pd.merge(df, geo_df[[GEO_ID, "num_neighbours"]], on=GEO_ID, how="left")
+    return pd.merge(df, geo_df[[GEO_ID] + list(features)], on=GEO_ID, how="left")
+
+
+def update_geo_state(
+    df: pd.DataFrame,
+    geo_state: Optional[pd.DataFrame] = None,
+    GEO_ID: Optional[str] = "GEO_ID",
+    radius: float = 0.1,
+) -> pd.DataFrame:
+    """Add the locations of df to the already known ones, updating the neighbour counts incrementally
+
+    Args:
+        df (pd.DataFrame): input Dataframe with coordinates 'latitude' and 'longitude' to provide as float nums
+        geo_state (Optional[pd.DataFrame], optional): known locations, as returned by a previous call. Defaults to None.
+        radius (float, optional): radius in km of the neighbourhood. Defaults to 0.1.
+
+    Returns:
+        pd.DataFrame: one row per known location, with the cartesian coordinates 'x', 'y' and 'num_neighbours'
+    """
+    geo_df = get_geo_df(df, GEO_ID)
+    if geo_state is None:
+        geo_state = geo_df.iloc[:0].assign(num_neighbours=np.zeros(0, dtype="int64"))
+
+    keys = [GEO_ID, "latitude", "longitude"]
+    new_df = geo_df.merge(geo_state[keys], on=keys, how="left", indicator=True)
+    new_df = new_df[new_df["_merge"] == "left_only"].drop(columns="_merge")
+    if new_df.empty:
+        return geo_state
+
+    coords, first, inverse = np.unique(
+        geo_state[["x", "y"]].values.reshape(-1, 2), axis=0, return_index=True, return_inverse=True
+    )
+    counts = np.zeros(len(coords), dtype="int64")
+    counts[inverse.ravel()] = geo_state["num_neighbours"].values
+    coords, counts = add_neighbours(
+        coords,
+        counts,
+        new_df[["x", "y"]].values,
+        radius,
+        latlon=geo_state[["latitude", "longitude"]].values.reshape(-1, 2)[first],
+        new_latlon=new_df[["latitude", "longitude"]].values,
+    )
+
+    geo_state = pd.concat([geo_state, new_df], ignore_index=True)
+    points = pd.MultiIndex.from_arrays([coords[:, 0], coords[:, 1]])
+    geo_state["num_neighbours"] = counts[
+        points.get_indexer(pd.MultiIndex.from_arrays([geo_state["x"], geo_state["y"]]))
+    ]
+    return geo_state
+
+
+def get_geo_features_from_state(
+    df: pd.DataFrame, geo_state: pd.DataFrame, GEO_ID: Optional[str] = "GEO_ID"
+) -> pd.DataFrame:
+    """Add 'num_neighbours' and 'dist_from_bc' to df from the known locations, see update_geo_state
+
+    Returns:
+        pd.DataFrame: equal to input with the addition of the columns 'num_neighbours' and 'dist_from_bc'
+    """
+    geo_df = geo_state[[GEO_ID, "num_neighbours"]].copy()
+    geo_df["dist_from_bc"] = dist_from_bc(geo_state[["x", "y"]].values)
+    geo_df = geo_df[geo_df[GEO_ID].isin(df[GEO_ID].unique())]
+    return pd.merge(df, geo_df, on=GEO_ID, how="left")
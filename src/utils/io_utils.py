@@ -1,16 +1,133 @@
 import pandas as pd
-from typing import Optional
+import pyarrow as pa
+from pyarrow import csv
+from typing import Iterator, List, Optional, Sequence
 import re
 
-def read_and_rename(path: str) -> Optional[pd.DataFrame]:
+# types of the columns of the *PerformanceData.csv files. Bedrooms holds "Studio" and
+# zipcodes are not numbers, so both are kept as strings
+PERFORMANCE_DATA_SCHEMA = {
+    "Property Type": pa.string(),
+    "Listing Type": pa.string(),
+    "Bedrooms": pa.string(),
+    "Bathrooms": pa.int64(),
+    "Country Code": pa.string(),
+    "City": pa.string(),
+    "Zipcode": pa.string(),
+    "Latitude": pa.float64(),
+    "Longitude": pa.float64(),
+    "Currency Native": pa.string(),
+    "Airbnb Property ID": pa.int64(),
+    "Airbnb Host ID": pa.int64(),
+    "last_seen": pa.string(),
+    "cleaning_fee": pa.float64(),
+    "Reporting Month": pa.string(),
+    "Blocked Days": pa.int64(),
+    "Available Days": pa.int64(),
+    "Scraped During Month": pa.bool_(),
+    "Occupancy Rate": pa.float64(),
+    "Reservation Days": pa.int64(),
+    "ADR (USD)": pa.int64(),
+    "ADR (Native)": pa.int64(),
+    "Number Of Reservation": pa.int64(),
+    "Revenue (USD)": pa.int64(),
+    "Revenue (Native)": pa.int64(),
+}
+
+
+def rename_column(name: str) -> str:
+    """basic columns renaming: 'ADR (USD)' -> 'adr_usd'"""
+    return re.sub("[^A-Z|_]", "", name.lower().replace(" ", "_"), 0, re.IGNORECASE)
+
+
+def _get_convert_options(
+    path: str, columns: Optional[List[str]]
+) -> csv.ConvertOptions:
+    """Build the convert options projecting the requested (renamed) columns"""
+    # empty strings are missing, as with pandas.read_csv
+    convert_options = csv.ConvertOptions(
+        column_types=PERFORMANCE_DATA_SCHEMA, strings_can_be_null=True
+    )
+    if columns is not None:
+        # closed right away, the reader keeps a file handle and a thread
+        with csv.open_csv(path) as reader:
+            header = reader.schema.names
+        raw_names = {rename_column(k): k for k in header}
+        missing = [c for c in columns if c not in raw_names]
+        if missing:
+            raise KeyError(f"columns {missing} not in {path}")
+        convert_options.include_columns = [raw_names[c] for c in columns]
+    return convert_options
+
+
+def read_and_rename(
+    path: str, columns: Optional[List[str]] = None
+) -> Optional[pd.DataFrame]:
+    """Read a performance data csv with the multithreaded pyarrow engine and explicit types
+
+    Args:
+        path (str): path of the csv
+        columns (Optional[List[str]], optional): renamed columns to read, the others are never parsed. Defaults to None (all).
+
+    Returns:
+        Optional[pd.DataFrame]: the data with renamed columns, None if the file does not exist
+    """
     try:
-        df = pd.read_csv(path)
-    except(FileNotFoundError):
+        table = csv.read_csv(
+            path, convert_options=_get_convert_options(path, columns)
+        )
+    except FileNotFoundError:
         print("File does not exists!")
         return None
-    
-    #basic columns renaming
-    rename_mapper = {k:re.sub("[^A-Z|_]", "", k.lower().replace(" ", "_") ,0,re.IGNORECASE) for k in df.columns}
-    return df.rename(columns=rename_mapper)
-    
-    
\ No newline at end of file
+
+    df = table.to_pandas()
+    return df.rename(columns={k: rename_column(k) for k in df.columns})
+
+
+def iter_record_batches(
+    path: str, columns: Optional[List[str]] = None, block_size: int = 1 << 26
+) -> Iterator[pa.RecordBatch]:
+    """Stream a performance data csv as record batches, for files larger than memory
+
+    Args:
+        path (str): path of the csv
+        columns (Optional[List[str]], optional): renamed columns to read. Defaults to None (all).
+        block_size (int, optional): bytes of csv parsed in every batch. Defaults to 64MB.
+
+    Yields:
+        Iterator[pa.RecordBatch]: batches with renamed columns
+    """
+    reader = csv.open_csv(
+        path,
+        read_options=csv.ReadOptions(block_size=block_size),
+        convert_options=_get_convert_options(path, columns),
+    )
+    names = [rename_column(k) for k in reader.schema.names]
+    for batch in reader:
+        yield pa.RecordBatch.from_arrays(batch.columns, names=names)
+
+
+def write_partitioned(
+    df: pd.DataFrame,
+    path: str,
+    partition_cols: List[str],
+    sort_by: Sequence[str] = (),
+    row_group_rows: Optional[int] = None,
+) -> None:
+    """Write the dataframe as a hive partitioned parquet dataset.
+    Only the partitions contained in df are replaced, the others are left untouched,
+    so that different processes can write different partitions of the same dataset.
+    The rows of every partition are sorted by sort_by, so that the min/max statistics of its row groups
+    (of at most row_group_rows rows) let the readers skip the ones without the keys they look for
+    """
+    if sort_by:
+        df = df.sort_values(list(partition_cols) + list(sort_by), kind="stable", ignore_index=True)
+    options = {"row_group_size": row_group_rows} if row_group_rows else {}
+    df.to_parquet(
+        path,
+        partition_cols=partition_cols,
+        index=False,
+        existing_data_behavior="delete_matching",
+        write_statistics=True,
+        **options,
+    )
@@ -0,0 +1,68 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+# above this many cells per row the presence grid is replaced by a hash lookup
+MAX_GRID_CELLS_PER_ROW = 64
+
+
+def month_index(months: pd.Series) -> np.ndarray:
+    """Months as consecutive integers (year * 12 + month - 1), from 'YYYY-MM' strings or timestamps"""
+    if pd.api.types.is_datetime64_any_dtype(months):
+        return (months.dt.year * 12 + months.dt.month - 1).to_numpy("int64")
+    months = months.astype(str)
+    return (months.str[:4].astype("int64") * 12 + months.str[5:7].astype("int64") - 1).to_numpy()
+
+
+def get_target_columns(horizons: Sequence[int]) -> List[str]:
+    return [f"target_{k}m" for k in horizons]
+
+
+def churn_labels(
+    property_ids: np.ndarray,
+    months: np.ndarray,
+    horizons: Sequence[int],
+    cutoff: Optional[int] = None,
+) -> pd.DataFrame:
+    """Labels 'target_<k>m', True if the property is listed again exactly k months after the month of the row.
+    A property missing in month m + k is not listed at horizon k, even if it comes back later. The labels of the
+    months closer than k to the cutoff are unknown (missing): the data cannot tell if the property is still listed.
+    The rows need no order: every (property, month) is a cell of a presence grid, or of a hash set when the grid
+    would be sparse, and every horizon is a lookup of the shifted cells, linear in the number of rows
+
+    Args:
+        property_ids (np.ndarray): (n,) property of every row
+        months (np.ndarray): (n,) integer month of every row, see month_index
+        horizons (Sequence[int]): months ahead, positive
+        cutoff (Optional[int], optional): last month observed. Defaults to None, the last month of the rows.
+
+    Returns:
+        pd.DataFrame: one nullable boolean column per horizon, aligned with the rows
+    """
+    if len(months) == 0:
+        return pd.DataFrame({c: pd.array([], dtype="boolean") for c in get_target_columns(horizons)})
+    cutoff = months.max() if cutoff is None else cutoff
+    first = months.min()
+    codes, uniques = pd.factorize(property_ids)
+    # cells of a property are followed by max(horizons) empty cells, shifts never reach the next one
+    stride = int(max(cutoff, months.max()) - first + 1 + max(horizons))
+    cells = codes.astype("int64") * stride + (months - first)
+
+    if len(uniques) * stride <= MAX_GRID_CELLS_PER_ROW * len(cells):
+        grid = np.zeros(len(uniques) * stride, dtype=bool)
+        grid[cells] = True
+
+        def listed(k: int) -> np.ndarray:
+            return grid[cells + k]
+
+    else:
+        known = pd.Index(cells)
+
+        def listed(k: int) -> np.ndarray:
+            return pd.Index(cells + k).isin(known)
+
+    labels = {}
+    for k, column in zip(horizons, get_target_columns(horizons)):
+        labels[column] = pd.arrays.BooleanArray(listed(k), mask=months + k > cutoff)
+    return pd.DataFrame(labels)
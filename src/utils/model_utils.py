@@ -0,0 +1,190 @@
+import os
+import pickle
+import tempfile
+import logging
+import subprocess
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import cloudpickle
+import mlflow
+import sklearn
+from mlflow.entities import ViewType
+from mlflow.exceptions import MlflowException
+from mlflow.tracking import MlflowClient
+
+from utils.compiled_forest import MAX_BATCH_ROWS, CompiledForest
+
+log = logging.getLogger("MODEL")
+
+MODEL_ARTIFACT_PATH = "sk_models"
+COMPILED_ARTIFACT_PATH = "compiled_forest"
+COMPILED_MODEL_FILE = "forest.npz"
+CHAMPION_ALIAS = "champion"
+# default url for local mlflow
+TRACKING_URI = os.environ.get("MLFLOW_TRACKING_URI", "http://127.0.0.1:5000")
+LOCAL_TRACKING = TRACKING_URI.startswith("http://127.0.0.1")
+
+
+@contextmanager
+def local_tracking_server(enabled: bool = True) -> Iterator[Optional[subprocess.Popen]]:
+    """mlflow ui serving TRACKING_URI while the block runs, when it is the local default
+
+    Yields:
+        Optional[subprocess.Popen]: the server, None when it is not started
+    """
+    server = None
+    if enabled and LOCAL_TRACKING:
+        log.info("starting mlflow ui")
+        server = subprocess.Popen(
+            ["mlflow", "ui", "--host", "0.0.0.0", "--port", "5000", "--workers", "1"]
+        )
+    try:
+        yield server
+    finally:
+        if server is not None:
+            log.info("Sutting down mlflow ui")
+            server.terminate()
+
+
+def search_best_run_id(experiment_name: str, metric: str = "mean_test_f1") -> str:
+    """Best active run of the experiment, ordering and limit are computed by the tracking server
+
+    Args:
+        experiment_name (str): name of the experiment
+        metric (str, optional): criterion to choose the best model. Defaults to "mean_test_f1".
+
+    Returns:
+        str: run id of the best trained model
+    """
+    client = MlflowClient()
+    experiment = client.get_experiment_by_name(experiment_name)
+    if experiment is None:
+        raise MlflowException(f"experiment {experiment_name} does not exist")
+    runs = client.search_runs(
+        experiment_ids=[experiment.experiment_id],
+        run_view_type=ViewType.ACTIVE_ONLY,
+        order_by=[f"metrics.{metric} DESC"],
+        max_results=1,
+    )
+    if not runs:
+        raise MlflowException(f"no runs in experiment {experiment_name}")
+    return runs[0].info.run_id
+
+
+def set_champion(experiment_name: str, metric: str = "mean_test_f1") -> str:
+    """Register the model of the best run and point the champion alias to it.
+    The registered model has the same name of the experiment
+
+    Returns:
+        str: run id of the champion
+    """
+    run_id = search_best_run_id(experiment_name, metric)
+    client = MlflowClient()
+    try:
+        champion = client.get_model_version_by_alias(experiment_name, CHAMPION_ALIAS)
+        if champion.run_id == run_id:
+            return run_id
+    except MlflowException:
+        pass
+    version = mlflow.register_model(
+        f"runs:/{run_id}/{MODEL_ARTIFACT_PATH}", experiment_name
+    ).version
+    client.set_registered_model_alias(experiment_name, CHAMPION_ALIAS, version)
+    log.info(f"run {run_id} is the {CHAMPION_ALIAS} of {experiment_name}")
+    return run_id
+
+
+def get_model_run_id(experiment_name: str, metric: str = "mean_test_f1") -> str:
+    """Run id of the champion model, with a single registry call.
+    Falls back to the search of the best run when there is no champion yet"""
+    try:
+        return (
+            MlflowClient()
+            .get_model_version_by_alias(experiment_name, CHAMPION_ALIAS)
+            .run_id
+        )
+    except MlflowException:
+        return search_best_run_id(experiment_name, metric)
+
+
+def load_model(run_id: str, cache_dir: Optional[str] = None) -> Any:
+    """Load the sklearn model of a run, deserialized models are cached on disk by run id,
+    so that only the first load downloads the artifacts
+
+    Args:
+        run_id (str): mlflow run id
+        cache_dir (Optional[str], optional): directory of the cache, None disables it. Defaults to None.
+
+    Returns:
+        Any: the fitted sklearn Pipeline
+    """
+    if cache_dir is None:
+        return mlflow.sklearn.load_model(f"runs:/{run_id}/{MODEL_ARTIFACT_PATH}")
+
+    # pickles are not portable across sklearn versions
+    path = os.path.join(cache_dir, f"{run_id}-sklearn{sklearn.__version__}.pkl")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    model = mlflow.sklearn.load_model(f"runs:/{run_id}/{MODEL_ARTIFACT_PATH}")
+    os.makedirs(cache_dir, exist_ok=True)
+    # write and rename, concurrent readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        cloudpickle.dump(model, f)
+    os.replace(tmp_path, path)
+    return model
+
+
+def load_compiled_model(run_id: str, cache_dir: Optional[str] = None) -> CompiledForest:
+    """Load the compiled forest of a run, the artifact is downloaded once in cache_dir
+
+    Args:
+        run_id (str): mlflow run id
+        cache_dir (Optional[str], optional): directory of the cache, None downloads in a temporary directory. Defaults to None.
+
+    Returns:
+        CompiledForest: predictor with the same output of the sklearn model
+    """
+    if cache_dir is None:
+        return CompiledForest.load(
+            mlflow.artifacts.download_artifacts(
+                run_id=run_id,
+                artifact_path=f"{COMPILED_ARTIFACT_PATH}/{COMPILED_MODEL_FILE}",
+            )
+        )
+
+    path = os.path.join(cache_dir, f"{run_id}-{COMPILED_MODEL_FILE}")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=cache_dir) as tmp_dir:
+            downloaded = mlflow.artifacts.download_artifacts(
+                run_id=run_id,
+                artifact_path=f"{COMPILED_ARTIFACT_PATH}/{COMPILED_MODEL_FILE}",
+                dst_path=tmp_dir,
+            )
+            os.replace(downloaded, path)
+    return CompiledForest.load(path)
+
+
+def load_scoring_model(run_id: str, batch_rows: int, cache_dir: Optional[str] = None) -> Any:
+    """Model of a run for predict calls of at most batch_rows rows: the compiled forest up to
+    MAX_BATCH_ROWS rows, where it is the faster one, the sklearn model for larger batches
+    and for the runs logged before the compiled export
+
+    Args:
+        run_id (str): mlflow run id
+        batch_rows (int): largest number of rows of a predict call
+        cache_dir (Optional[str], optional): directory of the cache. Defaults to None.
+
+    Returns:
+        Any: CompiledForest or the fitted sklearn Pipeline
+    """
+    if batch_rows <= MAX_BATCH_ROWS:
+        try:
+            return load_compiled_model(run_id, cache_dir=cache_dir)
+        except (MlflowException, OSError):
+            log.info(f"run {run_id} has no compiled forest")
+    return load_model(run_id, cache_dir=cache_dir)
@@ -0,0 +1,199 @@
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.spatial import cKDTree
+
+from utils.geo_processing_utils import _distances, convert_to_cartesian
+
+# radii of the neighbourhoods in km and quantiles of the revenue of the neighbours
+NEIGHBOURHOOD_RADII_KM = (0.1, 0.5)
+REVENUE_QUANTILES = (0.25, 0.5, 0.75)
+# properties whose neighbours are searched and grouped together, the pairs in memory are
+# about this many times the neighbours of a property
+TILE_SIZE = 1 << 12
+
+
+def get_neighbourhood_dtypes(radii: Sequence[float] = NEIGHBOURHOOD_RADII_KM) -> Dict[str, str]:
+    """Columns of get_neighbourhood_features with their type, e.g. 'neighbours_adr_mean_100m'"""
+    dtypes = {}
+    for radius in radii:
+        label = f"{round(radius * 1000)}m"
+        dtypes[f"active_neighbours_{label}"] = "int32"
+        dtypes[f"neighbours_adr_mean_{label}"] = "float32"
+        dtypes[f"neighbours_occupancy_mean_{label}"] = "float32"
+        for q in REVENUE_QUANTILES:
+            dtypes[f"neighbours_revenue_p{round(q * 100)}_{label}"] = "float32"
+    return dtypes
+
+
+def neighbour_pairs(
+    coords: np.ndarray, radius: float, sources: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Directed pairs (i, j) of distinct points closer than radius, with their distance
+
+    Args:
+        coords (np.ndarray): (n, 2) array of cartesian coordinates in km
+        radius (float): strict upper bound for the distance in km
+        sources (Optional[np.ndarray], optional): the points i of the pairs. Defaults to all the points.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: points, their neighbours and the distances
+    """
+    if sources is None:
+        sources = np.arange(len(coords))
+    # the neighbours of the sources are closer than the radius on the x axis too
+    x = coords[sources, 0]
+    candidates = np.flatnonzero(
+        (coords[:, 0] >= x.min(initial=np.inf) - radius) & (coords[:, 0] <= x.max(initial=-np.inf) + radius)
+    )
+    # same filter of count_neighbours: candidates found with a slightly larger radius
+    pairs = cKDTree(coords[sources]).sparse_distance_matrix(
+        cKDTree(coords[candidates]), radius * (1 + 1e-9), output_type="ndarray"
+    )
+    src, dst = sources[pairs["i"]], candidates[pairs["j"]]
+    dist = _distances(coords[src], coords[dst])
+    close = (dist < radius) & (src != dst)
+    return src[close], dst[close], dist[close]
+
+
+def _group_mean(groups: np.ndarray, values: np.ndarray, n: int) -> np.ndarray:
+    """Mean of the values of every group in [0, n), missing values are ignored"""
+    present = ~np.isnan(values)
+    sums = np.bincount(groups[present], weights=values[present], minlength=n)
+    counts = np.bincount(groups[present], minlength=n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def _group_quantile(sorted_values: np.ndarray, counts: np.ndarray, q: float) -> np.ndarray:
+    """Quantile q of contiguous groups of sorted values, linear interpolation as np.quantile"""
+    if len(sorted_values) == 0:
+        return np.full(len(counts), np.nan)
+    starts = np.cumsum(counts) - counts
+    pos = q * np.maximum(counts - 1, 0)
+    lo = np.floor(pos).astype("int64")
+    hi = np.minimum(lo + 1, np.maximum(counts - 1, 0))
+    # empty groups point to a valid position and are masked afterwards
+    last = len(sorted_values) - 1
+    low = sorted_values[np.minimum(starts + lo, last)]
+    high = sorted_values[np.minimum(starts + hi, last)]
+    return np.where(counts > 0, low + (high - low) * (pos - lo), np.nan)
+
+
+def month_neighbourhood(
+    coords: np.ndarray,
+    adr: np.ndarray,
+    occupancy: np.ndarray,
+    revenue: np.ndarray,
+    radii: Sequence[float] = NEIGHBOURHOOD_RADII_KM,
+    tile_size: int = TILE_SIZE,
+) -> Dict[str, np.ndarray]:
+    """Aggregates of the neighbours of every property active in the same month, for every radius.
+    The properties are numbered by revenue and the pairs are searched only with the largest radius,
+    then grouped by property as the rows of a sparse matrix (a linear bucket
+    sort, with the neighbours in order of revenue). The smaller radii are filters of the same grouped pairs
+    and the quantiles are positions in the groups. To bound the memory the pairs are searched and grouped
+    by tiles of tile_size properties along the x axis
+
+    Args:
+        coords (np.ndarray): (n, 2) cartesian coordinates in km of the properties of the month
+        adr (np.ndarray): (n,) ADR of the properties
+        occupancy (np.ndarray): (n,) occupancy rate of the properties
+        revenue (np.ndarray): (n,) revenue of the properties, not missing
+
+    Returns:
+        Dict[str, np.ndarray]: the columns of get_neighbourhood_dtypes, aligned with coords
+    """
+    n = len(coords)
+    by_revenue = np.argsort(revenue, kind="stable")
+    coords, adr, occupancy, revenue = (
+        a[by_revenue] for a in (coords, adr, occupancy, revenue)
+    )
+    features = {name: np.empty(n) for name in get_neighbourhood_dtypes(radii)}
+    # tiles are ranges of the properties sorted by x
+    by_x = np.argsort(coords[:, 0], kind="stable")
+    for start in range(0, n, tile_size):
+        tile = by_x[start : start + tile_size]
+        src, dst, dist = neighbour_pairs(coords, max(radii), tile)
+        position = np.empty(n, dtype="int64")
+        position[tile] = np.arange(len(tile))
+        for name, values in _tile_neighbourhood(
+            position[src], dst, dist, len(tile), n, adr, occupancy, revenue, radii
+        ).items():
+            features[name][tile] = values
+
+    # back to the order of the input
+    for name, values in features.items():
+        features[name] = np.empty_like(values)
+        features[name][by_revenue] = values
+    return features
+
+
+def _tile_neighbourhood(
+    src: np.ndarray,
+    dst: np.ndarray,
+    dist: np.ndarray,
+    n_src: int,
+    n: int,
+    adr: np.ndarray,
+    occupancy: np.ndarray,
+    revenue: np.ndarray,
+    radii: Sequence[float],
+) -> Dict[str, np.ndarray]:
+    """Aggregates of the pairs (src, dst) of a tile, src are positions in the tile"""
+    # the entries are positions of the pairs, never zero: sparse matrices drop explicit zeros
+    grouped = coo_matrix((np.arange(1, len(src) + 1), (src, dst)), shape=(n_src, n)).tocsr()
+    grouped.sort_indices()
+    dst, dist = grouped.indices, dist[grouped.data - 1]
+    src = np.repeat(np.arange(n_src), np.diff(grouped.indptr))
+
+    columns = iter(get_neighbourhood_dtypes(radii))
+    features = {}
+    for radius in radii:
+        close = dist < radius
+        s, d = src[close], dst[close]
+        counts = np.bincount(s, minlength=n_src)
+        features[next(columns)] = counts
+        features[next(columns)] = _group_mean(s, adr[d], n_src)
+        features[next(columns)] = _group_mean(s, occupancy[d], n_src)
+        for q in REVENUE_QUANTILES:
+            features[next(columns)] = _group_quantile(revenue[d], counts, q)
+    return features
+
+
+def get_neighbourhood_features(
+    df: pd.DataFrame,
+    radii: Sequence[float] = NEIGHBOURHOOD_RADII_KM,
+    month_col: Optional[str] = "reporting_month",
+) -> pd.DataFrame:
+    """Count, mean ADR, mean occupancy and revenue quantiles of the properties active in the same month
+    within every radius, the property itself excluded. Every month has its own spatial index
+
+    Args:
+        df (pd.DataFrame): monthly rows with 'latitude', 'longitude', 'adr_usd', 'occupancy_rate' and 'revenue_usd'
+        radii (Sequence[float], optional): radii in km. Defaults to NEIGHBOURHOOD_RADII_KM.
+        month_col (Optional[str], optional): column of the month. Defaults to "reporting_month".
+
+    Returns:
+        pd.DataFrame: the columns of get_neighbourhood_dtypes, aligned with the rows of df
+    """
+    x, y = convert_to_cartesian(df["latitude"].to_numpy(), df["longitude"].to_numpy())
+    coords = np.column_stack([x, y])
+    adr = df["adr_usd"].to_numpy(dtype="float64", na_value=np.nan)
+    occupancy = df["occupancy_rate"].to_numpy(dtype="float64", na_value=np.nan)
+    revenue = df["revenue_usd"].to_numpy(dtype="float64")
+
+    dtypes = get_neighbourhood_dtypes(radii)
+    out = {name: np.zeros(len(df), dtype="float64") for name in dtypes}
+    months = pd.factorize(df[month_col])[0]
+    order = np.argsort(months, kind="stable")
+    bounds = np.searchsorted(months[order], np.arange(months.max() + 2 if len(months) else 1))
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        rows = order[lo:hi]
+        for name, values in month_neighbourhood(
+            coords[rows], adr[rows], occupancy[rows], revenue[rows], radii
+        ).items():
+            out[name][rows] = values
+    return pd.DataFrame(out, index=df.index).astype(dtypes)
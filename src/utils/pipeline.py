@@ -0,0 +1,205 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+import threading
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Sequence
+
+from utils.tracing import stage_span
+
+log = logging.getLogger("PIPELINE")
+
+
+class Stage(NamedTuple):
+    """A step of the pipeline.
+
+    Args:
+        name (str): unique name of the stage
+        run (Callable[[], None]): the work, executed in process
+        deps (Sequence[str]): stages that must complete before this one
+        inputs (Sequence[str]): files, directories or glob patterns whose content is fingerprinted
+        config (Mapping[str, Any]): settings of the stage, part of the fingerprint
+        outputs (Sequence[str]): files or directories that must exist for the stage to be skipped
+        cache (bool): False when the stage has to run every time
+        shared_outputs (bool): True when the outputs are written by other stages too, the dependent stages
+            then see the fingerprint of the stage instead of the content of its outputs
+    """
+
+    name: str
+    run: Callable[[], None]
+    deps: Sequence[str] = ()
+    inputs: Sequence[str] = ()
+    config: Mapping[str, Any] = {}
+    outputs: Sequence[str] = ()
+    cache: bool = True
+    shared_outputs: bool = False
+
+
+def _expand(patterns: Iterable[str]) -> List[str]:
+    files = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isdir(path):
+                for root, dirs, names in os.walk(path):
+                    dirs.sort()
+                    files += [os.path.join(root, n) for n in sorted(names)]
+            else:
+                files.append(path)
+    return files
+
+
+class FileHashes:
+    """Content hashes of files, a file is hashed again only when its size or modification time change"""
+
+    def __init__(self, known: Optional[Dict[str, List]] = None):
+        self.known = dict(known or {})
+        self.lock = threading.Lock()
+
+    def __call__(self, path: str) -> str:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self.lock:
+            cached = self.known.get(key)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        with self.lock:
+            self.known[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+
+def _hash_files(patterns: Iterable[str], hashes: FileHashes, digest: Any) -> None:
+    for path in _expand(patterns):
+        digest.update(path.encode())
+        digest.update(hashes(path).encode())
+
+
+def fingerprint(stage: Stage, hashes: FileHashes, upstream: Mapping[str, str]) -> str:
+    """Hash of the inputs and the settings of a stage, and of what its dependencies produced"""
+    digest = hashlib.sha256(stage.name.encode())
+    digest.update(json.dumps(dict(stage.config), sort_keys=True, default=str).encode())
+    for dep in sorted(stage.deps):
+        digest.update(upstream[dep].encode())
+    _hash_files(stage.inputs, hashes, digest)
+    return digest.hexdigest()
+
+
+def output_hash(stage: Stage, hashes: FileHashes, fingerprint: str) -> str:
+    """What a stage produced: the content of its outputs, or its fingerprint when it has none.
+    A stage that runs again and writes the same outputs does not invalidate the next ones"""
+    if not stage.outputs or stage.shared_outputs:
+        return fingerprint
+    digest = hashlib.sha256()
+    _hash_files(stage.outputs, hashes, digest)
+    return digest.hexdigest()
+
+
+def _check_graph(stages: Sequence[Stage]) -> None:
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("stage names must be unique")
+    unknown = {d for s in stages for d in s.deps} - set(names)
+    if unknown:
+        raise ValueError(f"unknown dependencies {sorted(unknown)}")
+    done: set = set()
+    pending = list(stages)
+    while pending:
+        ready = [s for s in pending if set(s.deps) <= done]
+        if not ready:
+            raise ValueError(f"cycle among {sorted(s.name for s in pending)}")
+        done |= {s.name for s in ready}
+        pending = [s for s in pending if s.name not in done]
+
+
+def run_pipeline(
+    stages: Sequence[Stage],
+    state_path: str,
+    max_workers: Optional[int] = None,
+    force: Iterable[str] = (),
+) -> Dict[str, str]:
+    """Run the stages as a DAG in a thread pool: every stage starts as soon as its dependencies are done,
+    independent stages run concurrently. A stage is skipped when its fingerprint is the one of its last
+    successful run and its outputs exist. The fingerprints are saved in state_path after every stage
+
+    Args:
+        stages (Sequence[Stage]): the graph
+        state_path (str): json file with the fingerprints of the last runs
+        max_workers (Optional[int], optional): stages running at the same time. Defaults to None.
+        force (Iterable[str], optional): stages to run even if up to date. Defaults to ().
+
+    Returns:
+        Dict[str, str]: status of every stage, "done" or "skipped"
+    """
+    _check_graph(stages)
+    force = set(force)
+    state = {"stages": {}, "files": {}}
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    hashes = FileHashes(state["files"])
+    state_lock = threading.Lock()
+
+    def save_state() -> None:
+        with state_lock:
+            state["files"] = hashes.known
+            os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+            tmp_path = f"{state_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, indent=1)
+            os.replace(tmp_path, state_path)
+
+    produced: Dict[str, str] = {}
+    status: Dict[str, str] = {}
+
+    def execute(stage: Stage) -> str:
+        current = fingerprint(stage, hashes, produced)
+        if (
+            stage.cache
+            and stage.name not in force
+            and state["stages"].get(stage.name) == current
+            and all(os.path.exists(p) for p in stage.outputs)
+        ):
+            log.info(f"{stage.name}: up to date, skipped")
+            result = "skipped"
+        else:
+            log.info(f"{stage.name}: running")
+            with stage_span(stage.name):
+                stage.run()
+            if stage.cache:
+                with state_lock:
+                    state["stages"][stage.name] = current
+                save_state()
+            log.info(f"{stage.name}: done")
+            result = "done"
+        produced[stage.name] = output_hash(stage, hashes, current)
+        return result
+
+    pending = {s.name: s for s in stages}
+    running: Dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if set(stage.deps) <= status.keys():
+                    # the spans of the stage are children of the span of the caller
+                    running[pool.submit(contextvars.copy_context().run, execute, stage)] = name
+                    del pending[name]
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    status[name] = future.result()
+                except Exception:
+                    log.error(f"{name}: failed, the stages depending on it are not run")
+                    # let the running stages finish, nothing else is started
+                    pending.clear()
+                    wait(running)
+                    save_state()
+                    raise
+    save_state()
+    return status
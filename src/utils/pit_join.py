@@ -0,0 +1,295 @@
+import operator
+from datetime import timedelta
+from functools import reduce
+from typing import Callable, Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from feast import FeatureStore, FeatureView, FileSource
+from feast.infra.offline_stores.file import FileRetrievalJob
+from feast.infra.offline_stores.offline_store import RetrievalJob, RetrievalMetadata
+
+from utils.tracing import stage_span
+
+ENTITY_DF_EVENT_TIMESTAMP_COL = "event_timestamp"
+# hive partition of the sources written by prepare_data, the month ('YYYY-MM') of the UTC timestamps
+MONTH_PARTITION = "month"
+
+
+class AsOfRetrievalJob(FileRetrievalJob):
+    """Retrieval job evaluated with pandas instead of dask, it can be persisted as a saved dataset
+    and validated as the jobs of the file offline store. The join is computed once, the job keeps
+    its (immutable) arrow result: persisting the job and reading it back as a frame cost a single join"""
+
+    _table: Optional[pa.Table] = None
+
+    def _evaluate(self) -> pa.Table:
+        if self._table is None:
+            with stage_span("historical_retrieval") as span:
+                df = self.evaluation_function()
+                span.rows = len(df)
+                self._table = pa.Table.from_pandas(df, preserve_index=False)
+        return self._table
+
+    def _to_df_internal(self, timeout: Optional[int] = None) -> pd.DataFrame:
+        return self._evaluate().to_pandas()
+
+    def _to_arrow_internal(self, timeout: Optional[int] = None) -> pa.Table:
+        return self._evaluate()
+
+
+def _to_utc(ts: pd.Series) -> pd.Series:
+    # tz-naive timestamps are UTC, as in feast
+    return ts.dt.tz_localize("UTC") if ts.dt.tz is None else ts.dt.tz_convert("UTC")
+
+
+def read_source(
+    source: FileSource,
+    columns: List[str],
+    start: Optional[pd.Timestamp] = None,
+    end: Optional[pd.Timestamp] = None,
+) -> pd.DataFrame:
+    """Read the columns of a file source, only the rows with timestamp in [start, end] are loaded
+
+    Args:
+        source (FileSource): parquet file or (partitioned) dataset
+        columns (List[str]): columns to read
+        start (Optional[pd.Timestamp], optional): UTC lower bound of the timestamps. Defaults to None.
+        end (Optional[pd.Timestamp], optional): UTC upper bound of the timestamps. Defaults to None.
+
+    Returns:
+        pd.DataFrame: the requested data, with UTC timestamps
+    """
+    dataset = ds.dataset(source.path, format="parquet", partitioning="hive")
+    ts_type = dataset.schema.field(source.timestamp_field).type
+    # the partitions of the months out of [start, end] are skipped without opening their files,
+    # the row groups of the other ones by the statistics of the timestamps
+    by_month = (
+        dataset.partitioning is not None
+        and MONTH_PARTITION in dataset.partitioning.schema.names
+        and ts_type.tz is None
+    )
+
+    def as_scalar(value: pd.Timestamp) -> pa.Scalar:
+        if ts_type.tz is None:
+            value = value.tz_convert("UTC").tz_localize(None)
+        return pa.scalar(value, type=ts_type)
+
+    filters = []
+    if start is not None:
+        filters.append(ds.field(source.timestamp_field) >= as_scalar(start))
+        if by_month:
+            filters.append(ds.field(MONTH_PARTITION) >= start.tz_convert("UTC").strftime("%Y-%m"))
+    if end is not None:
+        filters.append(ds.field(source.timestamp_field) <= as_scalar(end))
+        if by_month:
+            filters.append(ds.field(MONTH_PARTITION) <= end.tz_convert("UTC").strftime("%Y-%m"))
+    filter_ = reduce(operator.and_, filters) if filters else None
+
+    df = dataset.to_table(columns=columns, filter=filter_).to_pandas()
+    for column in {source.timestamp_field, source.created_timestamp_column} - {""}:
+        df[column] = _to_utc(df[column])
+    return df
+
+
+def read_keys(source: FileSource, keys: pd.DataFrame) -> pd.DataFrame:
+    """The keys of the source among the given ones, e.g. the properties with at least a row.
+    Only the key columns are read, and only from the row groups whose statistics can contain the keys
+
+    Args:
+        source (FileSource): parquet file or (partitioned) dataset
+        keys (pd.DataFrame): keys to look for, with the column names of the source
+
+    Returns:
+        pd.DataFrame: the rows of the source with one of the keys, key columns only
+    """
+    filter_ = reduce(
+        operator.and_,
+        [ds.field(c).isin(pa.array(keys[c].drop_duplicates())) for c in keys.columns],
+    )
+    dataset = ds.dataset(source.path, format="parquet", partitioning="hive")
+    return dataset.to_table(columns=list(keys.columns), filter=filter_).to_pandas()
+
+
+def as_of_join(
+    entity_df: pd.DataFrame,
+    feature_df: pd.DataFrame,
+    join_keys: List[str],
+    timestamp_field: str,
+    features: Dict[str, str],
+    ttl: Optional[timedelta] = None,
+    created_timestamp_column: Optional[str] = None,
+    all_keys: Optional[Union[pd.DataFrame, Callable[[pd.DataFrame], pd.DataFrame]]] = None,
+    event_timestamp_col: str = ENTITY_DF_EVENT_TIMESTAMP_COL,
+) -> pd.DataFrame:
+    """Point in time join: every entity row gets the latest features with a timestamp in [event_timestamp - ttl, event_timestamp]
+
+    Args:
+        entity_df (pd.DataFrame): entities with UTC event timestamps, sorted by event timestamp
+        feature_df (pd.DataFrame): feature rows with UTC timestamps
+        join_keys (List[str]): entity columns to join on
+        timestamp_field (str): timestamp column of feature_df
+        features (Dict[str, str]): columns of feature_df to add, with their output name
+        ttl (Optional[timedelta], optional): max age of the features, None or 0 means no limit. Defaults to None.
+        created_timestamp_column (Optional[str], optional): breaks the ties between rows with the same timestamp. Defaults to None.
+        all_keys (Optional[Union[pd.DataFrame, Callable]], optional): all the keys of the source, or a function
+            returning the ones of the source among the keys it gets (called only when some entities
+            are not matched), see below. Defaults to None.
+
+    Returns:
+        pd.DataFrame: entity_df with the features. As in the file offline store of feast, entities with no row at all
+        in the source get missing values, while entities whose rows are all out of the ttl window are dropped
+    """
+    sort_by = [timestamp_field] + (
+        [created_timestamp_column] if created_timestamp_column else []
+    )
+    right = feature_df[join_keys + sort_by + list(features)].rename(
+        columns={**features, timestamp_field: "__timestamp"}
+    )
+    # the last row wins among the ones with the same timestamp: sort by creation too
+    right = right.sort_values(
+        ["__timestamp"] + sort_by[1:], kind="stable"
+    ).drop(columns=sort_by[1:])
+
+    joined = pd.merge_asof(
+        entity_df,
+        right,
+        left_on=event_timestamp_col,
+        right_on="__timestamp",
+        by=join_keys,
+        direction="backward",
+        allow_exact_matches=True,
+        tolerance=pd.Timedelta(ttl) if ttl else None,
+    )
+
+    if all_keys is not None:
+        unmatched = joined["__timestamp"].isna().values
+        if unmatched.any():
+            keys = joined.loc[unmatched, join_keys]
+            known_keys = all_keys(keys) if callable(all_keys) else all_keys
+            known = np.zeros(len(joined), dtype=bool)
+            known[unmatched] = (
+                keys.merge(known_keys.drop_duplicates(), how="left", indicator=True)["_merge"]
+                .eq("both")
+                .values
+            )
+            joined = joined[~known]
+    return joined.drop(columns="__timestamp")
+
+
+def _evaluate(
+    fs: FeatureStore,
+    entity_df: pd.DataFrame,
+    views_to_features: Dict[str, List[str]],
+    full_feature_names: bool,
+) -> pd.DataFrame:
+    df = entity_df.copy()
+    df[ENTITY_DF_EVENT_TIMESTAMP_COL] = _to_utc(
+        pd.to_datetime(df[ENTITY_DF_EVENT_TIMESTAMP_COL])
+    )
+    df = df.sort_values(ENTITY_DF_EVENT_TIMESTAMP_COL, kind="stable")
+    start, end = df[ENTITY_DF_EVENT_TIMESTAMP_COL].min(), df[ENTITY_DF_EVENT_TIMESTAMP_COL].max()
+
+    all_join_keys: List[str] = []
+    for view_name, features in views_to_features.items():
+        fv: FeatureView = fs.get_feature_view(view_name, allow_registry_cache=True)
+        source = fv.batch_source
+        reverse_mapping = {v: k for k, v in source.field_mapping.items()}
+        join_keys = [
+            fv.projection.join_key_map.get(c.name, c.name) for c in fv.entity_columns
+        ]
+        source_keys = [reverse_mapping.get(k, k) for k in join_keys]
+        all_join_keys = list(dict.fromkeys(all_join_keys + join_keys))
+
+        timestamps = [source.timestamp_field] + (
+            [source.created_timestamp_column] if source.created_timestamp_column else []
+        )
+        feature_df = read_source(
+            source,
+            source_keys + timestamps + [reverse_mapping.get(f, f) for f in features],
+            start=start - fv.ttl if fv.ttl else None,
+            end=end,
+        ).rename(columns=source.field_mapping)
+
+        df = as_of_join(
+            df,
+            feature_df,
+            join_keys,
+            timestamp_field=source.field_mapping.get(
+                source.timestamp_field, source.timestamp_field
+            ),
+            features={
+                f: f"{fv.projection.name_to_use()}__{f}" if full_feature_names else f
+                for f in features
+            },
+            ttl=fv.ttl,
+            created_timestamp_column=source.field_mapping.get(
+                source.created_timestamp_column, source.created_timestamp_column
+            ),
+            # the whole history is read only for the keys of the entities not matched
+            all_keys=lambda keys: read_keys(
+                source, keys.set_axis(source_keys, axis=1)
+            ).rename(columns=source.field_mapping),
+        )
+
+    # as in feast, one row per entity and timestamp
+    return df.drop_duplicates(
+        all_join_keys + [ENTITY_DF_EVENT_TIMESTAMP_COL], keep="last", ignore_index=True
+    )
+
+
+def get_historical_features(
+    fs: FeatureStore,
+    entity_df: pd.DataFrame,
+    features: List[str],
+    full_feature_names: bool = False,
+) -> RetrievalJob:
+    """Same as fs.get_historical_features, with the point in time join of every feature view computed
+    as a sorted as-of join in pandas. Only the columns and the time range needed are read from the sources.
+    Requests with on demand feature views or non file sources fall back to feast
+
+    Args:
+        fs (FeatureStore): the feature store
+        entity_df (pd.DataFrame): entities with an 'event_timestamp' column
+        features (List[str]): feature references as 'feature_view:feature'
+
+    Returns:
+        RetrievalJob: lazy job, as the one returned by feast
+    """
+    views_to_features: Dict[str, List[str]] = {}
+    for ref in features:
+        view_name, feature = ref.split(":")
+        views_to_features.setdefault(view_name, []).append(feature)
+
+    odfvs = {v.name for v in fs.list_on_demand_feature_views(allow_cache=True)}
+    if (
+        odfvs & views_to_features.keys()
+        or ENTITY_DF_EVENT_TIMESTAMP_COL not in entity_df.columns
+        or not all(
+            isinstance(
+                fs.get_feature_view(v, allow_registry_cache=True).batch_source, FileSource
+            )
+            for v in views_to_features
+        )
+    ):
+        return fs.get_historical_features(
+            entity_df=entity_df,
+            features=features,
+            full_feature_names=full_feature_names,
+        )
+
+    timestamps = pd.to_datetime(entity_df[ENTITY_DF_EVENT_TIMESTAMP_COL])
+    return AsOfRetrievalJob(
+        evaluation_function=lambda: _evaluate(
+            fs, entity_df, views_to_features, full_feature_names
+        ),
+        full_feature_names=full_feature_names,
+        metadata=RetrievalMetadata(
+            features=features,
+            keys=list(set(entity_df.columns) - {ENTITY_DF_EVENT_TIMESTAMP_COL}),
+            min_event_timestamp=timestamps.min().to_pydatetime(),
+            max_event_timestamp=timestamps.max().to_pydatetime(),
+        ),
+    )
@@ -0,0 +1,45 @@
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+# rate: (numerator, denominator), days of the month of the listing
+RATES: Dict[str, Tuple[str, str]] = {
+    "rate_blocked_days": ("blocked_days", "available_days"),
+    "rate_available_days": ("available_days", "blocked_days"),
+}
+RATE_DTYPE = "float32"
+
+
+def safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """numerator / denominator, nan where the denominator is 0 or any of the two is missing
+    (the properties with no available or no blocked days) instead of inf"""
+    numerator = np.asarray(numerator, dtype="float64")
+    denominator = np.asarray(denominator, dtype="float64")
+    out = np.full(np.broadcast(numerator, denominator).shape, np.nan)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out.astype(RATE_DTYPE)
+
+
+def _to_numpy(values: pd.Series) -> np.ndarray:
+    # the online store returns objects with None for the unknown properties
+    return values.to_numpy(dtype="float64", na_value=np.nan)
+
+
+def get_rates(df: pd.DataFrame) -> pd.DataFrame:
+    """Rates of the days of the month, the same with the sources of df2_feature_view
+    (precomputed) and in the on demand view (computed at retrieval)
+
+    Args:
+        df (pd.DataFrame): frame with the blocked_days and available_days columns
+
+    Returns:
+        pd.DataFrame: the RATES columns, with the index of df
+    """
+    return pd.DataFrame(
+        {
+            name: safe_divide(_to_numpy(df[numerator]), _to_numpy(df[denominator]))
+            for name, (numerator, denominator) in RATES.items()
+        },
+        index=df.index,
+    )
@@ -0,0 +1,143 @@
+import os
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence, Set, Tuple
+
+from feast import FeatureStore
+from feast.infra.registry.file import FileRegistryStore
+from feast.protos.feast.core.Registry_pb2 import Registry as RegistryProto
+
+from utils.config import load_config
+
+log = logging.getLogger("REGISTRY")
+
+FEATURE_REPO = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, "feature_store", "feature_repo"
+)
+# fingerprints of the definitions last applied, next to the pipeline state
+STATE_PATH = os.path.join(FEATURE_REPO, "data", "_state", "registry.json")
+
+# every change of the registry of the shared feature store (apply, saved datasets, materialization)
+# is a read-modify-write of its cached proto: the stages running in concurrent threads take turns
+REGISTRY_LOCK = threading.RLock()
+
+
+class AtomicFileRegistryStore(FileRegistryStore):
+    """Local registry written in a temporary file that replaces the old one, the stages running
+    concurrently and the other processes never read a partially written registry"""
+
+    def _write_registry(self, registry_proto: RegistryProto) -> None:
+        registry_proto.version_id = str(uuid.uuid4())
+        registry_proto.last_updated.FromDatetime(datetime.utcnow())
+        self._filepath.parent.mkdir(exist_ok=True)
+        tmp_path = f"{self._filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, mode="wb") as f:
+            f.write(registry_proto.SerializeToString())
+        os.replace(tmp_path, self._filepath)
+
+
+@lru_cache(maxsize=None)
+def _feature_store(repo_path: str) -> FeatureStore:
+    store = FeatureStore(repo_path=repo_path)
+    registry = store.registry
+    registry.cached_registry_proto_ttl = timedelta(seconds=load_config()["REGISTRY_TTL_S"])
+    # feast truncates and rewrites the file in place
+    if type(registry._registry_store) is FileRegistryStore:
+        registry._registry_store = AtomicFileRegistryStore(store.config.registry, Path(repo_path))
+    return store
+
+
+def get_feature_store(repo_path: str = FEATURE_REPO) -> FeatureStore:
+    """Feature store shared by the whole process. Its registry is parsed once and read again from disk
+    only when the snapshot is older than REGISTRY_TTL_S, or by the calls that do not allow the cache
+
+    Args:
+        repo_path (str, optional): feature repository. Defaults to the one of the project.
+
+    Returns:
+        FeatureStore: the feature store
+    """
+    return _feature_store(os.path.realpath(repo_path))
+
+
+def definitions_fingerprint(objects: Sequence) -> str:
+    """Hash of the specs of feast objects (entities, sources, feature views...), without the metadata
+    (creation and update times) that feast sets when they are applied"""
+    digest = hashlib.sha256()
+    for obj in sorted(objects, key=lambda o: (type(o).__name__, o.name)):
+        proto = obj.to_proto()
+        # data sources have no separate spec
+        spec = getattr(proto, "spec", proto)
+        digest.update(type(obj).__name__.encode())
+        digest.update(spec.SerializeToString(deterministic=True))
+    return digest.hexdigest()
+
+
+def _registered(store: FeatureStore) -> Set[Tuple[str, str]]:
+    registry, project = store.registry, store.project
+    listed = [
+        registry.list_data_sources(project, allow_cache=True),
+        registry.list_entities(project, allow_cache=True),
+        registry.list_feature_views(project, allow_cache=True),
+        registry.list_on_demand_feature_views(project, allow_cache=True),
+        registry.list_stream_feature_views(project, allow_cache=True),
+        registry.list_feature_services(project, allow_cache=True),
+    ]
+    return {(type(obj).__name__, obj.name) for objects in listed for obj in objects}
+
+
+def _read_state() -> Dict[str, str]:
+    if not os.path.exists(STATE_PATH):
+        return {}
+    with open(STATE_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_state(state: Dict[str, str]) -> None:
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    tmp_path = f"{STATE_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, STATE_PATH)
+
+
+def apply_if_changed(
+    store: FeatureStore,
+    name: str,
+    objects: Sequence,
+    apply: Optional[Callable[[], None]] = None,
+) -> bool:
+    """Apply a group of definitions only when their specs changed since the last apply of the group,
+    or when some of them are missing from the registry (a new registry, or deleted by another apply)
+
+    Args:
+        store (FeatureStore): the feature store
+        name (str): name of the group of definitions
+        objects (Sequence): feast objects of the group
+        apply (Optional[Callable[[], None]], optional): the apply. Defaults to store.apply(objects).
+
+    Returns:
+        bool: True when the definitions were applied
+    """
+    fingerprint = definitions_fingerprint(objects)
+    expected = {(type(obj).__name__, obj.name) for obj in objects}
+    with REGISTRY_LOCK:
+        state = _read_state()
+        if state.get(name) == fingerprint and expected <= _registered(store):
+            log.info(f"{name}: registry up to date")
+            return False
+
+        log.info(f"{name}: applying {len(objects)} definitions")
+        if apply is None:
+            store.apply(list(objects))
+        else:
+            apply()
+        state[name] = fingerprint
+        _write_state(state)
+    return True
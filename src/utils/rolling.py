@@ -0,0 +1,115 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# months of the trend features: changes over 3 months, volatility on windows of 3 months
+TREND_MONTHS = 3
+
+
+class MonthlySegments:
+    """Monthly rows sorted by property and month: every property is a contiguous segment and the rows
+    of a month window or of a month lag are at most `months` positions back in its segment.
+    Windows and lags are computed with shifted views of the sorted arrays, in O(rows * months),
+    and they are aware of the gaps: they are defined in months, not in rows
+
+    Args:
+        property_ids (np.ndarray): (n,) property of every row
+        months (np.ndarray): (n,) integer month of every row (see utils.labels.month_index), unique per property
+    """
+
+    def __init__(self, property_ids: np.ndarray, months: np.ndarray):
+        codes = pd.factorize(property_ids)[0]
+        months = np.asarray(months, dtype="int64")
+        # a single integer key sorts faster than a lexsort, sorted inputs are not sorted again
+        first_month, n_months = (months.min(), months.max() - months.min() + 1) if len(months) else (0, 1)
+        key = codes.astype("int64") * n_months + (months - first_month)
+        if (key[1:] < key[:-1]).any():
+            self.order = np.argsort(key)
+        else:
+            self.order = np.arange(len(key))
+        self.codes = codes[self.order]
+        self.months = months[self.order]
+        self._backs = {}
+        # position of the first row of the segment of every row
+        is_first = np.ones(len(self.codes), dtype=bool)
+        is_first[1:] = self.codes[1:] != self.codes[:-1]
+        self.first = np.maximum.accumulate(np.where(is_first, np.arange(len(is_first)), 0))
+
+    def sort(self, values: np.ndarray) -> np.ndarray:
+        return np.asarray(values, dtype="float64")[self.order]
+
+    def unsort(self, values: np.ndarray) -> np.ndarray:
+        """Values of the sorted rows back in the order of the input rows"""
+        out = np.empty_like(values)
+        out[self.order] = values
+        return out
+
+    def _back(self, j: int) -> np.ndarray:
+        """Rows j positions back in the same segment, -1 where there is none"""
+        if j not in self._backs:
+            idx = np.arange(len(self.codes)) - j
+            self._backs[j] = np.where(idx >= self.first, idx, -1)
+        return self._backs[j]
+
+    def lag(self, values: np.ndarray, k: int) -> np.ndarray:
+        """Sorted values of the same property k months earlier, nan when the property was not listed"""
+        out = np.full(len(values), np.nan)
+        for j in range(1, k + 1):
+            idx = self._back(j)
+            found = (idx >= 0) & (self.months[idx] == self.months - k)
+            out[found] = values[idx[found]]
+        return out
+
+    def window(self, values: np.ndarray, k: int) -> np.ndarray:
+        """(n, k) sorted values of the same property in the last k months (current included), nan when not listed"""
+        out = np.full((len(values), k), np.nan)
+        for j in range(k):
+            idx = self._back(j)
+            found = (idx >= 0) & (self.months[idx] > self.months - k)
+            out[found, j] = values[idx[found]]
+        return out
+
+    def first_month(self, known: Optional[pd.Series] = None, property_ids: Optional[np.ndarray] = None) -> np.ndarray:
+        """Sorted first month of every property, earlier months in known (property id -> month) included"""
+        first = self.months[self.first]
+        if known is not None and len(known):
+            earlier = known.reindex(np.asarray(property_ids)[self.order]).to_numpy()
+            first = np.fmin(first, earlier).astype("int64")
+        return first
+
+
+def trend_features(
+    df: pd.DataFrame, months: np.ndarray, first_seen: Optional[pd.Series] = None
+) -> pd.DataFrame:
+    """Trend features of the monthly rows of the properties: occupancy and revenue change over TREND_MONTHS months,
+    ADR volatility (standard deviation) on windows of TREND_MONTHS months and months since the first listing
+
+    Args:
+        df (pd.DataFrame): rows with 'airbnb_property_id', 'occupancy_rate', 'adr_usd' and 'revenue_usd'
+        months (np.ndarray): integer month of every row, see utils.labels.month_index
+        first_seen (Optional[pd.Series], optional): first month of the properties listed before the rows of df,
+            indexed by property id. Defaults to None.
+
+    Returns:
+        pd.DataFrame: the features, aligned with the rows of df
+    """
+    ids = df["airbnb_property_id"].to_numpy()
+    segments = MonthlySegments(ids, months)
+    features = {}
+    for column in ["occupancy_rate", "revenue_usd"]:
+        values = segments.sort(df[column].to_numpy(dtype="float64", na_value=np.nan))
+        name = column.split("_")[0]
+        features[f"{name}_change_{TREND_MONTHS}m"] = values - segments.lag(values, TREND_MONTHS)
+
+    adr = segments.window(segments.sort(df["adr_usd"].to_numpy(dtype="float64", na_value=np.nan)), TREND_MONTHS)
+    n_obs = (~np.isnan(adr)).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nansum(adr, axis=1) / n_obs
+        variance = np.nansum((adr - mean[:, None]) ** 2, axis=1) / (n_obs - 1)
+    features[f"adr_volatility_{TREND_MONTHS}m"] = np.where(n_obs > 1, np.sqrt(variance), np.nan)
+
+    features["months_since_first_seen"] = segments.months - segments.first_month(first_seen, ids)
+    return pd.DataFrame(
+        {name: segments.unsort(values) for name, values in features.items()}, index=df.index
+    )
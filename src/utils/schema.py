@@ -0,0 +1,135 @@
+from typing import Dict, List, Mapping
+
+import pandas as pd
+
+from utils.neighbourhood import get_neighbourhood_dtypes
+from utils.rates import RATE_DTYPE, RATES
+
+# Types of the prepared data, shared by prepare_data (in memory frames and parquet files),
+# the feature views in fs_definition.py and the model preprocessing.
+# Strings with few distinct values are categorical (dictionary encoded in parquet), numbers
+# are downcasted to 32 bits, the only exceptions being ids and coordinates
+
+ENTITY_DTYPES = {"airbnb_property_id": "int64", "event_timestamp": "datetime64[ns]"}
+
+FEATURE_DTYPES = {
+    "df1_feature_view": {
+        "listing_type": "category",
+        "bedrooms": "int32",
+        "bathrooms": "int32",
+    },
+    "df2_feature_view": {
+        "cleaning_fee": "float32",
+        "blocked_days": "int32",
+        "available_days": "int32",
+        "occupancy_rate": "float32",
+        "reservation_days": "int32",
+        "adr_usd": "float32",
+        "number_of_reservation": "int32",
+        "revenue_usd": "int32",
+        # precomputed rates, see utils.rates
+        **{name: RATE_DTYPE for name in RATES},
+    },
+    "df3_feature_view": {
+        "latitude": "float64",
+        "longitude": "float64",
+        "zipcode": "category",
+        "city": "category",
+        "num_neighbours": "int32",
+        "dist_from_bc": "float32",
+    },
+    # trends of the property, see utils.rolling
+    "df4_feature_view": {
+        "occupancy_change_3m": "float32",
+        "revenue_change_3m": "float32",
+        "adr_volatility_3m": "float32",
+        "months_since_first_seen": "int32",
+    },
+    # active neighbours of the same month within every radius, see utils.neighbourhood
+    "df5_feature_view": get_neighbourhood_dtypes(),
+}
+
+# columns of the sources that are not exposed as features of the views
+NOT_FEATURES = {"latitude", "longitude", "zipcode", "city"}
+
+# types of the columns read from the csv files, see utils.io_utils.read_and_rename
+RAW_DTYPES = {
+    "listing_type": "category",
+    "city": "category",
+    "zipcode": "category",
+    "bathrooms": "int32",
+    "blocked_days": "int32",
+    "available_days": "int32",
+    "occupancy_rate": "float32",
+    "reservation_days": "int32",
+    "adr_usd": "float32",
+    "number_of_reservation": "int32",
+    "revenue_usd": "int32",
+}
+
+# features used by the model, in the order of the columns of its input
+MODEL_FEATURES = {
+    "df1_feature_view": ["bedrooms", "bathrooms"],
+    "df2_feature_view": [
+        "cleaning_fee",
+        "available_days",
+        "blocked_days",
+        "occupancy_rate",
+        "reservation_days",
+        "adr_usd",
+        "number_of_reservation",
+        *RATES,
+    ],
+    "df3_feature_view": ["num_neighbours", "dist_from_bc"],
+    "df4_feature_view": [
+        "occupancy_change_3m",
+        "revenue_change_3m",
+        "adr_volatility_3m",
+        "months_since_first_seen",
+    ],
+    "df5_feature_view": list(get_neighbourhood_dtypes()),
+}
+# features that can be computed at retrieval by an on demand view instead of read from the sources
+ON_DEMAND_FEATURES = {"on_demand_rates": list(RATES)}
+# features missing by construction (trends of the properties listed for a short time, aggregates
+# of empty neighbourhoods, rates of zero days), the other ones are missing only for the properties unknown to the feature store
+NULLABLE_FEATURES = (
+    {"occupancy_change_3m", "revenue_change_3m", "adr_volatility_3m"}
+    | {name for name in get_neighbourhood_dtypes() if not name.startswith("active_neighbours")}
+    | set(RATES)
+)
+MODEL_DTYPE = "float32"
+# churn labels, missing when unknown (see utils.labels)
+TARGET_DTYPE = "boolean"
+
+
+def get_feature_fields(view_name: str) -> Dict[str, str]:
+    """Features exposed by a view, with their type"""
+    return {
+        k: v for k, v in FEATURE_DTYPES[view_name].items() if k not in NOT_FEATURES
+    }
+
+
+def get_feature_refs(
+    features: Mapping[str, List[str]] = MODEL_FEATURES, on_demand: bool = False
+) -> List[str]:
+    """Feature references for feast retrieval, e.g. 'df1_feature_view:bedrooms'.
+    With on_demand the ON_DEMAND_FEATURES are referenced from their on demand views"""
+    views = {f: v for v, names in ON_DEMAND_FEATURES.items() for f in names} if on_demand else {}
+    return [
+        f"{views.get(feature, view)}:{feature}" for view, names in features.items() for feature in names
+    ]
+
+
+def get_model_columns() -> List[str]:
+    return [feature for names in MODEL_FEATURES.values() for feature in names]
+
+
+def cast_to_schema(df: pd.DataFrame, dtypes: Mapping[str, str]) -> pd.DataFrame:
+    """Cast the columns of df contained in dtypes, the others are left untouched"""
+    return df.astype({k: v for k, v in dtypes.items() if k in df.columns})
+
+
+def parse_bedrooms(bedrooms: pd.Series) -> pd.Series:
+    """Bedrooms are strings in the csv files because of 'Studio', counted as one bedroom"""
+    return bedrooms.mask(bedrooms == "Studio", "1").astype("int32")
@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Set
+
+import psutil
+from opentelemetry import context, propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import (
+    ConsoleSpanExporter,
+    SimpleSpanProcessor,
+    SpanExporter,
+    SpanExportResult,
+)
+
+log = logging.getLogger("TRACING")
+
+# console, json or none. Environment variables, so that the worker processes get the same exporter.
+# The json file is appended by every span and never rotated, it is written only on demand
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "none")
+TRACE_FILE = os.environ.get(
+    "TRACE_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, ".traces", "spans.jsonl"),
+)
+RSS_INTERVAL_S = 0.05
+METRICS = ["wall_s", "cpu_s", "peak_rss_mb", "rows"]
+MAX_RECORDS = 10000
+
+# measures of the spans ended in this process and not yet logged, in order. The service traces
+# every micro batch: only the last MAX_RECORDS are kept
+RECORDS: Deque[Dict] = deque(maxlen=MAX_RECORDS)
+_records_lock = threading.Lock()
+_provider_lock = threading.Lock()
+_process = psutil.Process()
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """One json object per span appended to a file, readable without a collector"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        lines = "".join(json.dumps(json.loads(s.to_json())) + "\n" for s in spans)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # a single append per batch, the worker processes write the same file
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+        return SpanExportResult.SUCCESS
+
+
+def get_tracer() -> trace.Tracer:
+    """Tracer of the project, the provider is created on first use in every process"""
+    with _provider_lock:
+        if not isinstance(trace.get_tracer_provider(), TracerProvider):
+            provider = TracerProvider(resource=Resource.create({"service.name": "airbnb-bc"}))
+            if TRACE_EXPORTER == "console":
+                provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter(out=sys.stderr)))
+            elif TRACE_EXPORTER == "json":
+                provider.add_span_processor(SimpleSpanProcessor(JsonLinesSpanExporter(TRACE_FILE)))
+            elif TRACE_EXPORTER != "none":
+                raise ValueError(f"unknown TRACE_EXPORTER {TRACE_EXPORTER}")
+            trace.set_tracer_provider(provider)
+    return trace.get_tracer("airbnb-bc")
+
+
+def _rss() -> int:
+    """Resident memory of the process and of its workers"""
+    rss = _process.memory_info().rss
+    for child in _process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def _cpu() -> float:
+    """CPU time of the process with all its threads, of its running workers and of the exited ones"""
+    times = _process.cpu_times()
+    cpu = times.user + times.system + times.children_user + times.children_system
+    for child in _process.children(recursive=True):
+        try:
+            times = child.cpu_times()
+            cpu += times.user + times.system
+        except psutil.Error:
+            pass
+    return cpu
+
+
+class StageSpan:
+    """Measures of a running stage, rows can be set while the stage runs"""
+
+    def __init__(self, span: trace.Span):
+        self.span = span
+        self.rows: Optional[int] = None
+        # the measures, set when the stage ends
+        self.record: Dict = {}
+        self.peak_rss = _rss()
+        _SAMPLER.add(self)
+
+    def stop(self) -> None:
+        _SAMPLER.remove(self)
+        self.peak_rss = max(self.peak_rss, _rss())
+
+
+class RssSampler:
+    """A single thread measuring the RSS every RSS_INTERVAL_S for all the running stages, however
+    many are nested or concurrent. It runs only while some stage is running"""
+
+    def __init__(self):
+        self.stages: Set[StageSpan] = set()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, stage: StageSpan) -> None:
+        with self.lock:
+            self.stages.add(stage)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+                self.thread.start()
+
+    def remove(self, stage: StageSpan) -> None:
+        with self.lock:
+            self.stages.discard(stage)
+
+    def _sample(self) -> None:
+        while True:
+            time.sleep(RSS_INTERVAL_S)
+            rss = _rss()
+            with self.lock:
+                if not self.stages:
+                    self.thread = None
+                    return
+                for stage in self.stages:
+                    stage.peak_rss = max(stage.peak_rss, rss)
+
+
+_SAMPLER = RssSampler()
+
+
+@contextmanager
+def stage_span(name: str, parent: Optional[Dict[str, str]] = None, **attributes) -> Iterator[StageSpan]:
+    """Trace a stage: wall time, CPU time, peak RSS and rows become attributes of an OpenTelemetry span.
+    CPU time and RSS are those of the whole process with its workers, stages running in concurrent
+    threads see each other. The measures are kept in RECORDS until logged, see log_records_to_mlflow
+
+    Args:
+        name (str): name of the stage
+        parent (Optional[Dict[str, str]], optional): context from trace_context() of another process. Defaults to None.
+
+    Yields:
+        StageSpan: set its rows to the number of rows processed
+    """
+    ctx = propagate.extract(parent) if parent is not None else None
+    with get_tracer().start_as_current_span(name, context=ctx, attributes=attributes) as span:
+        stage = StageSpan(span)
+        start_wall, start_cpu = time.perf_counter(), _cpu()
+        try:
+            yield stage
+        finally:
+            stage.stop()
+            record = stage.record = {
+                "name": name,
+                "wall_s": time.perf_counter() - start_wall,
+                "cpu_s": _cpu() - start_cpu,
+                "peak_rss_mb": stage.peak_rss / 2**20,
+                "rows": stage.rows,
+            }
+            span.set_attributes({k: record[k] for k in METRICS if record[k] is not None})
+            with _records_lock:
+                RECORDS.append(record)
+            log.debug(record)
+
+
+def trace_context() -> Dict[str, str]:
+    """Current span as a picklable carrier, to parent the spans of worker processes"""
+    carrier: Dict[str, str] = {}
+    propagate.inject(carrier, context=context.get_current())
+    return carrier
+
+
+def log_records_to_mlflow(records: Optional[List[Dict]] = None) -> None:
+    """Log measures of ended stages as metrics of the active mlflow run, "<stage>.wall_s" and so on.
+    Repeated stages get increasing steps
+
+    Args:
+        records (Optional[List[Dict]], optional): defaults to all the stages ended in this process
+            and not yet logged, which are then removed from RECORDS.
+    """
+    import mlflow
+
+    with _records_lock:
+        if records is None:
+            records = list(RECORDS)
+            RECORDS.clear()
+        else:
+            records = list(records)
+    steps: Dict[str, int] = {}
+    for record in records:
+        step = steps.get(record["name"], 0)
+        steps[record["name"]] = step + 1
+        mlflow.log_metrics(
+            {f"{record['name']}.{k}": record[k] for k in METRICS if record[k] is not None},
+            step=step,
+        )
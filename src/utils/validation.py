@@ -0,0 +1,196 @@
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+# columns identifying the offending rows in the report, when present
+KEY_COLUMNS = ["airbnb_property_id", "event_timestamp"]
+
+
+class Expectation(NamedTuple):
+    """Values of column in [min_value, max_value] for at least a share `mostly` of the rows,
+    as expect_column_values_to_be_between of great expectations: missing values are not checked
+    """
+
+    column: str
+    min_value: Optional[float] = None
+    max_value: Optional[float] = None
+    mostly: float = 1.0
+
+    def check(self, values: np.ndarray) -> np.ndarray:
+        """Boolean mask of the checked values out of range"""
+        failed = np.zeros(len(values), dtype=bool)
+        if self.min_value is not None:
+            failed |= values < self.min_value
+        if self.max_value is not None:
+            failed |= values > self.max_value
+        return failed
+
+
+class ExpectationResult(NamedTuple):
+    expectation: Expectation
+    checked: int
+    failed: int
+
+    @property
+    def success_ratio(self) -> float:
+        return 1 - self.failed / self.checked if self.checked else 1.0
+
+    @property
+    def success(self) -> bool:
+        return self.success_ratio >= self.expectation.mostly
+
+
+class ValidationReport(NamedTuple):
+    """Outcome of every expectation, on all the rows or on a uniform sample of them.
+    offending_rows holds the rows failing at least one expectation (at most max_offending_rows),
+    indexed by their position in the input, with a boolean column failed_<column> per expectation
+    """
+
+    results: List[ExpectationResult]
+    offending_rows: pd.DataFrame
+    rows: int
+    sampled: bool
+
+    @property
+    def success(self) -> bool:
+        return all(r.success for r in self.results)
+
+    def summary(self) -> str:
+        lines = [
+            f"{'sample of ' if self.sampled else ''}{self.rows} rows: "
+            f"{'success' if self.success else 'FAILED'}"
+        ]
+        for r in self.results:
+            e = r.expectation
+            lines.append(
+                f"  {e.column} in [{e.min_value}, {e.max_value}]: {r.failed} of {r.checked} out of range, "
+                f"{r.success_ratio:.4f} >= {e.mostly} {'ok' if r.success else 'FAILED'}"
+            )
+        return "\n".join(lines)
+
+
+def failed_rows(df: pd.DataFrame, expectations: Sequence[Expectation]) -> np.ndarray:
+    """Boolean mask of the rows of df out of range for at least one expectation, missing values are not checked"""
+    failed = np.zeros(len(df), dtype=bool)
+    for e in expectations:
+        failed |= e.check(df[e.column].to_numpy(dtype="float64", na_value=np.nan))
+    return failed
+
+
+def _iter_frames(
+    data: Union[pd.DataFrame, str], columns: List[str], batch_size: int
+) -> Iterator[pd.DataFrame]:
+    """The columns of a frame or of a parquet dataset, batch_size rows at a time, indexed by row position"""
+    offset = 0
+    if isinstance(data, pd.DataFrame):
+        batches: Iterable = (
+            data.iloc[i : i + batch_size][columns] for i in range(0, len(data), batch_size)
+        )
+    else:
+        batches = (
+            b.to_pandas()
+            for b in ds.dataset(data, format="parquet").to_batches(
+                columns=columns, batch_size=batch_size
+            )
+        )
+    for frame in batches:
+        yield frame.set_axis(pd.RangeIndex(offset, offset + len(frame)))
+        offset += len(frame)
+
+
+def reservoir_sample(
+    frames: Iterable[pd.DataFrame], k: int, seed: int = 0
+) -> Optional[pd.DataFrame]:
+    """Uniform sample without replacement of k rows of a stream of frames, in a single pass and with
+    at most k + len(frame) rows in memory. Every row gets a random priority and the k rows with the
+    lowest ones are kept (reservoir sampling with priorities), one frame at a time
+
+    Args:
+        frames (Iterable[pd.DataFrame]): frames with the same columns
+        k (int): size of the sample
+
+    Returns:
+        Optional[pd.DataFrame]: the sample, in stream order and with the index of the frames. None if there is no frame
+    """
+    rng = np.random.default_rng(seed)
+    sample, keys = None, np.empty(0)
+    for frame in frames:
+        frame_keys = rng.random(len(frame))
+        if len(keys) == k:
+            # only the rows beating the worst of the reservoir can enter it
+            better = frame_keys < keys.max()
+            frame, frame_keys = frame[better], frame_keys[better]
+        sample = frame if sample is None else pd.concat([sample, frame])
+        keys = np.concatenate([keys, frame_keys])
+        if len(keys) > k:
+            keep = np.sort(np.argpartition(keys, k)[:k])
+            sample, keys = sample.iloc[keep], keys[keep]
+    return sample
+
+
+def validate(
+    data: Union[pd.DataFrame, str],
+    expectations: Sequence[Expectation],
+    sample_size: Optional[int] = None,
+    max_offending_rows: int = 1000,
+    batch_size: int = 1 << 16,
+    seed: int = 0,
+) -> ValidationReport:
+    """Check the expectations on a materialized frame or on a parquet dataset, read a batch at a time.
+    The checks are vectorized over the columns, with sample_size only a uniform sample of the rows
+    is checked
+
+    Args:
+        data (Union[pd.DataFrame, str]): the frame, or the path of a parquet file or dataset
+        expectations (Sequence[Expectation]): the checks
+        sample_size (Optional[int], optional): rows of the sample, None to check all the rows. Defaults to None.
+        max_offending_rows (int, optional): offending rows kept in the report. Defaults to 1000.
+
+    Returns:
+        ValidationReport: counts of the checked and failed values, with the offending rows
+    """
+    checked_columns = list(dict.fromkeys(e.column for e in expectations))
+    if isinstance(data, pd.DataFrame):
+        available = data.columns
+    else:
+        available = ds.dataset(data, format="parquet").schema.names
+    columns = [c for c in KEY_COLUMNS if c in available and c not in checked_columns]
+    columns += checked_columns
+
+    frames: Iterable[pd.DataFrame] = _iter_frames(data, columns, batch_size)
+    if sample_size is not None:
+        sample = reservoir_sample(frames, sample_size, seed)
+        frames = [] if sample is None else [sample]
+
+    rows = 0
+    checked = np.zeros(len(expectations), dtype="int64")
+    failed = np.zeros(len(expectations), dtype="int64")
+    offending: List[pd.DataFrame] = []
+    n_offending = 0
+    for frame in frames:
+        rows += len(frame)
+        masks = {}
+        for i, e in enumerate(expectations):
+            values = frame[e.column].to_numpy(dtype="float64", na_value=np.nan)
+            present = ~np.isnan(values)
+            mask = e.check(values[present])
+            checked[i] += present.sum()
+            failed[i] += mask.sum()
+            column_failed = masks.setdefault(f"failed_{e.column}", np.zeros(len(frame), dtype=bool))
+            column_failed[present] |= mask
+        any_failed = np.logical_or.reduce(list(masks.values()))
+        if any_failed.any() and n_offending < max_offending_rows:
+            bad = frame[any_failed].assign(**{k: v[any_failed] for k, v in masks.items()})
+            offending.append(bad.iloc[: max_offending_rows - n_offending])
+            n_offending += len(offending[-1])
+
+    return ValidationReport(
+        results=[
+            ExpectationResult(e, int(c), int(f)) for e, c, f in zip(expectations, checked, failed)
+        ],
+        offending_rows=pd.concat(offending) if offending else pd.DataFrame(columns=columns),
+        rows=rows,
+        sampled=sample_size is not None,
+    )
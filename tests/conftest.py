@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the scripts run from src and import the package utils as a top level package
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+sys.path.insert(0, os.path.realpath(SRC_DIR))
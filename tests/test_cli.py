@@ -0,0 +1,104 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+SRC_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+HEAVY_MODULES = ["feast", "mlflow", "sklearn"]
+# loose, the imports of feast, mlflow and sklearn together take several seconds
+MAX_STARTUP_S = 10
+
+ARGUMENTS = [
+    ["prepare-data", "MalibuPerformanceData.csv", "--incremental"],
+    ["prepare-training"],
+    ["train", "--search", "halving", "--budget-s", "600", "--resume"],
+    ["inference", "--batch"],
+    ["serve", "--port", "8001", "--materialize"],
+    ["load-test", "--requests", "10"],
+    ["pipeline", "train", "--force", "all"],
+]
+
+# import time of the module of every command, about 2.5 times the one measured on a single cpu.
+# prepare-training and serve import feast, train and load-test sklearn and mlflow
+# (see also the startup_* benchmarks)
+IMPORT_BUDGET_S = {
+    "prepare-data": 3,
+    "prepare-training": 12,
+    "train": 8,
+    "inference": 3,
+    "serve": 15,
+    "load-test": 4,
+    "pipeline": 1,
+}
+
+# imported in a fresh interpreter, the modules already imported by pytest would hide the heavy ones
+PARSE_ARGUMENTS = """
+import json, sys
+import cli
+
+parser = cli.build_parser()
+commands = [parser.parse_args(argv).command for argv in json.loads(sys.argv[1])]
+print(json.dumps({"commands": commands, "modules": sorted(m for m in sys.modules if "." not in m)}))
+"""
+
+# the import of the command as traced by cli.load_command
+LOAD_COMMAND = """
+import sys
+import cli
+from utils.tracing import RECORDS
+
+cli.load_command(sys.argv[1])
+print([r["wall_s"] for r in RECORDS if r["name"] == "cli.startup"][-1])
+"""
+
+
+def run_python(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+        timeout=120,
+        env={**os.environ, "TRACE_EXPORTER": "none"},
+    )
+
+
+def test_parsing_imports_no_heavy_module():
+    start = time.perf_counter()
+    result = run_python("-c", PARSE_ARGUMENTS, json.dumps(ARGUMENTS))
+    elapsed = time.perf_counter() - start
+
+    assert result.returncode == 0, result.stderr
+    parsed = json.loads(result.stdout.splitlines()[-1])
+    assert parsed["commands"] == [argv[0] for argv in ARGUMENTS]
+    assert not set(HEAVY_MODULES) & set(parsed["modules"])
+    assert elapsed < MAX_STARTUP_S
+
+
+@pytest.mark.parametrize("argv", [["--help"], ["train", "--help"], ["inference", "--bad-flag"]])
+def test_help_and_errors_are_immediate(argv):
+    start = time.perf_counter()
+    result = run_python("cli.py", *argv)
+    elapsed = time.perf_counter() - start
+
+    assert result.returncode == (2 if "--bad-flag" in argv else 0), result.stderr
+    assert "usage:" in (result.stdout + result.stderr)
+    assert elapsed < MAX_STARTUP_S
+
+
+def test_every_command_is_budgeted():
+    import cli
+
+    assert set(IMPORT_BUDGET_S) == set(cli.COMMANDS)
+
+
+@pytest.mark.parametrize("command", list(IMPORT_BUDGET_S))
+def test_command_import_time(command):
+    result = run_python("-c", LOAD_COMMAND, command)
+
+    assert result.returncode == 0, result.stderr
+    import_s = float(result.stdout.splitlines()[-1])
+    assert import_s < IMPORT_BUDGET_S[command], f"{command} imported in {import_s:.2f}s"
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+
+from train_model import PreprocessDF
+from utils.compiled_forest import MAX_BATCH_ROWS, CompiledForest
+from utils.schema import get_model_columns
+
+N_ROWS = 2000
+
+
+def make_features(n_rows: int, seed: int) -> pd.DataFrame:
+    """Random model columns with about 10% of missing values"""
+    rng = np.random.default_rng(seed)
+    values = rng.random((n_rows, len(get_model_columns())), dtype="float32")
+    values[rng.random(values.shape) < 0.1] = np.nan
+    return pd.DataFrame(values, columns=get_model_columns())
+
+
+@pytest.fixture(scope="module")
+def model() -> Pipeline:
+    # trained with missing values, so that the trees learn where to send them
+    features = make_features(N_ROWS, seed=0)
+    target = features.iloc[:, 0].fillna(0.5) + np.random.default_rng(1).random(N_ROWS) > 0.9
+    return Pipeline(
+        steps=[
+            ("preprocess", PreprocessDF()),
+            ("classifier", RandomForestClassifier(n_estimators=10, random_state=0)),
+        ]
+    ).fit(features, target)
+
+
+def test_trees_learned_the_missing_values(model):
+    assert CompiledForest.from_pipeline(model).missing_go_to_left.any()
+
+
+@pytest.mark.parametrize(
+    "n_rows", [1, MAX_BATCH_ROWS - 1, MAX_BATCH_ROWS, MAX_BATCH_ROWS + 1, N_ROWS]
+)
+def test_probabilities_are_identical_to_sklearn(model, n_rows):
+    compiled = CompiledForest.from_pipeline(model)
+    features = make_features(n_rows, seed=2)
+
+    expected = model.predict_proba(features)
+    assert np.array_equal(compiled.predict_proba(features), expected)
+    # the matrix already in the order of the model columns
+    assert np.array_equal(compiled.predict_proba(features.to_numpy()), expected)
+    assert np.array_equal(compiled.predict(features), model.predict(features))
+
+
+def test_saved_forest_predicts_the_same(model, tmp_path):
+    path = str(tmp_path / "forest.npz")
+    CompiledForest.from_pipeline(model).save(path)
+    compiled = CompiledForest.load(path)
+
+    features = make_features(N_ROWS, seed=3)
+    assert np.array_equal(compiled.predict_proba(features), model.predict_proba(features))
+    assert list(compiled.classes_) == list(model.classes_)
@@ -0,0 +1,146 @@
+import math
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.geo_processing_utils import (
+    convert_to_cartesian,
+    euclidean_distance,
+    get_num_neighbours,
+    update_geo_state,
+    get_geo_features_from_state,
+)
+
+GEO_ID = "airbnb_property_id"
+# around the center of Brighton
+LAT, LON = 50.8225, -0.1372
+
+
+def reference_num_neighbours(
+    df: pd.DataFrame, GEO_ID: Optional[str] = "GEO_ID", radius: float = 0.1
+) -> pd.DataFrame:
+    """The original all-pairs implementation of get_num_neighbours, with the radius as argument"""
+    geo_df = df[[GEO_ID, "latitude", "longitude"]].drop_duplicates()
+    geo_df["cartesian_coordinates"] = [
+        _scalar_cartesian(*a) for a in zip(geo_df["latitude"], geo_df["longitude"])
+    ]
+    coord_set = np.vstack(geo_df["cartesian_coordinates"].drop_duplicates().values)
+    geo_df["num_neighbours"] = geo_df["cartesian_coordinates"].apply(
+        lambda x: len(
+            [d for d in [euclidean_distance(x, cs) for cs in coord_set] if d < radius]
+        )
+        - 1
+    )
+    return pd.merge(df, geo_df[[GEO_ID, "num_neighbours"]], on=GEO_ID, how="left")
+
+
+def _scalar_cartesian(lat: float, lon: float):
+    R = 6371
+    x = R * math.cos(math.radians(lat)) * math.cos(math.radians(lon))
+    y = R * math.cos(math.radians(lat)) * math.sin(math.radians(lon))
+    return (x, y)
+
+
+def _distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    return euclidean_distance(_scalar_cartesian(lat1, lon1), _scalar_cartesian(lat2, lon2))
+
+
+def _boundary_longitudes(lat: float, lon: float, radius: float) -> List[float]:
+    """The two consecutive longitudes east of lon around which the distance reaches radius:
+    the last one still closer than radius and the first one that is not"""
+    inside, outside = lon, lon + 1.0
+    while np.nextafter(inside, outside) != outside:
+        mid = (inside + outside) / 2
+        if mid in (inside, outside):
+            mid = np.nextafter(inside, outside)
+        if _distance(lat, lon, lat, mid) < radius:
+            inside = mid
+        else:
+            outside = mid
+    return [inside, outside]
+
+
+def make_properties(radius: float, seed: int = 0) -> pd.DataFrame:
+    """Dense random properties with shared locations, repeated monthly rows and
+    pairs of points exactly around the radius"""
+    rng = np.random.default_rng(seed)
+    n = 300
+    # a few km wide, so that every point has some neighbours
+    lat = LAT + rng.normal(0, 0.004, n)
+    lon = LON + rng.normal(0, 0.006, n)
+    ids = np.arange(n)
+
+    # different properties at the very same location
+    shared = rng.choice(n, 30, replace=False)
+    lat = np.concatenate([lat, lat[shared]])
+    lon = np.concatenate([lon, lon[shared]])
+    ids = np.concatenate([ids, np.arange(n, n + len(shared))])
+
+    # points at the radius from some of the others, on both sides of the boundary
+    for i, anchor in enumerate(rng.choice(n, 10, replace=False)):
+        for boundary_lon in _boundary_longitudes(lat[anchor], lon[anchor], radius):
+            lat = np.append(lat, lat[anchor])
+            lon = np.append(lon, boundary_lon)
+            ids = np.append(ids, ids.max() + 1)
+
+    df = pd.DataFrame({GEO_ID: ids, "latitude": lat, "longitude": lon})
+    # every property is listed for a few months
+    months = rng.integers(1, 4, len(df))
+    df = df.loc[df.index.repeat(months)].reset_index(drop=True)
+    df["reporting_month"] = df.groupby(GEO_ID).cumcount()
+    return df
+
+
+@pytest.mark.parametrize("radius", [0.1, 0.35])
+def test_num_neighbours_matches_reference(radius):
+    df = make_properties(radius)
+
+    expected = reference_num_neighbours(df, GEO_ID, radius=radius)
+    result = get_num_neighbours(df, GEO_ID, radius=radius)
+
+    assert result["num_neighbours"].dtype == expected["num_neighbours"].dtype == "int64"
+    pd.testing.assert_frame_equal(result, expected)
+    # the boundary pairs are split, the duplicates counted once
+    assert expected["num_neighbours"].nunique() > 5
+
+
+def test_boundary_points_are_excluded():
+    radius = 0.1
+    inside, outside = _boundary_longitudes(LAT, LON, radius)
+    df = pd.DataFrame(
+        {
+            GEO_ID: [0, 1, 2],
+            "latitude": [LAT, LAT, LAT],
+            "longitude": [LON, inside, outside],
+        }
+    )
+    result = get_num_neighbours(df, GEO_ID, radius=radius)
+
+    assert result["num_neighbours"].tolist() == [1, 2, 1]
+    pd.testing.assert_frame_equal(result, reference_num_neighbours(df, GEO_ID, radius=radius))
+
+
+def test_cartesian_arrays_match_scalars():
+    df = make_properties(0.1)
+    x, y = convert_to_cartesian(df["latitude"].values, df["longitude"].values)
+    expected = np.array([_scalar_cartesian(*a) for a in zip(df["latitude"], df["longitude"])])
+
+    # np.cos and np.sin can differ from the C library in the last bit
+    np.testing.assert_allclose(np.column_stack([x, y]), expected, rtol=1e-12)
+
+
+def test_incremental_counts_match_reference():
+    radius = 0.1
+    df = make_properties(radius, seed=1)
+    ids = df[GEO_ID].unique()
+    first, second = df[df[GEO_ID].isin(ids[::2])], df[df[GEO_ID].isin(ids[1::2])]
+
+    geo_state = update_geo_state(first, GEO_ID=GEO_ID, radius=radius)
+    geo_state = update_geo_state(second, geo_state, GEO_ID=GEO_ID, radius=radius)
+    result = get_geo_features_from_state(df, geo_state, GEO_ID=GEO_ID)
+
+    expected = reference_num_neighbours(df, GEO_ID, radius=radius)
+    np.testing.assert_array_equal(result["num_neighbours"].values, expected["num_neighbours"].values)
+    assert result["num_neighbours"].dtype == "int64"
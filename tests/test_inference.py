@@ -0,0 +1,135 @@
+import os
+
+import cloudpickle
+import numpy as np
+import pandas as pd
+import pytest
+import sklearn
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+
+import inference
+import utils.model_utils
+import utils.pit_join
+from train_model import PreprocessDF
+from utils.config import load_config
+from utils.schema import get_model_columns
+from utils.validation import failed_rows
+
+RUN_ID = "0123456789abcdef"
+N_ROWS = 1000
+MONTHS = pd.date_range("2023-01-01", periods=2, freq="MS")
+
+
+class FakeRetrievalJob:
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+    def to_df(self) -> pd.DataFrame:
+        return self.df
+
+
+class FakeFeatureStore:
+    """Only the saved dataset of inference, written where main reads it back"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def create_saved_dataset(self, from_, **kwargs):
+        from_.to_df().to_parquet(self.path, index=False)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """Inference on random features, with the model already in the model cache and the data,
+    the caches and the mlflow runs in tmp_path. Most of the properties have more than one
+    bathroom, so the validation fails"""
+    config = dict(
+        load_config(),
+        OUT_DATA_DIR=str(tmp_path / "data"),
+        MODEL_CACHE_DIR=str(tmp_path / "models"),
+        MATRIX_CACHE_DIR=str(tmp_path / "matrices"),
+        # a few record batches, large enough for the sklearn model
+        SCORING_BATCH_ROWS=256,
+        SCORING_WORKERS=2,
+        VALIDATION_SAMPLE_SIZE=None,
+    )
+    os.makedirs(config["OUT_DATA_DIR"])
+    monkeypatch.setattr(inference, "load_config", lambda: config)
+    # the spawned scoring workers read it at import
+    monkeypatch.setenv("TRACE_EXPORTER", "none")
+
+    rng = np.random.default_rng(0)
+    features = pd.DataFrame(
+        rng.random((N_ROWS, len(get_model_columns())), dtype="float32"),
+        columns=get_model_columns(),
+    )
+    features["bathrooms"] = rng.integers(1, 4, N_ROWS)
+    features["available_days"] = rng.integers(1, 32, N_ROWS)
+    features["num_neighbours"] = rng.integers(0, 20, N_ROWS)
+    features.insert(0, "airbnb_property_id", np.arange(N_ROWS))
+    features.insert(1, "event_timestamp", MONTHS[np.arange(N_ROWS) % len(MONTHS)])
+    features[["airbnb_property_id", "event_timestamp"]].to_parquet(
+        os.path.join(config["OUT_DATA_DIR"], config["TESTDF"])
+    )
+
+    model = Pipeline(
+        steps=[
+            ("preprocess", PreprocessDF()),
+            ("classifier", RandomForestClassifier(n_estimators=5, random_state=0)),
+        ]
+    ).fit(features, rng.random(N_ROWS) < 0.8)
+    os.makedirs(config["MODEL_CACHE_DIR"])
+    with open(
+        os.path.join(config["MODEL_CACHE_DIR"], f"{RUN_ID}-sklearn{sklearn.__version__}.pkl"), "wb"
+    ) as f:
+        cloudpickle.dump(model, f)
+
+    inference_ds_path = os.path.join(config["OUT_DATA_DIR"], "my_inference_ds.parquet")
+    monkeypatch.setattr(inference, "get_feast_fs", lambda: FakeFeatureStore(inference_ds_path))
+    monkeypatch.setattr(
+        utils.pit_join,
+        "get_historical_features",
+        lambda fs, **kwargs: FakeRetrievalJob(features),
+    )
+    monkeypatch.setattr(utils.model_utils, "get_model_run_id", lambda experiment_name: RUN_ID)
+    monkeypatch.setattr(utils.model_utils, "TRACKING_URI", (tmp_path / "mlruns").as_uri())
+    return config, features, model
+
+
+def test_batch_inference_writes_predictions(project):
+    config, features, model = project
+
+    inference.main(batch=True)
+
+    # the failed validation is reported, only the valid properties are scored
+    assert os.path.exists(
+        os.path.join(config["OUT_DATA_DIR"], "my_inference_ds_invalid_rows.parquet")
+    )
+    features = features[~failed_rows(features, inference.EXPECTATIONS)]
+    assert 0 < len(features) < N_ROWS
+    predictions = pd.read_parquet(os.path.join(config["OUT_DATA_DIR"], config["PREDICTIONS"]))
+    predictions = predictions.sort_values("airbnb_property_id").reset_index(drop=True)
+    assert (predictions["airbnb_property_id"].to_numpy() == features["airbnb_property_id"]).all()
+    assert (predictions["model_run_id"].astype(str) == RUN_ID).all()
+    assert set(predictions["month"].astype(str)) == {"2023-01", "2023-02"}
+    churn_class = list(model.classes_).index(False)
+    np.testing.assert_allclose(
+        predictions["churn_probability"],
+        model.predict_proba(features)[:, churn_class],
+        rtol=1e-6,
+    )
+
+
+def test_inference_predicts_from_the_feature_matrix(project, caplog):
+    config, features, model = project
+
+    with caplog.at_level("INFO", logger="INFERENCE"):
+        inference.main()
+
+    invalid = failed_rows(features, inference.EXPECTATIONS)
+    assert f"{invalid.sum()} of {N_ROWS} rows are out of range" in caplog.text
+    # the model columns of the valid rows, mapped from the matrix cache
+    assert [f for f in os.listdir(config["MATRIX_CACHE_DIR"]) if f.endswith(".npy")]
+    leaving = (~model.predict(features[~invalid])).sum()
+    assert f"{leaving} of {(~invalid).sum()} properties predicted to leave" in caplog.text
@@ -0,0 +1,79 @@
+from typing import Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils.labels
+from utils.labels import churn_labels, get_target_columns, month_index
+
+HORIZONS = [1, 3, 6]
+
+
+def reference_labels(
+    property_ids: np.ndarray, months: np.ndarray, horizons: Sequence[int], cutoff: Optional[int] = None
+) -> pd.DataFrame:
+    """Label of every row from the set of months of its property, one row at a time"""
+    cutoff = months.max() if cutoff is None else cutoff
+    listed = {}
+    for property_id, month in zip(property_ids, months):
+        listed.setdefault(property_id, set()).add(month)
+    labels = {column: [] for column in get_target_columns(horizons)}
+    for property_id, month in zip(property_ids, months):
+        for k, column in zip(horizons, get_target_columns(horizons)):
+            labels[column].append(None if month + k > cutoff else month + k in listed[property_id])
+    return pd.DataFrame({c: pd.array(v, dtype="boolean") for c, v in labels.items()})
+
+
+def make_rows(n_properties: int = 50, n_months: int = 24, seed: int = 0):
+    """Properties listed in random months, with gaps, in no particular order"""
+    rng = np.random.default_rng(seed)
+    listed = rng.random((n_properties, n_months)) < 0.6
+    property_ids, months = np.nonzero(listed)
+    order = rng.permutation(len(months))
+    # sparse ids, and months far from zero
+    return property_ids[order] * 1000 + 7, months[order] + month_index(pd.Series(["2022-01"]))[0]
+
+
+@pytest.fixture(params=["grid", "hash"])
+def lookup(request, monkeypatch):
+    # the presence grid is used up to MAX_GRID_CELLS_PER_ROW cells per row
+    monkeypatch.setattr(
+        utils.labels, "MAX_GRID_CELLS_PER_ROW", 10**6 if request.param == "grid" else 0
+    )
+    return request.param
+
+
+@pytest.mark.parametrize("cutoff_offset", [None, 0, -2])
+def test_labels_match_reference(lookup, cutoff_offset):
+    property_ids, months = make_rows()
+    cutoff = None if cutoff_offset is None else months.max() + cutoff_offset
+
+    result = churn_labels(property_ids, months, HORIZONS, cutoff=cutoff)
+
+    pd.testing.assert_frame_equal(result, reference_labels(property_ids, months, HORIZONS, cutoff))
+
+
+def test_gaps_and_last_months(lookup):
+    # listed in 2023-01, 02, 04 and 07, the data ends in 2023-07
+    months = month_index(pd.Series(["2023-01", "2023-02", "2023-04", "2023-07"]))
+    property_ids = np.zeros(len(months), dtype="int64")
+
+    result = churn_labels(property_ids, months, HORIZONS)
+
+    # a missing month is not listed, even if the property comes back later
+    expected = {
+        "target_1m": [True, False, False, None],
+        # 2023-04 + 3 and 2023-01 + 6 are the cutoff itself, it is still observed
+        "target_3m": [True, False, True, None],
+        "target_6m": [True, None, None, None],
+    }
+    pd.testing.assert_frame_equal(
+        result, pd.DataFrame({c: pd.array(v, dtype="boolean") for c, v in expected.items()})
+    )
+
+
+def test_no_rows():
+    result = churn_labels(np.array([], dtype="int64"), np.array([], dtype="int64"), HORIZONS)
+    assert list(result.columns) == get_target_columns(HORIZONS)
+    assert len(result) == 0
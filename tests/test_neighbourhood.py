@@ -0,0 +1,142 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.geo_processing_utils import _distances, convert_to_cartesian
+from utils.neighbourhood import (
+    NEIGHBOURHOOD_RADII_KM,
+    REVENUE_QUANTILES,
+    get_neighbourhood_dtypes,
+    get_neighbourhood_features,
+    month_neighbourhood,
+)
+
+# around the center of Brighton
+LAT, LON = 50.8225, -0.1372
+
+
+def _coords(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    return np.column_stack(convert_to_cartesian(np.asarray(lat), np.asarray(lon)))
+
+
+def _boundary_longitudes(radius: float) -> List[float]:
+    """The two consecutive longitudes east of LON around which the distance from (LAT, LON)
+    reaches radius: the last one still closer than radius and the first one that is not"""
+    inside, outside = LON, LON + 1.0
+    while np.nextafter(inside, outside) != outside:
+        mid = (inside + outside) / 2
+        if mid in (inside, outside):
+            mid = np.nextafter(inside, outside)
+        if _distances(_coords([LAT], [LON]), _coords([LAT], [mid]))[0] < radius:
+            inside = mid
+        else:
+            outside = mid
+    return [inside, outside]
+
+
+def reference_features(df: pd.DataFrame, radii=NEIGHBOURHOOD_RADII_KM) -> pd.DataFrame:
+    """All the pairs of properties of every month, one property at a time"""
+    coords = _coords(df["latitude"], df["longitude"])
+    rows = []
+    for i in range(len(df)):
+        month = (df["reporting_month"] == df["reporting_month"].iloc[i]).to_numpy()
+        month[i] = False
+        others = np.flatnonzero(month)
+        dist = _distances(np.repeat(coords[i : i + 1], len(others), axis=0), coords[others])
+        row = []
+        for radius in radii:
+            close = others[dist < radius]
+            row.append(len(close))
+            row.append(np.nanmean(df["adr_usd"].to_numpy()[close]) if len(close) else np.nan)
+            row.append(np.nanmean(df["occupancy_rate"].to_numpy()[close]) if len(close) else np.nan)
+            for q in REVENUE_QUANTILES:
+                revenue = df["revenue_usd"].to_numpy()[close]
+                row.append(np.quantile(revenue, q) if len(close) else np.nan)
+        rows.append(row)
+    dtypes = get_neighbourhood_dtypes(radii)
+    return pd.DataFrame(rows, columns=list(dtypes), index=df.index).astype(dtypes)
+
+
+def make_months(seed: int = 0) -> pd.DataFrame:
+    """Three months of properties within about a km, points just inside and just outside both
+    radii from the first property, and a month with a single listing"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for month in ["2023-01", "2023-02", "2023-03"]:
+        n = 80
+        frames.append(
+            pd.DataFrame(
+                {
+                    "reporting_month": month,
+                    "latitude": LAT + rng.normal(0, 0.003, n),
+                    "longitude": LON + rng.normal(0, 0.005, n),
+                }
+            )
+        )
+    boundary = [LON] + [lon for radius in NEIGHBOURHOOD_RADII_KM for lon in _boundary_longitudes(radius)]
+    frames.append(
+        pd.DataFrame({"reporting_month": "2023-03", "latitude": LAT, "longitude": boundary})
+    )
+    frames.append(pd.DataFrame({"reporting_month": ["2023-04"], "latitude": [LAT], "longitude": [LON]}))
+    df = pd.concat(frames, ignore_index=True)
+    df["adr_usd"] = rng.random(len(df)) * 200
+    df["occupancy_rate"] = rng.random(len(df))
+    df.loc[rng.random(len(df)) < 0.1, ["adr_usd", "occupancy_rate"]] = np.nan
+    # ties in the revenue too
+    df["revenue_usd"] = rng.integers(0, 50, len(df)).astype("float64") * 100
+    # shuffled, with an index that is not a range
+    df = df.sample(frac=1, random_state=seed)
+    df.index = df.index * 3 + 1
+    return df
+
+
+# some properties have only neighbours without ADR
+@pytest.mark.filterwarnings("ignore:Mean of empty slice:RuntimeWarning")
+def test_features_match_all_pairs():
+    df = make_months()
+
+    result = get_neighbourhood_features(df)
+
+    expected = reference_features(df)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-6)
+    # the single listing of its month has no neighbours
+    single = df["reporting_month"] == "2023-04"
+    assert (result.loc[single, "active_neighbours_100m"] == 0).all()
+    assert result.loc[single, "neighbours_revenue_p50_500m"].isna().all()
+
+
+@pytest.mark.parametrize("radius", NEIGHBOURHOOD_RADII_KM)
+def test_points_at_the_radius(radius):
+    inside, outside = _boundary_longitudes(radius)
+    df = pd.DataFrame(
+        {
+            "reporting_month": "2023-01",
+            "latitude": LAT,
+            "longitude": [LON, inside, outside],
+            "adr_usd": 100.0,
+            "occupancy_rate": 0.5,
+            "revenue_usd": 1000.0,
+        }
+    )
+
+    result = get_neighbourhood_features(df, radii=[radius])
+
+    label = f"{round(radius * 1000)}m"
+    # the distance must be strictly smaller than the radius
+    assert result[f"active_neighbours_{label}"].tolist() == [1, 2, 1]
+    pd.testing.assert_frame_equal(result, reference_features(df, radii=[radius]))
+
+
+def test_tiles_do_not_change_the_features():
+    df = make_months()
+    df = df[df["reporting_month"] == "2023-03"]
+    coords = _coords(df["latitude"], df["longitude"])
+    arrays = [df[c].to_numpy() for c in ["adr_usd", "occupancy_rate", "revenue_usd"]]
+
+    whole = month_neighbourhood(coords, *arrays)
+    tiled = month_neighbourhood(coords, *arrays, tile_size=7)
+
+    for name, values in whole.items():
+        np.testing.assert_array_equal(tiled[name], values, err_msg=name)
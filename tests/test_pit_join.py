@@ -0,0 +1,313 @@
+import os
+from datetime import timedelta
+from typing import List
+
+import numpy as np
+import pandas as pd
+import pytest
+from feast import Entity, FeatureStore, FeatureView, Field, FileSource
+from feast.on_demand_feature_view import on_demand_feature_view
+from feast.repo_config import RepoConfig
+from feast.types import Float32, Float64, Int64
+
+from utils.io_utils import write_partitioned
+from utils.pit_join import AsOfRetrievalJob, MONTH_PARTITION, get_historical_features
+from utils.registry import FEATURE_REPO, get_feature_store
+from utils.schema import get_feature_refs
+
+KEY = "airbnb_property_id"
+START = pd.Timestamp("2023-01-01")
+MONTHS = pd.date_range(START, periods=6, freq="MS")
+N_PROPERTIES = 40
+# every view of the repo, the on demand one excluded
+FEATURES = [
+    "occupancy:occupancy_rate",
+    "occupancy:revenue",
+    "listing:bedrooms",
+    "listing:cleaning_fee",
+    "location:num_neighbours",
+]
+
+
+def _source_rows(rng: np.random.Generator, share: float) -> pd.DataFrame:
+    """A row per property and month, for a random share of them"""
+    df = pd.DataFrame(
+        [(i, month) for i in range(N_PROPERTIES) for month in MONTHS],
+        columns=[KEY, "event_timestamp"],
+    )
+    return df[rng.random(len(df)) < share].reset_index(drop=True)
+
+
+def on_demand_occupancy(input_df: pd.DataFrame) -> pd.DataFrame:
+    return pd.DataFrame({"occupied_revenue": input_df["occupancy_rate"] * input_df["revenue"]})
+
+
+def make_feature_store(
+    repo_path: str, seed: int = 0, ties: bool = False, on_demand: bool = False
+) -> FeatureStore:
+    """Three file sources as the ones of the project: a single file with creation timestamps
+    (and ties, rows with the same timestamp), a dataset partitioned by month and a source with no ttl.
+    With on_demand, an on demand view of the first one"""
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(repo_path, "data")
+    os.makedirs(data_dir)
+
+    occupancy = _source_rows(rng, 0.8)
+    occupancy["created"] = occupancy["event_timestamp"] + pd.Timedelta(hours=1)
+    if ties:
+        # rows created again with the same timestamp, the last created wins whatever the file order
+        updates = occupancy.sample(frac=0.2, random_state=seed)
+        updates["created"] += pd.to_timedelta(rng.choice([-1, 1], len(updates)), unit="min")
+        occupancy = pd.concat([occupancy, updates], ignore_index=True)
+    occupancy["occupancy_rate"] = rng.random(len(occupancy)).astype("float32")
+    occupancy["revenue"] = rng.integers(0, 5000, len(occupancy)).astype("int64")
+    occupancy = occupancy.sample(frac=1, random_state=seed)
+    occupancy.to_parquet(os.path.join(data_dir, "occupancy.parquet"), index=False)
+
+    listing = _source_rows(rng, 0.6)
+    listing["bedrooms"] = rng.integers(0, 5, len(listing)).astype("int64")
+    listing["fee"] = rng.normal(50, 10, len(listing))
+    listing[MONTH_PARTITION] = listing["event_timestamp"].dt.strftime("%Y-%m")
+    # by month only: feast (the reference) fails on the empty dask partitions of many small files
+    write_partitioned(
+        listing,
+        os.path.join(data_dir, "listing"),
+        [MONTH_PARTITION],
+        sort_by=[KEY, "event_timestamp"],
+        row_group_rows=16,
+    )
+
+    # the properties of the last ids are never located
+    location = _source_rows(rng, 0.3)
+    location = location[location[KEY] < N_PROPERTIES - 5]
+    location["num_neighbours"] = rng.integers(0, 30, len(location)).astype("int64")
+    location.to_parquet(os.path.join(data_dir, "location.parquet"), index=False)
+
+    entity = Entity(name=KEY)
+    occupancy_source = FileSource(
+        name="occupancy_source",
+        path=os.path.join(data_dir, "occupancy.parquet"),
+        timestamp_field="event_timestamp",
+        created_timestamp_column="created",
+    )
+    listing_source = FileSource(
+        name="listing_source",
+        path=os.path.join(data_dir, "listing"),
+        timestamp_field="event_timestamp",
+        field_mapping={"fee": "cleaning_fee"},
+    )
+    location_source = FileSource(
+        name="location_source",
+        path=os.path.join(data_dir, "location.parquet"),
+        timestamp_field="event_timestamp",
+    )
+    occupancy_fv = FeatureView(
+        name="occupancy",
+        entities=[entity],
+        ttl=timedelta(days=1),
+        schema=[Field(name="occupancy_rate", dtype=Float32), Field(name="revenue", dtype=Int64)],
+        source=occupancy_source,
+    )
+    listing_fv = FeatureView(
+        name="listing",
+        entities=[entity],
+        ttl=timedelta(days=40),
+        schema=[Field(name="bedrooms", dtype=Int64), Field(name="cleaning_fee", dtype=Float64)],
+        source=listing_source,
+    )
+    location_fv = FeatureView(
+        name="location",
+        entities=[entity],
+        ttl=timedelta(0),
+        schema=[Field(name="num_neighbours", dtype=Int64)],
+        source=location_source,
+    )
+    views = [occupancy_fv, listing_fv, location_fv]
+    if on_demand:
+        views.append(
+            on_demand_feature_view(
+                sources=[occupancy_fv],
+                schema=[Field(name="occupied_revenue", dtype=Float64)],
+            )(on_demand_occupancy)
+        )
+
+    fs = FeatureStore(
+        config=RepoConfig(
+            project="test_pit_join",
+            registry=os.path.join(data_dir, "registry.db"),
+            provider="local",
+            online_store={"type": "sqlite", "path": os.path.join(data_dir, "online_store.db")},
+            entity_key_serialization_version=2,
+            repo_path=repo_path,
+        )
+    )
+    fs.apply([entity, occupancy_source, listing_source, location_source])
+    fs.apply(views)
+    return fs
+
+
+def make_entity_df(seed: int = 0, n: int = 300) -> pd.DataFrame:
+    """Entities at the timestamps of the features, inside, at the limit and out of the ttl,
+    with unknown properties and duplicated rows"""
+    rng = np.random.default_rng(seed)
+    offsets = pd.to_timedelta(
+        rng.choice([0, 3600, 86400, 86401, 20 * 86400, 45 * 86400], n), unit="s"
+    )
+    df = pd.DataFrame(
+        {
+            KEY: rng.integers(0, N_PROPERTIES + 10, n),
+            "event_timestamp": MONTHS[rng.integers(0, len(MONTHS), n)] + offsets,
+        }
+    )
+    return pd.concat([df, df.sample(20, random_state=seed)], ignore_index=True)
+
+
+@pytest.fixture(scope="module")
+def fs(tmp_path_factory) -> FeatureStore:
+    return make_feature_store(str(tmp_path_factory.mktemp("feature_repo")), on_demand=True)
+
+
+def _sorted(df: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    return df.sort_values(keys, kind="stable", ignore_index=True)
+
+
+def assert_same_as_feast(
+    fs: FeatureStore, entity_df: pd.DataFrame, features: List[str], full_feature_names: bool = False
+) -> pd.DataFrame:
+    """The two retrievals are the same rows, columns and dtypes. Feast does not sort the rows
+    of the entities with the same timestamp, both are compared sorted"""
+    expected = fs.get_historical_features(
+        entity_df=entity_df, features=features, full_feature_names=full_feature_names
+    ).to_df()
+    job = get_historical_features(fs, entity_df, features, full_feature_names=full_feature_names)
+    result = job.to_df()
+
+    keys = [KEY, "event_timestamp"]
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(_sorted(result, keys), _sorted(expected, keys))
+    # the arrow result is the same frame
+    pd.testing.assert_frame_equal(job.to_arrow().to_pandas(), result)
+    return result
+
+
+@pytest.mark.parametrize("full_feature_names", [False, True])
+def test_matches_feast(fs, full_feature_names):
+    result = assert_same_as_feast(fs, make_entity_df(), FEATURES, full_feature_names)
+
+    column = "occupancy__occupancy_rate" if full_feature_names else "occupancy_rate"
+    # the sample covers the cases of the join: missing features, unknown and dropped entities
+    assert result[column].isna().any()
+    assert result[KEY].ge(N_PROPERTIES).any()
+    assert len(result) < len(make_entity_df().drop_duplicates())
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_matches_feast_on_other_samples(tmp_path, seed):
+    fs = make_feature_store(str(tmp_path), seed=seed)
+    assert_same_as_feast(fs, make_entity_df(seed), FEATURES)
+
+
+def test_ttl_expiry(fs):
+    # the rows of a property are a month apart, longer than the ttl of a day
+    row = pd.read_parquet(fs.get_feature_view("occupancy").batch_source.path).iloc[0]
+    entity_df = pd.DataFrame(
+        {
+            KEY: [row[KEY]] * 3,
+            "event_timestamp": row["event_timestamp"]
+            + pd.to_timedelta([0, 86400, 86401], unit="s"),
+        }
+    )
+    result = assert_same_as_feast(fs, entity_df, ["occupancy:occupancy_rate"])
+
+    # the rows up to the ttl are kept, the expired one is dropped as in the file offline store
+    kept = result["event_timestamp"].dt.tz_localize(None)
+    assert kept.tolist() == entity_df["event_timestamp"].iloc[:2].tolist()
+
+
+def test_unknown_entities_get_missing_values(fs):
+    occupancy = pd.read_parquet(fs.get_feature_view("occupancy").batch_source.path)
+    # a property never located, and one unknown to all the sources
+    not_located = occupancy.loc[
+        (occupancy[KEY] >= N_PROPERTIES - 5) & (occupancy["event_timestamp"] == MONTHS[2]), KEY
+    ].iloc[0]
+    entity_df = pd.DataFrame(
+        {KEY: [not_located, N_PROPERTIES + 1], "event_timestamp": [MONTHS[2]] * 2}
+    )
+    # feast fails on the empty partitions of a few entities, they are added to a larger sample
+    result = assert_same_as_feast(
+        fs, pd.concat([make_entity_df(), entity_df], ignore_index=True), FEATURES
+    )
+
+    rows = result[result["event_timestamp"].eq(MONTHS[2].tz_localize("UTC"))].set_index(KEY)
+    assert rows.loc[[not_located, N_PROPERTIES + 1], "num_neighbours"].isna().all()
+    assert pd.notna(rows.loc[not_located, "occupancy_rate"])
+    assert rows.loc[N_PROPERTIES + 1, ["occupancy_rate", "bedrooms"]].isna().all()
+
+
+def test_created_timestamp_breaks_ties(tmp_path):
+    fs = make_feature_store(str(tmp_path), ties=True)
+    feature_df = pd.read_parquet(fs.get_feature_view("occupancy").batch_source.path)
+    ties = feature_df[feature_df.duplicated([KEY, "event_timestamp"], keep=False)]
+    entity_df = _sorted(ties[[KEY, "event_timestamp"]].drop_duplicates(), [KEY, "event_timestamp"])
+    assert len(entity_df) > 10
+
+    result = _sorted(
+        get_historical_features(fs, entity_df, ["occupancy:occupancy_rate"]).to_df(),
+        [KEY, "event_timestamp"],
+    )
+    last_created = ties.sort_values("created").drop_duplicates([KEY, "event_timestamp"], keep="last")
+    np.testing.assert_array_equal(
+        result["occupancy_rate"].values,
+        _sorted(last_created, [KEY, "event_timestamp"])["occupancy_rate"].values,
+    )
+    # feast sorts by creation and then by timestamp with the unstable sort of dask: the last
+    # created row wins only when the rows are not split in several partitions, one entity at a time
+    for i in range(5):
+        assert_same_as_feast(fs, entity_df.iloc[[i]], ["occupancy:occupancy_rate"])
+
+
+def test_duplicate_entity_rows(fs):
+    entity_df = make_entity_df()
+    duplicated = entity_df.duplicated([KEY, "event_timestamp"])
+    assert duplicated.any()
+
+    result = assert_same_as_feast(fs, entity_df, FEATURES)
+
+    assert not result.duplicated([KEY, "event_timestamp"]).any()
+
+
+def test_on_demand_features_fall_back_to_feast(fs):
+    entity_df = make_entity_df()
+    features = FEATURES + ["on_demand_occupancy:occupied_revenue"]
+    job = get_historical_features(fs, entity_df, features)
+
+    assert not isinstance(job, AsOfRetrievalJob)
+    expected = fs.get_historical_features(entity_df=entity_df, features=features).to_df()
+    keys = [KEY, "event_timestamp"]
+    pd.testing.assert_frame_equal(_sorted(job.to_df(), keys), _sorted(expected, keys))
+
+
+def test_without_event_timestamp_falls_back_to_feast(fs):
+    entity_df = make_entity_df().rename(columns={"event_timestamp": "ts"})
+    job = get_historical_features(fs, entity_df, FEATURES)
+
+    assert not isinstance(job, AsOfRetrievalJob)
+    expected = fs.get_historical_features(entity_df=entity_df, features=FEATURES).to_df()
+    keys = [KEY, "ts"]
+    pd.testing.assert_frame_equal(_sorted(job.to_df(), keys), _sorted(expected, keys))
+
+
+TRAIN_DF = os.path.join(FEATURE_REPO, "data", "train_df.parquet")
+
+
+@pytest.mark.skipif(
+    not os.path.exists(TRAIN_DF), reason="the project data is prepared by launch_project.py"
+)
+def test_matches_feast_on_the_training_entities():
+    # 27678 identical rows on the three markets of bc_data, in about 30 s for feast
+    fs = get_feature_store()
+    entity_df = pd.read_parquet(TRAIN_DF)
+
+    result = assert_same_as_feast(fs, entity_df, get_feature_refs())
+
+    assert len(result) == len(entity_df.drop_duplicates([KEY, "event_timestamp"]))
@@ -0,0 +1,71 @@
+import os
+from typing import Dict, List, Tuple
+
+import pandas as pd
+import pytest
+
+from prepare_data import CONFIG, prepare_market
+
+MARKET_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, CONFIG["INPUT_DATA_DIR"], "MalibuPerformanceData.csv"
+)
+SOURCES = ["DATA1", "DATA2", "DATA3", "DATA4", "DATA5", "TARGETDF"]
+
+
+def read_sources() -> Dict[str, pd.DataFrame]:
+    return {
+        key: pd.read_parquet(os.path.join(CONFIG["OUT_DATA_DIR"], CONFIG[key]))
+        .sort_values(["airbnb_property_id", "event_timestamp"], ignore_index=True)
+        for key in SOURCES
+    }
+
+
+def run(run_dir: str, steps: List[Tuple[str, bool]]) -> Dict[str, pd.DataFrame]:
+    """Sources written in run_dir by successive preparations of the market (file, incremental)"""
+    os.makedirs(run_dir)
+    cwd = os.getcwd()
+    # OUT_DATA_DIR is relative to the working directory
+    os.chdir(run_dir)
+    try:
+        for path, incremental in steps:
+            prepare_market(path, incremental=incremental, out_of_core=False)
+        return read_sources()
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.mark.parametrize("drop_property", [False, True])
+def test_incremental_matches_full_run(tmp_path, drop_property):
+    raw = pd.read_csv(MARKET_FILE, dtype=str, keep_default_na=False)
+    months = sorted(raw["Reporting Month"].unique())
+    # the market as it was three months ago, then with the new months
+    old_file = tmp_path / "old" / os.path.basename(MARKET_FILE)
+    new_file = tmp_path / "new" / os.path.basename(MARKET_FILE)
+    os.makedirs(old_file.parent)
+    os.makedirs(new_file.parent)
+    raw[raw["Reporting Month"] <= months[-3]].to_csv(old_file, index=False)
+    if drop_property:
+        # a property removed from the whole history of the file: its neighbours are counted again
+        raw = raw[raw["Airbnb Property ID"] != raw["Airbnb Property ID"].iloc[0]]
+    raw.to_csv(new_file, index=False)
+
+    full = run(tmp_path / "full", [(str(new_file), False)])
+    incremental = run(tmp_path / "incremental", [(str(old_file), False), (str(new_file), True)])
+
+    for key in SOURCES:
+        pd.testing.assert_frame_equal(incremental[key], full[key], obj=key)
+
+
+def test_full_run_drops_the_months_not_in_the_file(tmp_path):
+    raw = pd.read_csv(MARKET_FILE, dtype=str, keep_default_na=False)
+    months = sorted(raw["Reporting Month"].unique())
+    old_file = tmp_path / "old" / os.path.basename(MARKET_FILE)
+    os.makedirs(old_file.parent)
+    raw[raw["Reporting Month"] <= months[-3]].to_csv(old_file, index=False)
+
+    # the whole file, then a full run of the file with fewer months
+    rerun = run(tmp_path / "rerun", [(MARKET_FILE, False), (str(old_file), False)])
+    full = run(tmp_path / "full", [(str(old_file), False)])
+
+    for key in SOURCES:
+        pd.testing.assert_frame_equal(rerun[key], full[key], obj=key)
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+from utils.rates import RATE_DTYPE, RATES, get_rates, safe_divide
+
+
+def test_safe_divide_gives_nan_instead_of_inf():
+    numerator = np.array([6.0, 0.0, 3.0, np.nan, 1.0, 0.0])
+    denominator = np.array([3.0, 0.0, 0.0, 2.0, np.nan, 5.0])
+
+    with np.errstate(all="raise"):
+        result = safe_divide(numerator, denominator)
+
+    assert result.dtype == RATE_DTYPE
+    # a zero denominator, 0/0 and a missing value are all nan
+    np.testing.assert_array_equal(
+        result, np.array([2.0, np.nan, np.nan, np.nan, np.nan, 0.0], dtype=RATE_DTYPE)
+    )
+    assert not np.isinf(result).any()
+
+
+def test_rates_of_the_online_store_rows():
+    # the online store returns objects, with None for the unknown properties
+    df = pd.DataFrame(
+        {"blocked_days": [10, 0, 0, None], "available_days": [20, 30, 0, None]},
+        index=[5, 6, 7, 8],
+        dtype=object,
+    )
+
+    rates = get_rates(df)
+
+    assert list(rates.columns) == list(RATES)
+    assert (rates.dtypes == RATE_DTYPE).all()
+    pd.testing.assert_index_equal(rates.index, df.index)
+    np.testing.assert_array_equal(
+        rates["rate_blocked_days"], np.array([0.5, 0.0, np.nan, np.nan], dtype=RATE_DTYPE)
+    )
+    np.testing.assert_array_equal(
+        rates["rate_available_days"], np.array([2.0, np.nan, np.nan, np.nan], dtype=RATE_DTYPE)
+    )
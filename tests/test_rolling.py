@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.rolling import TREND_MONTHS, MonthlySegments, trend_features
+
+N_MONTHS = 8
+
+
+def make_rows(n_properties: int = 40, seed: int = 0) -> pd.DataFrame:
+    """Monthly rows in random order, with missing months inside the series, series shorter than
+    the windows and some missing values"""
+    rng = np.random.default_rng(seed)
+    listed = rng.random((n_properties, N_MONTHS)) < 0.7
+    # a property listed only once
+    listed[0] = False
+    listed[0, 3] = True
+    property_ids, months = np.nonzero(listed)
+    df = pd.DataFrame(
+        {
+            "airbnb_property_id": property_ids * 10 + 1,
+            "month": months + 24000,
+            "occupancy_rate": rng.random(len(months)),
+            "revenue_usd": rng.random(len(months)) * 1000,
+            "adr_usd": rng.random(len(months)) * 200,
+        }
+    )
+    df.loc[rng.random(len(df)) < 0.1, "adr_usd"] = np.nan
+    return df.sample(frac=1, random_state=seed, ignore_index=True)
+
+
+def on_month_grid(df: pd.DataFrame) -> pd.DataFrame:
+    """Every property on every month of its span, nan in the months it was not listed,
+    so that shift and rolling count months instead of rows"""
+    return (
+        df.set_index(["airbnb_property_id", "month"])
+        .sort_index()
+        .groupby(level="airbnb_property_id", group_keys=False)
+        .apply(
+            lambda g: g.reindex(
+                pd.MultiIndex.from_product(
+                    [g.index.get_level_values(0)[:1], range(g.index[0][1], g.index[-1][1] + 1)],
+                    names=g.index.names,
+                )
+            )
+        )
+    )
+
+
+def back_to_rows(reference: pd.Series, df: pd.DataFrame) -> np.ndarray:
+    return reference.reindex(pd.MultiIndex.from_frame(df[["airbnb_property_id", "month"]])).to_numpy()
+
+
+@pytest.mark.parametrize("k", [1, TREND_MONTHS, N_MONTHS + 2])
+def test_lag_and_window_match_groupby(k):
+    df = make_rows()
+    segments = MonthlySegments(df["airbnb_property_id"].to_numpy(), df["month"].to_numpy())
+    values = segments.sort(df["revenue_usd"].to_numpy())
+    grid = on_month_grid(df)["revenue_usd"].groupby(level="airbnb_property_id")
+
+    lag = segments.unsort(segments.lag(values, k))
+    np.testing.assert_array_equal(lag, back_to_rows(grid.shift(k), df))
+
+    # the values of the listed months of the window, in any order. Windows longer than the whole
+    # history hold only the months that exist
+    window = segments.window(values, k)
+    expected = np.stack([back_to_rows(grid.shift(j), df) for j in range(k)], axis=1)
+    np.testing.assert_array_equal(
+        np.sort(segments.unsort(window), axis=1), np.sort(expected, axis=1)
+    )
+    window_sum = segments.unsort(np.nansum(window, axis=1))
+    expected = back_to_rows(grid.rolling(k, min_periods=1).sum().droplevel(0), df)
+    np.testing.assert_allclose(window_sum, expected)
+
+
+def test_trend_features_match_groupby():
+    df = make_rows(seed=1)
+    first_seen = pd.Series([24000 - 5], index=[df["airbnb_property_id"].iloc[0]])
+
+    result = trend_features(df, df["month"].to_numpy(), first_seen)
+
+    grid = on_month_grid(df).groupby(level="airbnb_property_id")
+    for column, name in [("occupancy_rate", "occupancy"), ("revenue_usd", "revenue")]:
+        expected = back_to_rows(grid[column].diff(TREND_MONTHS), df)
+        np.testing.assert_allclose(result[f"{name}_change_{TREND_MONTHS}m"], expected)
+    # standard deviation of the listed months of the window, at least two of them
+    volatility = grid["adr_usd"].rolling(TREND_MONTHS, min_periods=2).std().droplevel(0)
+    np.testing.assert_allclose(
+        result[f"adr_volatility_{TREND_MONTHS}m"], back_to_rows(volatility, df), rtol=1e-9
+    )
+
+    first = df.groupby("airbnb_property_id")["month"].transform("min")
+    first = np.fmin(first, df["airbnb_property_id"].map(first_seen))
+    np.testing.assert_array_equal(result["months_since_first_seen"], df["month"] - first)
+    pd.testing.assert_index_equal(result.index, df.index)
@@ -0,0 +1,116 @@
+import asyncio
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from fastapi.testclient import TestClient
+
+from scoring_service import ChurnScorer, MicroBatcher, create_app
+from utils.schema import get_model_columns
+from utils.tracing import RECORDS
+
+
+class FakeOnlineResponse:
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+    def to_df(self) -> pd.DataFrame:
+        return self.df
+
+
+class EmptyOnlineStore:
+    """Online store without any property: every feature is missing, as feast returns them"""
+
+    def get_online_features(self, features: List[str], entity_rows: List[Dict]) -> FakeOnlineResponse:
+        assert entity_rows
+        df = pd.DataFrame({c: [None] * len(entity_rows) for c in get_model_columns()}, dtype=object)
+        df.insert(0, "airbnb_property_id", [row["airbnb_property_id"] for row in entity_rows])
+        return FakeOnlineResponse(df)
+
+
+class ListedOnlineStore:
+    """Online store of the properties with an id below 100, their features are a function of the id"""
+
+    def get_online_features(self, features: List[str], entity_rows: List[Dict]) -> FakeOnlineResponse:
+        ids = [row["airbnb_property_id"] for row in entity_rows]
+        df = pd.DataFrame(
+            {c: [(i % 10) / 10 if i < 100 else None for i in ids] for c in get_model_columns()},
+            dtype=object,
+        )
+        df.insert(0, "airbnb_property_id", ids)
+        return FakeOnlineResponse(df)
+
+
+class RecordingModel:
+    classes_ = np.array([False, True])
+
+    def __init__(self):
+        self.rows: List[int] = []
+
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
+        X = X[get_model_columns()].astype("float32")
+        self.rows.append(len(X))
+        return np.tile([0.25, 0.75], (len(X), 1))
+
+
+class FeatureModel(RecordingModel):
+    """Probability of leaving equal to the first model column"""
+
+    def predict_proba(self, X: pd.DataFrame) -> np.ndarray:
+        leaving = X[get_model_columns()[0]].to_numpy(dtype="float64")
+        self.rows.append(len(X))
+        return np.column_stack([leaving, 1 - leaving])
+
+
+def test_startup_warms_up_the_model_and_rejects_empty_requests():
+    model = RecordingModel()
+    scorer = ChurnScorer(EmptyOnlineStore(), model, "run")
+
+    with TestClient(create_app(scorer, max_batch_size=4, max_wait_ms=1)) as client:
+        # the warm-up predicts once, even if no property is in the online store
+        assert model.rows == [1]
+
+        response = client.post("/score", json={"airbnb_property_ids": []})
+        assert response.status_code == 422
+
+        response = client.post("/score", json={"airbnb_property_ids": [1, 2]})
+        assert response.status_code == 200
+        assert response.json()["churn_probability"] == [None, None]
+        assert model.rows == [1]
+    # every micro batch is traced
+    assert [r["rows"] for r in RECORDS if r["name"] == "scoring.batch"][-1] == 2
+
+
+def test_concurrent_requests_share_one_batch():
+    model = FeatureModel()
+    scorer = ChurnScorer(ListedOnlineStore(), model, "run")
+    # repeated and unknown ids, requests of different sizes
+    requests = [[1, 2, 3], [3], [45, 46, 500], [7, 7, 8, 9]]
+    expected = [scorer.score(np.array(ids)) for ids in requests]
+    model.rows.clear()
+
+    calls = []
+
+    def score_fn(ids: np.ndarray) -> np.ndarray:
+        calls.append(len(ids))
+        return scorer.score(ids)
+
+    async def serve() -> List[np.ndarray]:
+        # the batch waits for all the requests: they arrive well within max_wait_ms
+        batcher = MicroBatcher(score_fn, max_batch_size=100, max_wait_ms=1000)
+        await batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(ids) for ids in requests))
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(serve())
+
+    # one lookup and one predict for all the requests, on the unique known ids
+    assert calls == [sum(len(ids) for ids in requests)]
+    assert model.rows == [len({i for ids in requests for i in ids if i < 100})]
+    for ids, result, direct in zip(requests, results, expected):
+        assert len(result) == len(ids)
+        np.testing.assert_array_equal(result, direct)
+    assert np.isnan(results[2][2])
+    np.testing.assert_array_equal(results[0], [0.1, 0.2, 0.3])
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.validation import Expectation, failed_rows, reservoir_sample, validate
+
+N_ROWS = 1000
+
+
+def make_rows(seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "airbnb_property_id": np.arange(N_ROWS),
+            "available_days": rng.integers(1, 32, N_ROWS).astype("float64"),
+            # a nullable feature, missing for a third of the rows
+            "neighbours_adr_mean_100m": rng.random(N_ROWS) * 200,
+        }
+    )
+    df.loc[rng.random(N_ROWS) < 0.3, "neighbours_adr_mean_100m"] = np.nan
+    return df
+
+
+def test_passing_expectation():
+    df = make_rows()
+
+    report = validate(df, [Expectation("available_days", min_value=1, max_value=31)])
+
+    assert report.success
+    assert report.rows == N_ROWS
+    assert report.results[0].checked == N_ROWS
+    assert report.results[0].failed == 0
+    assert report.offending_rows.empty
+
+
+def test_failing_expectation(tmp_path):
+    df = make_rows()
+    df.loc[:19, "available_days"] = 40
+    expectations = [
+        Expectation("available_days", max_value=31, mostly=0.99),
+        Expectation("neighbours_adr_mean_100m", min_value=0),
+    ]
+
+    report = validate(df, expectations)
+
+    # 2% of the rows out of range, only 1% is tolerated
+    assert not report.success
+    assert [r.success for r in report.results] == [False, True]
+    assert report.results[0].failed == 20
+    assert report.offending_rows.index.tolist() == list(range(20))
+    assert report.offending_rows["failed_available_days"].all()
+    assert not report.offending_rows["failed_neighbours_adr_mean_100m"].any()
+    assert failed_rows(df, expectations).sum() == 20
+    # the same outcome from the parquet file, read in batches
+    path = str(tmp_path / "rows.parquet")
+    df.to_parquet(path)
+    from_file = validate(path, expectations, batch_size=64)
+    assert from_file.results == report.results
+    pd.testing.assert_frame_equal(from_file.offending_rows, report.offending_rows)
+
+
+def test_missing_values_are_not_checked():
+    df = make_rows()
+    missing = int(df["neighbours_adr_mean_100m"].isna().sum())
+    assert missing > 0
+
+    expectations = [Expectation("neighbours_adr_mean_100m", min_value=0, max_value=200)]
+    report = validate(df, expectations)
+
+    assert report.success
+    assert report.results[0].checked == N_ROWS - missing
+    assert not failed_rows(df, expectations).any()
+
+
+def _frames(n_rows: int, frame_rows: int = 64):
+    df = pd.DataFrame({"row": np.arange(n_rows)})
+    return (df.iloc[i : i + frame_rows] for i in range(0, n_rows, frame_rows))
+
+
+@pytest.mark.parametrize("k", [1, 50, N_ROWS - 1])
+def test_reservoir_sample_has_k_rows(k):
+    sample = reservoir_sample(_frames(N_ROWS), k, seed=0)
+
+    assert len(sample) == k
+    # distinct rows, in stream order and with their index
+    assert sample["row"].is_unique
+    assert sample["row"].is_monotonic_increasing
+    assert (sample.index == sample["row"]).all()
+
+
+def test_reservoir_sample_is_deterministic():
+    first = reservoir_sample(_frames(N_ROWS), 50, seed=1)
+
+    pd.testing.assert_frame_equal(reservoir_sample(_frames(N_ROWS), 50, seed=1), first)
+    assert not reservoir_sample(_frames(N_ROWS), 50, seed=2).equals(first)
+
+
+def test_reservoir_sample_of_fewer_rows_than_k():
+    sample = reservoir_sample(_frames(30, frame_rows=7), 50)
+
+    assert sample["row"].tolist() == list(range(30))
+    assert reservoir_sample(_frames(0), 50) is None